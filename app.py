@@ -1,12 +1,33 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, make_response
-from models import db, User, Entry, Batch, Equipment, Material, BatchMaterial, Product, BatchTemplate, BatchTemplateMaterial
+from flask import Flask, Response, render_template, request, redirect, url_for, session, jsonify, make_response, send_file, g, has_app_context, stream_with_context
+from models import db, User, Entry, Batch, Equipment, Material, BatchMaterial, Product, BatchTemplate, BatchTemplateMaterial, DailyMaterialRollup, MaterialLedger, KpiSnapshot, DataVersion, ExportJob
+from material_rollup import ENTRY_MATERIALS
+from material_ledger import sync_batches, sync_entries
+from xlsx_export import MAX_COLUMN_WIDTH, XLSX_MIMETYPE, column_width, write_xlsx
+from export_jobs import ExportFileCache, ExportQueue, job_status
+from parquet_export import BATCH_MATERIAL_SCHEMA, BATCH_SCHEMA, ENTRY_SCHEMA, parquet_available, write_parquet
+from downsample import lttb_indices, parse_points
+from durations import BATCH_DURATION_MINUTES, DURATION_BATCH_TYPES, duration_stats, parse_bins
+from utilization import daily_utilization, summarize_utilization
+from timeline import TIMELINE_MAX_PAGE_SIZE, TIMELINE_PAGE_SIZE, decode_cursor, timeline_item_json, timeline_page
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session, configure_mappers, joinedload, selectinload
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from functools import wraps
 import csv
+import hashlib
 import io
 import json
 import os
+import pickle
+import sqlite3
+import sys
+import threading
 import time
+import uuid
+import zlib
 import openpyxl
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
@@ -18,56 +39,907 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 db.init_app(app)
 
+# === СТРАТЕГИИ ЗАГРУЗКИ СВЯЗЕЙ ===
+# Все связи в models.py ленивые, поэтому маршруты, которые обходят списки,
+# явно указывают, что подгрузить заранее, чтобы не получать N+1 запросов.
+configure_mappers()  # backref-атрибуты (Batch.product, Batch.equipment) появляются только после настройки мапперов
+
+# Списки партий и экспорт: продукт и оборудование одним JOIN
+BATCH_LIST_LOADERS = (joinedload(Batch.product), joinedload(Batch.equipment))
+
+# Партии с материалами: материалы отдельным SELECT ... IN, справочник материалов JOIN
+BATCH_MATERIALS_LOADERS = (selectinload(Batch.materials).joinedload(BatchMaterial.material),)
+
+# Шаблоны партий: продукт, оборудование и материалы
+TEMPLATE_LOADERS = (
+    joinedload(BatchTemplate.product),
+    joinedload(BatchTemplate.equipment),
+    selectinload(BatchTemplate.materials).joinedload(BatchTemplateMaterial.material),
+)
+
 # === СИСТЕМА КЭШИРОВАНИЯ ===
-class SimpleCache:
-    def __init__(self):
-        self.cache = {}
-        self.cache_ttl = {}  # Time To Live
-    
+def cache_scope(tables, date_from=None, date_to=None, batch_types=None):
+    """Область данных, от которой зависит значение в кэше.
+
+    tables - таблицы-источники, date_from/date_to - период (None - без границы),
+    batch_types - типы партий (None - любые). По области после коммита решается,
+    какие ключи устарели (см. invalidate).
+    """
+    return {
+        "tables": sorted(tables),
+        "date_from": date_from.isoformat() if date_from else None,
+        "date_to": date_to.isoformat() if date_to else None,
+        "batch_types": sorted(batch_types) if batch_types else None,
+    }
+
+def scope_matches(scope, table, day=None, batch_type=None):
+    """Затрагивает ли изменение (таблица, дата, тип партии) значение с областью scope"""
+    if not scope or table not in scope["tables"]:
+        return False
+    if day is not None:
+        if scope["date_from"] and day < scope["date_from"]:
+            return False
+        if scope["date_to"] and day > scope["date_to"]:
+            return False
+    if batch_type is not None and scope["batch_types"] and batch_type not in scope["batch_types"]:
+        return False
+    return True
+
+class CacheBackend:
+    """Интерфейс бэкенда кэша, которым пользуется get_cached_data"""
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl_seconds=300, scope=None):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """Свежие значения нескольких ключей за одно обращение: {ключ: значение}, промахов в словаре нет"""
+        raise NotImplementedError
+
+    def set_many(self, items):
+        """Записывает значения [(ключ, значение, ttl_seconds, scope)] за одно обращение"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def clear_pattern(self, pattern):
+        raise NotImplementedError
+
+    def invalidate(self, changes):
+        """Удаляет значения, область которых затронута изменениями [(таблица, дата ISO, тип партии)]"""
+        raise NotImplementedError
+
+    def get_or_load(self, key, loader, ttl_seconds=300, scope=None):
+        raise NotImplementedError
+
+    def status(self):
+        raise NotImplementedError
+
+class LRUCache(CacheBackend):
+    """Ограниченный потокобезопасный кэш с вытеснением давно неиспользуемых ключей (LRU).
+
+    - размер ограничен числом записей и примерным объемом в байтах;
+    - get_or_load пересчитывает значение только в одном потоке на ключ
+      (остальные ждут его результата, а не запускают тот же тяжелый запрос);
+    - после истечения TTL значение еще stale_seconds отдается как устаревшее,
+      пока один поток его пересчитывает (stale-while-revalidate).
+    """
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024, stale_seconds=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_seconds = stale_seconds
+        self._entries = OrderedDict()  # ключ -> [значение, истекает, размер, область]
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._load_locks = {}  # ключ -> [блокировка загрузки, число ее пользователей] (single-flight)
+        self.stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "loads": 0,
+            "load_errors": 0,
+            "load_time_total": 0.0,
+        }
+
+    @staticmethod
+    def _estimate_size(value):
+        """Примерный размер значения в байтах"""
+        try:
+            return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return sys.getsizeof(value)
+
+    def _lookup(self, key):
+        """Возвращает (значение, свежее ли оно) или None; удаляет совсем устаревшие записи"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry[0], entry[1]
+        now = time.time()
+        if now < expires_at:
+            self._entries.move_to_end(key)
+            return value, True
+        if now < expires_at + self.stale_seconds:
+            return value, False
+        self._remove(key)
+        return None
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def _evict(self):
+        """Вытесняет самые давно использованные записи, пока кэш не уложится в лимиты"""
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            key, entry = self._entries.popitem(last=False)
+            self._bytes -= entry[2]
+            self.stats["evictions"] += 1
+
     def get(self, key):
-        if key in self.cache:
-            if time.time() < self.cache_ttl.get(key, 0):
-                return self.cache[key]
+        with self._lock:
+            found = self._lookup(key)
+            if found and found[1]:
+                self.stats["hits"] += 1
+                return found[0]
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, key, value, ttl_seconds=300, scope=None):  # 5 минут по умолчанию
+        size = self._estimate_size(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return  # Значение больше всего кэша - не кэшируем
+            self._entries[key] = [value, time.time() + ttl_seconds, size, scope]
+            self._bytes += size
+            self._evict()
+
+    def get_many(self, keys):
+        with self._lock:
+            return {key: value for key, value in ((key, self.get(key)) for key in keys) if value is not None}
+
+    def set_many(self, items):
+        for key, value, ttl_seconds, scope in items:
+            self.set(key, value, ttl_seconds, scope)
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def clear_pattern(self, pattern):
+        """Очищает кэш по паттерну ключа"""
+        with self._lock:
+            for key in [key for key in self._entries if pattern in key]:
+                self._remove(key)
+
+    def invalidate(self, changes):
+        with self._lock:
+            stale = [
+                key for key, entry in self._entries.items()
+                if any(scope_matches(entry[3], *change) for change in changes)
+            ]
+            for key in stale:
+                self._remove(key)
+            return len(stale)
+
+    def _load_lock(self, key):
+        """Блокировка загрузки ключа; каждый взявший ее обязан вызвать _release_load_lock"""
+        with self._lock:
+            holder = self._load_locks.setdefault(key, [threading.Lock(), 0])
+            holder[1] += 1
+            return holder[0]
+
+    def _release_load_lock(self, key):
+        """Блокировка удаляется, только когда ее больше никто не держит и не ждет"""
+        with self._lock:
+            holder = self._load_locks[key]
+            holder[1] -= 1
+            if holder[1] == 0:
+                del self._load_locks[key]
+
+    def _load(self, key, loader, ttl_seconds, scope):
+        started = time.perf_counter()
+        try:
+            value = loader()
+        except Exception:
+            with self._lock:
+                self.stats["load_errors"] += 1
+            raise
+        elapsed = time.perf_counter() - started
+        self.set(key, value, ttl_seconds, scope)
+        with self._lock:
+            self.stats["loads"] += 1
+            self.stats["load_time_total"] += elapsed
+        return value
+
+    def get_or_load(self, key, loader, ttl_seconds=300, scope=None):
+        """Возвращает значение из кэша или вычисляет его loader() ровно в одном потоке"""
+        with self._lock:
+            found = self._lookup(key)
+            if found and found[1]:
+                self.stats["hits"] += 1
+                return found[0]
+
+        load_lock = self._load_lock(key)
+        try:
+            if found:
+                # Устаревшее значение: пересчитывает первый пришедший, остальные получают старое
+                if not load_lock.acquire(blocking=False):
+                    with self._lock:
+                        self.stats["stale_hits"] += 1
+                    return found[0]
             else:
-                # Кэш истек
-                del self.cache[key]
-                del self.cache_ttl[key]
+                load_lock.acquire()
+
+            try:
+                # Пока ждали блокировку, значение мог загрузить другой поток
+                with self._lock:
+                    fresh = self._lookup(key)
+                    if fresh and fresh[1]:
+                        self.stats["hits"] += 1
+                        return fresh[0]
+                    self.stats["misses"] += 1
+                return self._load(key, loader, ttl_seconds, scope)
+            finally:
+                load_lock.release()
+        finally:
+            self._release_load_lock(key)
+
+    def status(self):
+        """Сводка для /cache/status"""
+        with self._lock:
+            now = time.time()
+            loads = self.stats["loads"]
+            return {
+                "backend": "memory",
+                "cache_size": len(self._entries),
+                "cache_bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "cached_keys": list(self._entries.keys()),
+                "cache_ttl": {key: entry[1] - now for key, entry in self._entries.items()},
+                "stats": dict(self.stats, avg_load_time=self.stats["load_time_total"] / loads if loads else 0),
+            }
+
+class SQLiteCacheBackend(CacheBackend):
+    """Общий для всех процессов gunicorn кэш в отдельном файле SQLite на том же хосте.
+
+    Значение, вычисленное одним воркером, получают все остальные, а очистка
+    (clear, clear_pattern, delete) сразу видна всем воркерам. Пересчет ключа
+    координируется строкой-блокировкой в таблице cache_lock, поэтому тяжелый
+    запрос выполняет только один воркер, остальные ждут результата или получают
+    устаревшее значение (stale-while-revalidate).
+    """
+    def __init__(self, path, max_entries=1024, max_bytes=128 * 1024 * 1024, stale_seconds=60,
+                 lock_timeout=30, poll_interval=0.05):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_seconds = stale_seconds
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "loads": 0,
+            "load_errors": 0,
+            "load_time_total": 0.0,
+        }
+        self._init_schema()
+
+    def _connection(self):
+        """Отдельное соединение на поток (sqlite3 не разделяет соединения между потоками)"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    SCHEMA_VERSION = 2
+
+    def _init_schema(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        connection = self._connection()
+        if connection.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            # Кэш одноразовый: при смене формата просто пересоздаем таблицы
+            connection.execute("DROP TABLE IF EXISTS cache_entry")
+            connection.execute("DROP TABLE IF EXISTS cache_lock")
+            connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        # Область значения хранится в колонках, чтобы инвалидация была одним DELETE:
+        # scope_tables и batch_types - списки через запятую с запятыми по краям (",entry,batch,")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entry ("
+            " key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL,"
+            " size INTEGER NOT NULL, last_access REAL NOT NULL,"
+            " scope_tables TEXT, date_from TEXT, date_to TEXT, batch_types TEXT)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_cache_entry_last_access ON cache_entry (last_access)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_lock (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _count(self, name, value=1):
+        with self._stats_lock:
+            self.stats[name] += value
+
+    def _lookup(self, key):
+        """Возвращает (значение, свежее ли оно) или None"""
+        connection = self._connection()
+        row = connection.execute("SELECT value, expires_at FROM cache_entry WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        now = time.time()
+        if now >= expires_at + self.stale_seconds:
+            connection.execute("DELETE FROM cache_entry WHERE key = ? AND expires_at = ?", (key, expires_at))
+            return None
+        if now < expires_at:
+            connection.execute("UPDATE cache_entry SET last_access = ? WHERE key = ?", (now, key))
+        try:
+            return pickle.loads(value), now < expires_at
+        except Exception:
+            return None
+
+    def _evict(self, connection):
+        """Вытесняет самые давно использованные записи, пока кэш не уложится в лимиты"""
+        count, total = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entry").fetchone()
+        evicted = 0
+        while count > self.max_entries or total > self.max_bytes:
+            row = connection.execute("SELECT key, size FROM cache_entry ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            connection.execute("DELETE FROM cache_entry WHERE key = ?", (row[0],))
+            count -= 1
+            total -= row[1]
+            evicted += 1
+        if evicted:
+            self._count("evictions", evicted)
+
+    def get(self, key):
+        found = self._lookup(key)
+        if found and found[1]:
+            self._count("hits")
+            return found[0]
+        self._count("misses")
         return None
-    
-    def set(self, key, value, ttl_seconds=300):  # 5 минут по умолчанию
-        self.cache[key] = value
-        self.cache_ttl[key] = time.time() + ttl_seconds
-    
+
+    def set(self, key, value, ttl_seconds=300, scope=None):
+        self.set_many([(key, value, ttl_seconds, scope)])
+
+    # Ключей в одном запросе get_many (лимит переменных SQLite)
+    MANY_CHUNK_SIZE = 500
+
+    def get_many(self, keys):
+        connection = self._connection()
+        keys = list(keys)
+        now = time.time()
+        found = {}
+        for start in range(0, len(keys), self.MANY_CHUNK_SIZE):
+            chunk = keys[start:start + self.MANY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = connection.execute(
+                f"SELECT key, value FROM cache_entry WHERE key IN ({placeholders}) AND expires_at > ?",
+                (*chunk, now)
+            ).fetchall()
+            for key, value in rows:
+                try:
+                    found[key] = pickle.loads(value)
+                except Exception:
+                    continue
+            if rows:
+                connection.execute(
+                    f"UPDATE cache_entry SET last_access = ? WHERE key IN ({','.join('?' * len(rows))})",
+                    (now, *(key for key, _ in rows))
+                )
+        self._count("hits", len(found))
+        self._count("misses", len(keys) - len(found))
+        return found
+
+    def set_many(self, items):
+        now = time.time()
+        rows = []
+        for key, value, ttl_seconds, scope in items:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(data) > self.max_bytes:
+                continue  # Значение больше всего кэша - не кэшируем
+            scope_columns = (None, None, None, None)
+            if scope:
+                scope_columns = (
+                    "," + ",".join(scope["tables"]) + ",",
+                    scope["date_from"],
+                    scope["date_to"],
+                    "," + ",".join(scope["batch_types"]) + "," if scope["batch_types"] else None,
+                )
+            rows.append((key, data, now + ttl_seconds, len(data), now) + scope_columns)
+        if not rows:
+            return
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT OR REPLACE INTO cache_entry"
+                " (key, value, expires_at, size, last_access, scope_tables, date_from, date_to, batch_types)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self._evict(connection)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM cache_entry WHERE key = ?", (key,))
+
     def clear(self):
-        self.cache.clear()
-        self.cache_ttl.clear()
-    
+        self._connection().execute("DELETE FROM cache_entry")
+
     def clear_pattern(self, pattern):
         """Очищает кэш по паттерну ключа"""
-        keys_to_remove = [key for key in self.cache.keys() if pattern in key]
-        for key in keys_to_remove:
-            del self.cache[key]
-            del self.cache_ttl[key]
-
-# Глобальный кэш
-cache = SimpleCache()
-
-def get_cached_data(key, fetch_func, ttl_seconds=300):
-    """Получает данные из кэша или выполняет функцию и кэширует результат"""
-    cached_data = cache.get(key)
-    if cached_data is not None:
-        return cached_data
-    
-    # Выполняем функцию и кэшируем результат
-    data = fetch_func()
-    cache.set(key, data, ttl_seconds)
-    return data
-
-def clear_analytics_cache():
-    """Очищает кэш аналитических данных"""
-    cache.clear_pattern("material_consumption")
-    cache.clear_pattern("daily_analytics")
-    cache.clear_pattern("weekly_analytics")
+        escaped = pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        self._connection().execute("DELETE FROM cache_entry WHERE key LIKE ? ESCAPE '\\'", (f"%{escaped}%",))
+
+    def invalidate(self, changes):
+        connection = self._connection()
+        removed = 0
+        for table, day, batch_type in changes:
+            cursor = connection.execute(
+                "DELETE FROM cache_entry WHERE instr(scope_tables, ?) > 0"
+                " AND (? IS NULL OR ((date_from IS NULL OR date_from <= ?) AND (date_to IS NULL OR date_to >= ?)))"
+                " AND (? IS NULL OR batch_types IS NULL OR instr(batch_types, ?) > 0)",
+                (f",{table},", day, day, day, batch_type, f",{batch_type},")
+            )
+            removed += cursor.rowcount
+        return removed
+
+    def _acquire(self, key):
+        """Пытается захватить блокировку пересчета ключа (одну на все воркеры)"""
+        connection = self._connection()
+        now = time.time()
+        connection.execute("DELETE FROM cache_lock WHERE key = ? AND expires_at < ?", (key, now))
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO cache_lock (key, owner, expires_at) VALUES (?, ?, ?)",
+            (key, self._owner, now + self.lock_timeout)
+        )
+        return cursor.rowcount == 1
+
+    def _release(self, key):
+        self._connection().execute("DELETE FROM cache_lock WHERE key = ? AND owner = ?", (key, self._owner))
+
+    def _load(self, key, loader, ttl_seconds, scope):
+        started = time.perf_counter()
+        try:
+            value = loader()
+        except Exception:
+            self._count("load_errors")
+            raise
+        self.set(key, value, ttl_seconds, scope)
+        self._count("loads")
+        self._count("load_time_total", time.perf_counter() - started)
+        return value
+
+    def get_or_load(self, key, loader, ttl_seconds=300, scope=None):
+        """Возвращает значение из общего кэша или вычисляет его loader() в одном воркере"""
+        found = self._lookup(key)
+        if found and found[1]:
+            self._count("hits")
+            return found[0]
+
+        if found:
+            # Устаревшее значение: пересчитывает тот, кто захватил блокировку, остальные получают старое
+            if not self._acquire(key):
+                self._count("stale_hits")
+                return found[0]
+        else:
+            # Значения нет: ждем, пока его посчитает воркер, захвативший блокировку
+            deadline = time.time() + self.lock_timeout
+            while not self._acquire(key):
+                if time.time() >= deadline:
+                    break  # Владелец блокировки завис - считаем сами
+                time.sleep(self.poll_interval)
+                fresh = self._lookup(key)
+                if fresh and fresh[1]:
+                    self._count("hits")
+                    return fresh[0]
+
+        try:
+            fresh = self._lookup(key)
+            if fresh and fresh[1]:
+                self._count("hits")
+                return fresh[0]
+            self._count("misses")
+            return self._load(key, loader, ttl_seconds, scope)
+        finally:
+            self._release(key)
+
+    def status(self):
+        """Сводка для /cache/status (статистика - по текущему воркеру)"""
+        now = time.time()
+        rows = self._connection().execute("SELECT key, expires_at, size FROM cache_entry ORDER BY last_access").fetchall()
+        with self._stats_lock:
+            stats = dict(self.stats)
+        loads = stats["loads"]
+        stats["avg_load_time"] = stats["load_time_total"] / loads if loads else 0
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "worker_pid": os.getpid(),
+            "cache_size": len(rows),
+            "cache_bytes": sum(size for _, _, size in rows),
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "cached_keys": [key for key, _, _ in rows],
+            "cache_ttl": {key: expires_at - now for key, expires_at, _ in rows},
+            "stats": stats,
+        }
+
+def create_cache(backend):
+    """Создает кэш по имени бэкенда: sqlite (общий для воркеров) или memory (в процессе)"""
+    if backend == "memory":
+        return LRUCache()
+    return SQLiteCacheBackend(os.path.join(app.instance_path, "cache.db"))
+
+# Глобальный кэш. По умолчанию общий SQLite-файл, чтобы все воркеры gunicorn
+# видели одни значения и одну очистку; CACHE_BACKEND=memory - кэш внутри процесса.
+app.config["CACHE_BACKEND"] = os.environ.get("CACHE_BACKEND", "sqlite")
+cache = create_cache(app.config["CACHE_BACKEND"])
+
+
+def get_cached_data(key, fetch_func, ttl_seconds=300, scope=None):
+    """Получает данные из кэша или выполняет функцию и кэширует результат.
+
+    scope (см. cache_scope) - от каких данных зависит значение; без него значение
+    живет до истечения TTL и не сбрасывается при изменениях.
+    """
+    return cache.get_or_load(key, fetch_func, ttl_seconds, scope)
+
+# === ИНВАЛИДАЦИЯ КЭША ПО КОММИТАМ ===
+# Изменения собираются из сессии при каждом flush и применяются к кэшу только
+# после успешного коммита: сбрасываются лишь значения, чья область (таблицы,
+# период, типы партий) затронута, поэтому кэш прошлых периодов переживает
+# добавление сегодняшних записей.
+CACHE_CHANGES_KEY = "cache_changes"
+
+def _day(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.isoformat()
+
+def _history_values(obj, attribute):
+    """Текущее и прежнее (до изменения в этой транзакции) значения атрибута"""
+    history = inspect(obj).attrs[attribute].history
+    values = list(history.added) + list(history.deleted) + list(history.unchanged)
+    return values or [getattr(obj, attribute)]
+
+def _track_old_value(target, value, oldvalue, initiator):
+    return value
+
+# active_history: при присваивании SQLAlchemy загружает прежнее значение, даже если
+# атрибут истек после коммита, - иначе перенос записи на другую дату не сбросит старую
+for attribute in (Entry.date, Batch.start_time, Batch.batch_type):
+    event.listen(attribute, "set", _track_old_value, retval=True, active_history=True)
+
+def describe_change(db_session, obj):
+    """Изменение объекта в виде [(таблица, дата ISO или None, тип партии или None)]"""
+    table = obj.__table__.name
+    if isinstance(obj, Entry):
+        return [(table, _day(day), "casting") for day in _history_values(obj, "date")]
+    if isinstance(obj, Batch):
+        return [
+            (table, _day(start), batch_type)
+            for start in _history_values(obj, "start_time")
+            for batch_type in _history_values(obj, "batch_type")
+        ]
+    if isinstance(obj, BatchMaterial):
+        with db_session.no_autoflush:
+            batch = obj.batch if obj.batch is not None else db_session.get(Batch, obj.batch_id)
+        if batch is None:
+            return [(table, None, None)]
+        return [(table, _day(batch.start_time), batch.batch_type)]
+    return [(table, None, None)]
+
+@event.listens_for(Session, "after_flush")
+def collect_cache_changes(db_session, flush_context):
+    changes = db_session.info.setdefault(CACHE_CHANGES_KEY, set())
+    for obj in list(db_session.new) + list(db_session.dirty) + list(db_session.deleted):
+        if hasattr(obj, "__table__"):
+            changes.update(describe_change(db_session, obj))
+
+@event.listens_for(Session, "after_commit")
+def apply_cache_changes(db_session):
+    changes = db_session.info.pop(CACHE_CHANGES_KEY, None)
+    if changes:
+        cache.invalidate(sorted(changes, key=repr))
+        if any(table in ReferenceData.TABLES for table, _, _ in changes):
+            reference_data.invalidate()
+
+@event.listens_for(Session, "after_rollback")
+def discard_cache_changes(db_session):
+    db_session.info.pop(CACHE_CHANGES_KEY, None)
+
+# === ЖУРНАЛ РАСХОДА МАТЕРИАЛОВ ===
+# Строки material_ledger измененных записей заливки и партий пересобираются
+# в той же транзакции, что и сами записи, вместе с суточными итогами
+# daily_material_rollup (см. material_ledger.py). Так итоги верны при любой
+# записи через ORM - из маршрутов, скриптов заполнения или удалении партий.
+
+@event.listens_for(Session, "after_flush")
+def sync_material_ledger(db_session, flush_context):
+    entry_ids, batch_ids = set(), set()
+    for obj in list(db_session.new) + list(db_session.dirty) + list(db_session.deleted):
+        if obj in db_session.dirty and not db_session.is_modified(obj):
+            continue
+        if isinstance(obj, Entry):
+            entry_ids.add(obj.id)
+        elif isinstance(obj, Batch):
+            batch_ids.add(obj.id)
+        elif isinstance(obj, BatchMaterial):
+            batch_ids.add(obj.batch_id)
+    if entry_ids or batch_ids:
+        connection = db_session.connection()
+        sync_entries(connection, entry_ids)
+        sync_batches(connection, batch_ids - {None})
+
+# === ВЕРСИИ ДАННЫХ И УСЛОВНЫЕ ЗАПРОСЫ (ETag / 304) ===
+# Каждая запись в таблицу увеличивает ее счетчик в data_version в той же
+# транзакции. Тяжелые страницы строят ETag из счетчиков своих таблиц и, если
+# клиент прислал тот же ETag, отвечают 304 без запросов к данным и рендеринга.
+
+@event.listens_for(Session, "after_flush")
+def bump_data_versions(db_session, flush_context):
+    tables = {
+        obj.__table__.name
+        for obj in list(db_session.new) + list(db_session.dirty) + list(db_session.deleted)
+        if hasattr(obj, "__table__") and (obj not in db_session.dirty or db_session.is_modified(obj))
+    }
+    tables.discard(DataVersion.__tablename__)
+    if not tables:
+        return
+
+    now = datetime.now()
+    statement = insert(DataVersion).values([
+        {"table_name": table, "version": 1, "updated_at": now} for table in sorted(tables)
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=["table_name"],
+        set_={"version": DataVersion.version + 1, "updated_at": statement.excluded.updated_at}
+    )
+    db_session.connection().execute(statement)
+
+def get_data_versions(tables):
+    """Текущие версии таблиц и время последнего изменения среди них"""
+    rows = db.session.execute(
+        db.select(DataVersion.table_name, DataVersion.version, DataVersion.updated_at)
+        .where(DataVersion.table_name.in_(tables))
+    ).all()
+    versions = {table: 0 for table in tables}
+    last_modified = None
+    for table_name, version, updated_at in rows:
+        versions[table_name] = version
+        if last_modified is None or updated_at > last_modified:
+            last_modified = updated_at
+    return versions, last_modified
+
+def request_data_versions(tables):
+    """Версии таблиц: уже прочитанные conditional_on_data в начале запроса или отдельным запросом"""
+    known = g.get("data_versions") if has_app_context() else None
+    if known is not None and all(table in known for table in tables):
+        return {table: known[table] for table in tables}
+    return get_data_versions(tables)[0]
+
+def conditional_on_data(*tables):
+    """Декоратор GET-маршрута: ETag/Last-Modified по версиям таблиц и ответ 304.
+
+    В ETag входят версии таблиц, адрес с параметрами, пользователь с ролью и
+    текущая дата (периоды по умолчанию считаются от сегодняшнего дня), поэтому
+    проверки доступа внутри маршрута не нужно повторять для 304. По той же
+    причине Last-Modified не бывает раньше начала текущего дня.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            versions, last_modified = get_data_versions(tables)
+            today = datetime.now().date()
+            fingerprint = json.dumps([
+                request.full_path,
+                session.get("user_id"),
+                session.get("role"),
+                today.isoformat(),
+                versions,
+            ], sort_keys=True)
+            etag = hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()
+            # Смена дня меняет страницу (как и ETag), поэтому начало сегодняшнего дня -
+            # нижняя граница Last-Modified: вчерашний If-Modified-Since не даст 304
+            day_start = datetime.combine(today, datetime.min.time())
+            last_modified = max(last_modified, day_start) if last_modified else day_start
+            # В базе локальное время без зоны, в заголовке - UTC с точностью до секунды
+            last_modified = last_modified.astimezone(timezone.utc).replace(microsecond=0)
+
+            not_modified = "user_id" in session and (
+                etag in request.if_none_match
+                if request.if_none_match
+                else request.if_modified_since is not None and last_modified <= request.if_modified_since
+            )
+            if not_modified:
+                response = make_response("", 304)
+            else:
+                # Версии доступны маршруту (request_data_versions) только на время его вызова
+                g.data_versions = versions
+                try:
+                    response = make_response(view(*args, **kwargs))
+                finally:
+                    g.pop("data_versions", None)
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # Браузер хранит копию, но перед показом всегда переспрашивает сервер
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add("Cookie")
+            return response
+        return wrapper
+    return decorator
+
+# === СПРАВОЧНИКИ (КЭШ В ПРОЦЕССЕ) ===
+class ReferenceData:
+    """Продукты, оборудование и материалы, загруженные один раз на воркер.
+
+    Снимок помечен версиями таблиц из data_version: версии читаются один раз
+    за запрос, и если другой воркер изменил справочник, снимок перечитывается.
+    Свои коммиты сбрасывают снимок сразу (apply_cache_changes). Объекты
+    отсоединены от сессии - у них можно читать колонки, но не связи.
+    """
+    TABLES = ("product", "equipment", "material")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+        if has_app_context():
+            g.pop("reference_versions", None)
+
+    def _load(self, versions):
+        with Session(db.engine, expire_on_commit=False) as reference_session:
+            products = reference_session.scalars(db.select(Product).order_by(Product.id)).all()
+            equipment = reference_session.scalars(db.select(Equipment).order_by(Equipment.id)).all()
+            materials = reference_session.scalars(db.select(Material).order_by(Material.id)).all()
+        return {
+            "versions": versions,
+            "products": products,
+            "equipment": equipment,
+            "materials": materials,
+            "product_names": {product.id: product.name for product in products},
+            "product_codes": {product.id: product.product_code for product in products},
+            "equipment_names": {item.id: item.name for item in equipment},
+            "material_names": {material.id: material.name for material in materials},
+        }
+
+    def _current(self):
+        versions = g.get("reference_versions")
+        if versions is None:
+            versions, _ = get_data_versions(self.TABLES)
+            g.reference_versions = versions
+
+        snapshot = self._snapshot
+        if snapshot is None or snapshot["versions"] != versions:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None or snapshot["versions"] != versions:
+                    snapshot = self._snapshot = self._load(versions)
+        return snapshot
+
+    @property
+    def products(self):
+        return self._current()["products"]
+
+    @property
+    def active_products(self):
+        return [product for product in self.products if product.is_active]
+
+    @property
+    def equipment(self):
+        return self._current()["equipment"]
+
+    def operational_equipment(self, equipment_type=None):
+        """Исправное оборудование, при необходимости только указанного типа"""
+        return [
+            item for item in self.equipment
+            if item.status == "operational" and (equipment_type is None or item.equipment_type == equipment_type)
+        ]
+
+    @property
+    def materials(self):
+        return self._current()["materials"]
+
+    @property
+    def active_materials(self):
+        return [material for material in self.materials if material.is_active]
+
+    @property
+    def product_names(self):
+        return self._current()["product_names"]
+
+    @property
+    def product_codes(self):
+        return self._current()["product_codes"]
+
+    @property
+    def equipment_names(self):
+        return self._current()["equipment_names"]
+
+    @property
+    def material_names(self):
+        return self._current()["material_names"]
+
+reference_data = ReferenceData()
+app.jinja_env.globals["reference_data"] = reference_data
+
+# === ФИЛЬТРЫ ПО ДАТАМ ===
+def parse_date(value):
+    """Разбирает дату из параметра запроса (YYYY-MM-DD), при ошибке возвращает None"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+def parse_time(value):
+    """Время записи из формы (ЧЧ:ММ или ЧЧ:ММ:СС) в формате ЧЧ:ММ:СС, при ошибке - None"""
+    for fmt in ('%H:%M:%S', '%H:%M'):
+        try:
+            return datetime.strptime(value or '', fmt).strftime('%H:%M:%S')
+        except ValueError:
+            continue
+    return None
+
+def date_range_filter(column, date_from=None, date_to=None):
+    """Условия полуинтервала [date_from, date_to + 1 день) для колонки Date или DateTime.
+
+    Колонка не оборачивается в функции (date(), strftime()), поэтому SQLite
+    может использовать индекс по ней. Пустая граница не ограничивает диапазон.
+    """
+    conditions = []
+    is_datetime = isinstance(column.type, db.DateTime)
+
+    if date_from:
+        lower = datetime.combine(date_from, datetime.min.time()) if is_datetime else date_from
+        conditions.append(column >= lower)
+
+    if date_to:
+        upper = date_to + timedelta(days=1)
+        if is_datetime:
+            conditions.append(column < datetime.combine(upper, datetime.min.time()))
+        else:
+            conditions.append(column < upper)
+
+    return conditions
 
 @app.route("/")
 def index():
@@ -172,7 +1044,7 @@ def products_list():
     if session.get("role") != "admin":
         return redirect(url_for("login"))
     
-    products = Product.query.filter_by(is_active=True).all()
+    products = reference_data.active_products
     return render_template("products_list.html", products=products)
 
 @app.route("/add_product", methods=["GET", "POST"])
@@ -230,16 +1102,15 @@ def employee_dashboard():
         )
         db.session.add(entry)
         db.session.commit()
-        clear_analytics_cache()  # Очищаем кэш при добавлении новых данных
 
         return redirect(url_for("employee_dashboard"))
 
     # Получаем историю операций за сегодня
     today = datetime.now().date()
-    today_entries = Entry.query.filter_by(
-        user_id=session["user_id"], 
-        date=today
-    ).order_by(Entry.time.desc()).limit(10).all()
+    today_entries = Entry.query.filter(
+        Entry.user_id == session["user_id"],
+        *date_range_filter(Entry.recorded_at, today, today)
+    ).order_by(Entry.recorded_at.desc()).limit(10).all()
     
     return render_template("employee_dashboard.html", today_entries=today_entries)
 
@@ -250,32 +1121,29 @@ def cutting_dashboard():
         return redirect(url_for("login"))
     
     # Получаем активные партии резки этого пользователя
-    active_batches = Batch.query.filter_by(
+    active_batches = Batch.query.options(*BATCH_LIST_LOADERS).filter_by(
         user_id=session["user_id"],
         batch_type="cutting",
         status="active"
     ).all()
     
     # Получаем завершенные партии
-    completed_batches = Batch.query.filter_by(
+    completed_batches = Batch.query.options(*BATCH_LIST_LOADERS).filter_by(
         user_id=session["user_id"],
         batch_type="cutting",
         status="completed"
     ).order_by(Batch.end_time.desc()).limit(10).all()
     
     # Получаем доступное оборудование (резчики)
-    cutters = Equipment.query.filter_by(
-        equipment_type="cutting",
-        status="operational"
-    ).all()
+    cutters = reference_data.operational_equipment("cutting")
     
     # Получаем историю операций резки за сегодня
     today = datetime.now().date()
-    today_batches = Batch.query.filter_by(
+    today_batches = Batch.query.options(*BATCH_LIST_LOADERS).filter_by(
         user_id=session["user_id"],
         batch_type="cutting"
     ).filter(
-        db.func.date(Batch.start_time) == today
+        *date_range_filter(Batch.start_time, today, today)
     ).order_by(Batch.start_time.desc()).limit(10).all()
     
     return render_template("cutting_dashboard.html",
@@ -291,39 +1159,547 @@ def autoclave_dashboard():
         return redirect(url_for("login"))
     
     # Получаем активные циклы автоклавирования
-    active_batches = Batch.query.filter_by(
+    active_batches = Batch.query.options(*BATCH_LIST_LOADERS).filter_by(
         user_id=session["user_id"],
         batch_type="autoclave",
         status="active"
     ).all()
     
     # Получаем завершенные циклы
-    completed_batches = Batch.query.filter_by(
+    completed_batches = Batch.query.options(*BATCH_LIST_LOADERS).filter_by(
         user_id=session["user_id"],
         batch_type="autoclave",
         status="completed"
     ).order_by(Batch.end_time.desc()).limit(10).all()
     
     # Получаем доступное оборудование (автоклавы)
-    autoclaves = Equipment.query.filter_by(
-        equipment_type="autoclave",
-        status="operational"
-    ).all()
+    autoclaves = reference_data.operational_equipment("autoclave")
     
     return render_template("autoclave_dashboard.html",
                          active_batches=active_batches,
                          completed_batches=completed_batches,
                          autoclaves=autoclaves)
 
+# === АГРЕГАТЫ KPI ДЛЯ ДАШБОРДА ДИРЕКТОРА ===
+def day_columns(moment, by_day):
+    """Колонка дня для GROUP BY, если группы нужны по дням"""
+    return [db.func.date(moment)] if by_day else []
+
+def rows_by_day(rows, by_day, build):
+    """Группы списком или при by_day - словарем {дата: группы} (день - первая колонка строки)"""
+    if not by_day:
+        return [build(*row) for row in rows]
+    result = {}
+    for day, *row in rows:
+        result.setdefault(datetime.strptime(day, '%Y-%m-%d').date(), []).append(build(*row))
+    return result
+
+def aggregate_entry_groups(date_from=None, date_to=None, by_day=False):
+    """Группирует записи заливки по сменам одним запросом (by_day - еще и по дням)"""
+    query = db.session.query(
+        *day_columns(Entry.recorded_at, by_day),
+        Entry.shift,
+        db.func.count(Entry.id),
+        db.func.coalesce(db.func.sum(Entry.cement), 0),
+        db.func.coalesce(db.func.sum(Entry.lime), 0),
+        db.func.coalesce(db.func.sum(Entry.water), 0)
+    ).join(User, Entry.user_id == User.id)
+
+    if date_from and date_to:
+        query = query.filter(*date_range_filter(Entry.recorded_at, date_from, date_to))
+
+    return rows_by_day(
+        query.group_by(*day_columns(Entry.recorded_at, by_day), Entry.shift).all(),
+        by_day,
+        lambda shift, count, cement, lime, water: {
+            'shift': shift, 'count': count, 'cement': float(cement), 'lime': float(lime), 'water': float(water)
+        }
+    )
+
+def aggregate_batch_groups(date_from=None, date_to=None, by_day=False):
+    """Группирует партии по типу, статусу, смене и продукту одним запросом (by_day - еще и по дням)"""
+    tech_violation = db.case(
+        (db.or_(Batch.product_id.is_(None), Batch.equipment_id.is_(None)), 1),
+        else_=0
+    )
+    query = db.session.query(
+        *day_columns(Batch.start_time, by_day),
+        Batch.batch_type,
+        Batch.status,
+        Batch.shift,
+        Product.product_code,
+        Product.name,
+        tech_violation,
+        db.func.count(Batch.id),
+        db.func.coalesce(db.func.sum(BATCH_DURATION_MINUTES), 0),
+        db.func.count(BATCH_DURATION_MINUTES)
+    ).join(User, Batch.user_id == User.id).outerjoin(Product, Batch.product_id == Product.id)
+
+    if date_from and date_to:
+        query = query.filter(*date_range_filter(Batch.start_time, date_from, date_to))
+
+    query = query.group_by(
+        *day_columns(Batch.start_time, by_day),
+        Batch.batch_type, Batch.status, Batch.shift,
+        Product.id, Product.product_code, Product.name,
+        tech_violation
+    )
+
+    return rows_by_day(
+        query.all(),
+        by_day,
+        lambda batch_type, status, shift, product_code, product_name, violation, count, duration_sum, duration_count: {
+            'batch_type': batch_type,
+            'status': status,
+            'shift': shift,
+            'product_code': product_code,
+            'product_name': product_name,
+            'tech_violation': bool(violation),
+            'count': count,
+            'duration_sum': float(duration_sum),
+            'duration_count': duration_count
+        }
+    )
+
+def build_dashboard_kpis(entry_groups, batch_groups):
+    """Сводит сгруппированные строки в показатели дашборда директора"""
+    kpis = {
+        'total_entries': 0, 'total_cement': 0, 'total_lime': 0, 'total_water': 0,
+        'day_entries_casting': 0, 'night_entries_casting': 0,
+        'day_entries_cutting': 0, 'night_entries_cutting': 0,
+        'day_entries_autoclave': 0, 'night_entries_autoclave': 0,
+        'total_cutting_batches': 0, 'active_cutting': 0, 'completed_cutting': 0,
+        'total_autoclave_batches': 0, 'active_autoclave': 0, 'completed_autoclave': 0,
+        'total_casting_batches': 0,
+        'total_production': 0, 'downtime_batches': 0, 'active_time_batches': 0,
+        'defect_batches': 0, 'tech_violations': 0,
+        'products_stats': {}
+    }
+
+    # Записи заливки
+    for group in entry_groups:
+        kpis['total_entries'] += group['count']
+        kpis['total_cement'] += group['cement']
+        kpis['total_lime'] += group['lime']
+        kpis['total_water'] += group['water']
+        if group['shift'] in ("day", "night"):
+            kpis[f"{group['shift']}_entries_casting"] += group['count']
+
+    # Партии
+    batches_by_shift = {"day": 0, "night": 0}
+    durations = {"all": [0, 0], "cutting": [0, 0], "autoclave": [0, 0]}
+    completed_batches = 0
+
+    for group in batch_groups:
+        batch_type = group['batch_type']
+        status = group['status']
+        count = group['count']
+
+        kpis['total_production'] += count
+        if group['shift'] in batches_by_shift:
+            batches_by_shift[group['shift']] += count
+            if batch_type in ("cutting", "autoclave"):
+                kpis[f"{group['shift']}_entries_{batch_type}"] += count
+
+        if batch_type in ("cutting", "autoclave"):
+            kpis[f"total_{batch_type}_batches"] += count
+            if status in ["active", "inactive"]:
+                kpis[f"active_{batch_type}"] += count
+            elif status == "completed":
+                kpis[f"completed_{batch_type}"] += count
+            durations[batch_type][0] += group['duration_sum']
+            durations[batch_type][1] += group['duration_count']
+        elif batch_type == "casting":
+            kpis['total_casting_batches'] += count
+
+        durations["all"][0] += group['duration_sum']
+        durations["all"][1] += group['duration_count']
+
+        if status == 'inactive':
+            kpis['downtime_batches'] += count
+        elif status == 'active':
+            kpis['active_time_batches'] += count
+        elif status == 'cancelled':
+            kpis['defect_batches'] += count
+        elif status == 'completed':
+            completed_batches += count
+
+        if group['tech_violation']:
+            kpis['tech_violations'] += count
+
+        # Аналитика по продуктам
+        product_code = group['product_code']
+        if product_code:
+            stats = kpis['products_stats'].setdefault(product_code, {
+                'name': group['product_name'],
+                'total': 0,
+                'active': 0,
+                'completed': 0
+            })
+            stats['total'] += count
+            if status == 'active':
+                stats['active'] += count
+            elif status == 'completed':
+                stats['completed'] += count
+
+    # Общая статистика по сменам (Entry + Batch)
+    kpis['day_entries'] = kpis['day_entries_casting'] + batches_by_shift["day"]
+    kpis['night_entries'] = kpis['night_entries_casting'] + batches_by_shift["night"]
+
+    # Средние длительности (в минутах)
+    for key, (total, count) in durations.items():
+        avg_key = "avg_duration" if key == "all" else f"avg_{key}_duration"
+        kpis[avg_key] = total / count if count else 0
+
+    kpis['products_stats'] = dict(sorted(kpis['products_stats'].items()))
+
+    # Эффективность (отношение завершенных к общему количеству)
+    total_production = kpis['total_production']
+    kpis['efficiency'] = (completed_batches / total_production * 100) if total_production > 0 else 0
+
+    return kpis
+
+def aggregate_operator_stats(date_from=None, date_to=None, by_day=False):
+    """Активность операторов за период: три GROUP BY запроса по Entry, Batch и журналу расхода.
+
+    Возвращает {user_id: статистика}, операторы упорядочены по последней активности;
+    при by_day - {дата: {user_id: статистика}}.
+    """
+    entry_day = day_columns(Entry.recorded_at, by_day)
+    batch_day = day_columns(Batch.start_time, by_day)
+    ledger_day = day_columns(MaterialLedger.recorded_at, by_day)
+    entry_query = db.session.query(
+        *entry_day,
+        User.id, User.fio, User.role,
+        Entry.shift,
+        db.func.count(Entry.id),
+        db.func.max(Entry.recorded_at)
+    ).join(User, Entry.user_id == User.id)
+    batch_query = db.session.query(
+        *batch_day,
+        User.id, User.fio, User.role,
+        Batch.batch_type,
+        Batch.shift,
+        db.func.count(Batch.id),
+        db.func.max(Batch.start_time)
+    ).join(User, Batch.user_id == User.id)
+    material_query = db.session.query(
+        *ledger_day,
+        MaterialLedger.user_id,
+        Material.unit,
+        db.func.coalesce(db.func.sum(MaterialLedger.quantity), 0)
+    ).join(Material, MaterialLedger.material_id == Material.id)
+
+    if date_from and date_to:
+        entry_query = entry_query.filter(*date_range_filter(Entry.recorded_at, date_from, date_to))
+        batch_query = batch_query.filter(*date_range_filter(Batch.start_time, date_from, date_to))
+        material_query = material_query.filter(*date_range_filter(MaterialLedger.recorded_at, date_from, date_to))
+
+    stats = {}  # (день или None, user_id) -> статистика
+
+    def split(row):
+        return (row[0], row[1:]) if by_day else (None, row)
+
+    def operator(day, user_id, fio, role):
+        return stats.setdefault((day, user_id), {
+            'name': fio,
+            'role': role,
+            'entries_count': 0,
+            'batches_count': 0,
+            'batches_by_type': {},
+            'shifts': {},
+            'materials': {},
+            'last_activity': None
+        })
+
+    def touch(item, moment):
+        if item['last_activity'] is None or moment > item['last_activity']:
+            item['last_activity'] = moment
+
+    for day, (user_id, fio, role, shift, count, last) in map(split, entry_query.group_by(*entry_day, User.id, User.fio, User.role, Entry.shift).all()):
+        item = operator(day, user_id, fio, role)
+        item['entries_count'] += count
+        item['shifts'][shift] = item['shifts'].get(shift, 0) + count
+        touch(item, last)
+
+    for day, (user_id, fio, role, batch_type, shift, count, last) in map(split, batch_query.group_by(*batch_day, User.id, User.fio, User.role, Batch.batch_type, Batch.shift).all()):
+        item = operator(day, user_id, fio, role)
+        item['batches_count'] += count
+        item['batches_by_type'][batch_type] = item['batches_by_type'].get(batch_type, 0) + count
+        item['shifts'][shift] = item['shifts'].get(shift, 0) + count
+        touch(item, last)
+
+    for day, (user_id, unit, quantity) in map(split, material_query.group_by(*ledger_day, MaterialLedger.user_id, Material.unit).all()):
+        item = stats.get((day, user_id))
+        if item and quantity:
+            item['materials'][unit] = item['materials'].get(unit, 0) + float(quantity)
+
+    by_activity = sorted(stats.items(), key=lambda pair: pair[1]['last_activity'], reverse=True)
+    if not by_day:
+        return {user_id: item for (_, user_id), item in by_activity}
+    result = {}
+    for (day, user_id), item in by_activity:
+        result.setdefault(datetime.strptime(day, '%Y-%m-%d').date(), {})[user_id] = item
+    return result
+
+def get_operator_stats(date_from=None, date_to=None):
+    """Активность операторов с кэшем по периоду"""
+    def load():
+        if date_from and date_to:
+            return period_kpi_groups(date_from, date_to)["operators"]
+        return aggregate_operator_stats(date_from, date_to)
+
+    return get_cached_data(
+        f"operator_stats:{date_from}:{date_to}",
+        load,
+        ttl_seconds=600,
+        scope=cache_scope(["entry", "batch", "batch_material", "material", "user"], date_from, date_to)
+    )
+
+# === СНИМКИ KPI ЗАКРЫТЫХ ДНЕЙ ===
+# Группы KPI аддитивны (счетчики и суммы), поэтому KPI любого периода - это
+# сумма групп по дням. Для закрытых дней (до сегодняшнего) группы один раз
+# считаются и замораживаются в kpi_snapshot, живой расчет нужен только для
+# текущего дня. Любая запись, затрагивающая закрытый день (edit_entry,
+# edit_batch, партия задним числом), удаляет его снимок в той же транзакции.
+
+SNAPSHOT_DAY_TABLES = ("entry", "batch", "batch_material")
+SNAPSHOT_GLOBAL_TABLES = ("product", "user", "material")  # названия и единицы внутри снимков
+
+# Часть групп KPI -> функция расчета (date_from, date_to, by_day) и пустое значение
+KPI_GROUP_PARTS = {
+    "entry_groups": (aggregate_entry_groups, list),
+    "batch_groups": (aggregate_batch_groups, list),
+    "operators": (aggregate_operator_stats, dict),
+}
+
+def dump_kpi_groups(groups):
+    operators = {
+        str(user_id): dict(stats, last_activity=stats["last_activity"].isoformat())
+        for user_id, stats in groups["operators"].items()
+    }
+    return json.dumps(dict(groups, operators=operators), ensure_ascii=False)
+
+def load_kpi_groups(payload):
+    groups = json.loads(payload)
+    groups["operators"] = {
+        int(user_id): dict(stats, last_activity=datetime.fromisoformat(stats["last_activity"]))
+        for user_id, stats in groups["operators"].items()
+    }
+    return groups
+
+def merge_kpi_groups(parts):
+    """Складывает группы нескольких периодов (строки групп просто объединяются)"""
+    merged = {"entry_groups": [], "batch_groups": [], "operators": {}}
+    for part in parts:
+        merged["entry_groups"].extend(part["entry_groups"])
+        merged["batch_groups"].extend(part["batch_groups"])
+        for user_id, stats in part["operators"].items():
+            total = merged["operators"].get(user_id)
+            if total is None:
+                merged["operators"][user_id] = {
+                    **stats, **{key: dict(stats[key]) for key in ("batches_by_type", "shifts", "materials")}
+                }
+                continue
+            total["entries_count"] += stats["entries_count"]
+            total["batches_count"] += stats["batches_count"]
+            for key in ("batches_by_type", "shifts", "materials"):
+                for name, value in stats[key].items():
+                    total[key][name] = total[key].get(name, 0) + value
+            total["last_activity"] = max(total["last_activity"], stats["last_activity"])
+    merged["operators"] = dict(sorted(merged["operators"].items(), key=lambda pair: pair[1]["last_activity"], reverse=True))
+    return merged
+
+SNAPSHOT_INSERT_CHUNK = 500
+KPI_GROUPS_KEY = "kpi_groups"
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def forget_kpi_groups(db_session):
+    db_session.info.pop(KPI_GROUPS_KEY, None)
+
+def first_data_day():
+    """Первый день с записями заливки или партиями (None - данных еще нет)"""
+    moments = db.session.query(
+        db.select(db.func.min(Entry.recorded_at)).scalar_subquery(),
+        db.select(db.func.min(Batch.start_time)).scalar_subquery()
+    ).one()
+    moments = [moment for moment in moments if moment]
+    return min(moments).date() if moments else None
+
+def store_kpi_snapshots(rows, versions):
+    """Пишет снимки частями по SNAPSHOT_INSERT_CHUNK в отдельной транзакции.
+
+    versions - версии таблиц снимка (get_data_versions), прочитанные до расчета
+    групп. Если с тех пор кто-то записал в эти таблицы, его правка могла не
+    найти снимка для удаления - тогда снимки не пишутся, иначе устаревшие
+    группы заморозились бы навсегда. Сессия запроса не коммитится: чтение не
+    должно фиксировать чужие изменения в ней. Параллельный запрос мог уже
+    заморозить те же дни. Возвращает True, если снимки записаны.
+    """
+    # Незакоммиченные изменения сессии видны ее чтениям - такие группы не замораживаются
+    # (к тому же отдельная транзакция ждала бы блокировку записи этой сессии)
+    if db.session.info.get(CACHE_CHANGES_KEY) or db.session.new or db.session.dirty or db.session.deleted:
+        return False
+    with db.engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            for start in range(0, len(rows), SNAPSHOT_INSERT_CHUNK):
+                connection.execute(
+                    insert(KpiSnapshot).values(rows[start:start + SNAPSHOT_INSERT_CHUNK]).on_conflict_do_nothing(index_elements=["date"])
+                )
+            # Вставка уже держит блокировку записи: до коммита версии не изменятся
+            current = dict(connection.execute(
+                db.select(DataVersion.table_name, DataVersion.version).where(DataVersion.table_name.in_(versions))
+            ).all())
+            if any(current.get(table, 0) != version for table, version in versions.items()):
+                transaction.rollback()
+                return False
+            transaction.commit()
+            return True
+        except Exception:
+            transaction.rollback()
+            raise
+
+def period_kpi_groups(date_from, date_to):
+    """Группы KPI за период: снимки закрытых дней и живой расчет с сегодняшнего дня.
+
+    Результат запоминается в сессии до ее коммита или отката - в одном запросе
+    его используют и KPI, и активность операторов.
+    """
+    memo = db.session.info.setdefault(KPI_GROUPS_KEY, {})
+    if (date_from, date_to) in memo:
+        return memo[(date_from, date_to)]
+
+    today = datetime.now().date()
+    parts = []
+    live_from = max(date_from, today)
+    closed_to = min(date_to, today - timedelta(days=1))
+    # До первого дня с данными группы пустые - их не считаем и не замораживаем
+    closed_from = max(date_from, first_data_day() or today) if date_from <= closed_to else today
+    if closed_from <= closed_to:
+        payloads = dict(db.session.query(KpiSnapshot.date, KpiSnapshot.payload).filter(
+            KpiSnapshot.date >= closed_from, KpiSnapshot.date <= closed_to
+        ).all())
+        days = [closed_from + timedelta(days=offset) for offset in range((closed_to - closed_from).days + 1)]
+        missing = [day for day in days if day not in payloads]
+
+        # Недостающие дни считаются разом (по запросу на часть, с группировкой по дням)
+        # вместе с открытыми днями периода, и закрытые из них замораживаются
+        if missing:
+            # Версии читаются до расчета: по ним store_kpi_snapshots узнает о параллельных правках
+            versions = request_data_versions(SNAPSHOT_DAY_TABLES + SNAPSHOT_GLOBAL_TABLES)
+            built = {
+                name: aggregate(missing[0], date_to, by_day=True)
+                for name, (aggregate, _) in KPI_GROUP_PARTS.items()
+            }
+            now = datetime.now()
+            rows = []
+            for day in missing:
+                groups = {name: built[name].get(day, empty()) for name, (_, empty) in KPI_GROUP_PARTS.items()}
+                payloads[day] = dump_kpi_groups(groups)
+                rows.append({"date": day, "payload": payloads[day], "created_at": now})
+            store_kpi_snapshots(rows, versions)
+
+            live_days = sorted({day for groups in built.values() for day in groups if day >= live_from})
+            parts.extend(
+                {name: built[name].get(day, empty()) for name, (_, empty) in KPI_GROUP_PARTS.items()}
+                for day in live_days
+            )
+            live_from = None  # открытые дни уже посчитаны
+
+        parts.extend(load_kpi_groups(payloads[day]) for day in days)
+
+    if live_from and date_to >= live_from:
+        parts.append({name: aggregate(live_from, date_to) for name, (aggregate, _) in KPI_GROUP_PARTS.items()})
+
+    memo[(date_from, date_to)] = merge_kpi_groups(parts)
+    return memo[(date_from, date_to)]
+
+def load_dashboard_groups(date_from=None, date_to=None):
+    """Группы заливки и партий для KPI: по снимкам, если период задан"""
+    if date_from and date_to:
+        groups = period_kpi_groups(date_from, date_to)
+        return groups["entry_groups"], groups["batch_groups"]
+    return aggregate_entry_groups(), aggregate_batch_groups()
+
+@event.listens_for(Session, "after_flush")
+def drop_stale_kpi_snapshots(db_session, flush_context):
+    days, drop_all = set(), False
+    for obj in list(db_session.new) + list(db_session.dirty) + list(db_session.deleted):
+        if obj in db_session.dirty and not db_session.is_modified(obj):
+            continue
+        for table, day, _ in describe_change(db_session, obj) if hasattr(obj, "__table__") else []:
+            if table in SNAPSHOT_GLOBAL_TABLES or (table in SNAPSHOT_DAY_TABLES and day is None):
+                drop_all = True
+            elif table in SNAPSHOT_DAY_TABLES:
+                days.add(datetime.strptime(day, "%Y-%m-%d").date())
+    if drop_all:
+        db_session.connection().execute(db.delete(KpiSnapshot))
+    elif days:
+        db_session.connection().execute(db.delete(KpiSnapshot).where(KpiSnapshot.date.in_(sorted(days))))
+
+MATERIAL_MATRIX_PAGE_SIZE = 10
+
+def material_matrix_page(material_columns, date_from=None, date_to=None, page=1, per_page=MATERIAL_MATRIX_PAGE_SIZE):
+    """Страница сводной таблицы материалов: (строки, есть ли следующая страница).
+
+    Один запрос к журналу расхода: GROUP BY по записи заливки или партии и
+    SUM(CASE ...) по каждому материалу разворачивают строки журнала в колонки.
+    """
+    if not material_columns:
+        return [], False
+    pivot = [
+        db.func.sum(db.case((MaterialLedger.material_id == material.id, MaterialLedger.quantity), else_=0))
+        for material in material_columns
+    ]
+    recorded_at = db.func.max(MaterialLedger.recorded_at)
+    query = db.session.query(
+        MaterialLedger.source,
+        MaterialLedger.entry_id,
+        MaterialLedger.batch_id,
+        recorded_at,
+        db.func.max(MaterialLedger.shift),
+        db.func.max(MaterialLedger.batch_type),
+        db.func.max(User.fio),
+        db.func.max(Batch.batch_number),
+        *pivot
+    ).join(
+        User, MaterialLedger.user_id == User.id
+    ).outerjoin(
+        Batch, MaterialLedger.batch_id == Batch.id
+    )
+    if date_from and date_to:
+        query = query.filter(*date_range_filter(MaterialLedger.recorded_at, date_from, date_to))
+    query = query.group_by(
+        MaterialLedger.source, MaterialLedger.entry_id, MaterialLedger.batch_id
+    ).order_by(
+        recorded_at.desc(), MaterialLedger.source.desc(), MaterialLedger.entry_id.desc(), MaterialLedger.batch_id.desc()
+    ).offset((page - 1) * per_page).limit(per_page + 1)
+
+    rows = [
+        {
+            'type': source,
+            'id': entry_id if source == 'entry' else batch_id,
+            'datetime': moment,
+            'operator': fio,
+            'shift': shift,
+            'batch_type': batch_type,
+            'batch_number': batch_number,
+            'quantities': [float(quantity or 0) for quantity in quantities]
+        }
+        for source, entry_id, batch_id, moment, shift, batch_type, fio, batch_number, *quantities in query
+    ]
+    return rows[:per_page], len(rows) > per_page
+
 @app.route("/director_dashboard")
+@conditional_on_data("entry", "batch", "batch_material", "material", "product", "equipment", "user")
 def director_dashboard():
     allowed_roles = ["director", "chief_technologist"]
     if session.get("role") not in allowed_roles:
         return redirect(url_for("login"))
 
     # Получаем параметры фильтрации
-    from datetime import datetime, timedelta
-    
     date_from = request.args.get('date_from')
     date_to = request.args.get('date_to')
     batch_type_filter = request.args.get('batch_type', 'all')
@@ -337,121 +1713,28 @@ def director_dashboard():
     if not date_to:
         date_to = datetime.now().strftime('%Y-%m-%d')
 
-    # Получаем все записи с данными пользователей (с фильтром по датам)
-    entries_query = db.session.query(Entry, User).join(User, Entry.user_id == User.id)
-    
-    # Применяем фильтр по датам для Entry
-    try:
-        date_from_obj = datetime.strptime(date_from, '%Y-%m-%d').date()
-        date_to_obj = datetime.strptime(date_to, '%Y-%m-%d').date()
-        entries_query = entries_query.filter(Entry.date >= date_from_obj, Entry.date <= date_to_obj)
-    except ValueError:
-        pass  # Если дата некорректна, игнорируем фильтр
-    
-    entries = entries_query.all()
-    
+    date_from_obj = parse_date(date_from)
+    date_to_obj = parse_date(date_to)
+    if not date_from_obj or not date_to_obj:
+        date_from_obj = date_to_obj = None  # Если дата некорректна, игнорируем фильтр
+
+    # === KPI: ДВА GROUP BY ЗАПРОСА ВМЕСТО ПОЛНОЙ ЗАГРУЗКИ ПАРТИЙ ===
+    # Кэшируются по периоду: новая запись сбрасывает только периоды, в которые она попадает
+    kpis = get_cached_data(
+        f"dashboard_kpis:{date_from_obj}:{date_to_obj}",
+        lambda: build_dashboard_kpis(*load_dashboard_groups(date_from_obj, date_to_obj)),
+        ttl_seconds=600,
+        scope=cache_scope(["entry", "batch", "product", "user"], date_from_obj, date_to_obj)
+    )
+
     # Базовый запрос для партий с фильтром по датам
     batches_query = db.session.query(Batch, User).join(User, Batch.user_id == User.id)
+    if date_from_obj and date_to_obj:
+        batches_query = batches_query.filter(*date_range_filter(Batch.start_time, date_from_obj, date_to_obj))
     
-    # Применяем фильтр по датам для Batch
-    try:
-        batches_query = batches_query.filter(
-            Batch.start_time >= datetime.strptime(date_from, '%Y-%m-%d'),
-            Batch.start_time <= datetime.strptime(date_to + ' 23:59:59', '%Y-%m-%d %H:%M:%S')
-        )
-    except ValueError:
-        pass
-    
-    # Статистика по сменам (Entry записи - заливка)
-    day_entries = [e for e, u in entries if e.shift == "day"]
-    night_entries = [e for e, u in entries if e.shift == "night"]
-    
-    # Статистика по сменам для Batch записей (резка и автоклав)
-    all_batches_for_shifts = batches_query.all()
-    day_batches = [b for b, u in all_batches_for_shifts if b.shift == "day"]
-    night_batches = [b for b, u in all_batches_for_shifts if b.shift == "night"]
-    
-    # Общая статистика по сменам (Entry + Batch)
-    total_day_operations = len(day_entries) + len(day_batches)
-    total_night_operations = len(night_entries) + len(night_batches)
-    
-    # Общая статистика по материалам
-    total_entries = len(entries)
-    total_cement = sum(e.cement for e, u in entries)
-    total_lime = sum(e.lime for e, u in entries)
-    total_water = sum(e.water for e, u in entries)
-    
-    # Применяем фильтр по типу партии
-    if batch_type_filter != 'all':
-        batches_query_filtered = batches_query.filter(Batch.batch_type == batch_type_filter)
-    else:
-        batches_query_filtered = batches_query
-    
-    # Применяем фильтр по статусу
-    if status_filter != 'all':
-        batches_query_filtered = batches_query_filtered.filter(Batch.status == status_filter)
-    
-    # Применяем фильтр по продукту
-    if product_filter != 'all':
-        batches_query_filtered = batches_query_filtered.filter(Batch.product_id == product_filter)
-    
-    # Применяем фильтр по оборудованию
-    if equipment_filter != 'all':
-        batches_query_filtered = batches_query_filtered.filter(Batch.equipment_id == equipment_filter)
-    
-    # Аналитика по партиям резки
-    cutting_batches_query = batches_query.filter(Batch.batch_type == "cutting")
-    cutting_batches = cutting_batches_query.order_by(Batch.start_time.desc()).all()
-    total_cutting_batches = len(cutting_batches)
-    active_cutting = len([b for b, u in cutting_batches if b.status in ["active", "inactive"]])
-    completed_cutting = len([b for b, u in cutting_batches if b.status == "completed"])
-    
-    # Средняя длительность резки (в минутах)
-    cutting_durations = []
-    for batch, user in cutting_batches:
-        if batch.end_time and batch.start_time:
-            duration = (batch.end_time - batch.start_time).total_seconds() / 60
-            cutting_durations.append(duration)
-    avg_cutting_duration = sum(cutting_durations) / len(cutting_durations) if cutting_durations else 0
-    
-    # Аналитика по циклам автоклавирования
-    autoclave_batches_query = batches_query.filter(Batch.batch_type == "autoclave")
-    autoclave_batches = autoclave_batches_query.order_by(Batch.start_time.desc()).all()
-    total_autoclave_batches = len(autoclave_batches)
-    active_autoclave = len([b for b, u in autoclave_batches if b.status in ["active", "inactive"]])
-    completed_autoclave = len([b for b, u in autoclave_batches if b.status == "completed"])
-    
-    # Средняя длительность автоклавирования (в минутах)
-    autoclave_durations = []
-    for batch, user in autoclave_batches:
-        if batch.end_time and batch.start_time:
-            duration = (batch.end_time - batch.start_time).total_seconds() / 60
-            autoclave_durations.append(duration)
-    avg_autoclave_duration = sum(autoclave_durations) / len(autoclave_durations) if autoclave_durations else 0
-    
-    # Аналитика по заливке
-    casting_batches_query = batches_query.filter(Batch.batch_type == "casting")
-    casting_batches = casting_batches_query.all()
-    total_casting_batches = len(casting_batches)
-    
-    # Аналитика по продуктам
-    products_stats = {}
-    all_batches = batches_query.all()
-    for batch, user in all_batches:
-        if batch.product:
-            product_code = batch.product.product_code
-            if product_code not in products_stats:
-                products_stats[product_code] = {
-                    'name': batch.product.name,
-                    'total': 0,
-                    'active': 0,
-                    'completed': 0
-                }
-            products_stats[product_code]['total'] += 1
-            if batch.status == 'active':
-                products_stats[product_code]['active'] += 1
-            elif batch.status == 'completed':
-                products_stats[product_code]['completed'] += 1
+    # Последние партии резки и автоклавирования (в шаблоне нужны только последние 10)
+    cutting_batches = batches_query.options(*BATCH_LIST_LOADERS).filter(Batch.batch_type == "cutting").order_by(Batch.start_time.desc()).limit(10).all()
+    autoclave_batches = batches_query.options(*BATCH_LIST_LOADERS).filter(Batch.batch_type == "autoclave").order_by(Batch.start_time.desc()).limit(10).all()
     
     # === ОБЩАЯ АНАЛИТИКА: РАСХОД СЫРЬЯ (СТАТИЧНАЯ) ===
     
@@ -459,7 +1742,8 @@ def director_dashboard():
     material_data = get_cached_data(
         "material_consumption", 
         get_material_consumption_data, 
-        ttl_seconds=600  # 10 минут
+        ttl_seconds=600,  # 10 минут
+        scope=cache_scope(["entry", "batch", "batch_material", "material"])
     )
     
     materials_by_batch_type = material_data["materials_by_batch_type"]
@@ -467,241 +1751,241 @@ def director_dashboard():
     
     # === ЛЕНТА ОПЕРАЦИЙ ЗА ПЕРИОД ===
     
-    # Получаем все Entry записи за период
-    entries_timeline = []
-    if date_from and date_to:
-        try:
-            from_date = datetime.strptime(date_from, '%Y-%m-%d')
-            to_date = datetime.strptime(date_to, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
-            
-            # Entry записи (ввод данных по заливке)
-            entry_records = db.session.query(Entry, User).join(
-                User, Entry.user_id == User.id
-            ).filter(
-                Entry.date >= from_date.date(),
-                Entry.date <= to_date.date()
-            ).order_by(Entry.date.desc(), Entry.time.desc()).all()
-            
-            for entry, user in entry_records:
-                entries_timeline.append({
-                    'type': 'entry',
-                    'datetime': datetime.combine(entry.date, datetime.strptime(entry.time, '%H:%M:%S').time()),
-                    'user': user,
-                    'data': entry,
-                    'description': f"Ввод данных заливки - {entry.shift} смена"
-                })
-            
-            # Batch записи (создание партий)
-            batch_records = db.session.query(Batch, User).join(
-                User, Batch.user_id == User.id
-            ).filter(
-                Batch.start_time >= from_date,
-                Batch.start_time <= to_date
-            ).order_by(Batch.start_time.desc()).all()
-            
-            for batch, user in batch_records:
-                status_text = ""
-                if batch.status == 'cancelled':
-                    status_text = " (ОТМЕНЕНА)"
-                elif batch.status == 'completed':
-                    status_text = " (ЗАВЕРШЕНА)"
-                elif batch.status == 'inactive':
-                    status_text = " (ПРИОСТАНОВЛЕНА)"
-                
-                entries_timeline.append({
-                    'type': 'batch',
-                    'datetime': batch.start_time,
-                    'user': user,
-                    'data': batch,
-                    'description': f"Создание партии {batch.batch_type} - {batch.batch_number}{status_text}"
-                })
-            
-        except ValueError:
-            pass
-    
-    # Сортируем по времени (новые сначала)
-    entries_timeline.sort(key=lambda x: x['datetime'], reverse=True)
-    
-    # Статистика активности операторов
-    operator_stats = {}
-    for item in entries_timeline:
-        user_id = item['user'].id
-        user_name = item['user'].fio
-        if user_id not in operator_stats:
-            operator_stats[user_id] = {
-                'name': user_name,
-                'role': item['user'].role,
-                'entries_count': 0,
-                'batches_count': 0,
-                'last_activity': item['datetime']
-            }
-        
-        if item['type'] == 'entry':
-            operator_stats[user_id]['entries_count'] += 1
-        elif item['type'] == 'batch':
-            operator_stats[user_id]['batches_count'] += 1
-        
-        # Обновляем последнюю активность
-        if item['datetime'] > operator_stats[user_id]['last_activity']:
-            operator_stats[user_id]['last_activity'] = item['datetime']
-    
-    # === ПРОИЗВОДСТВЕННЫЕ МЕТРИКИ ===
+    # Только первая страница; следующие подгружаются через /timeline по курсору
+    entries_timeline, timeline_cursor = [], None
+    if date_from_obj and date_to_obj:
+        period = lambda column: date_range_filter(column, date_from_obj, date_to_obj)
+        entries_timeline, timeline_cursor = timeline_page(period)
     
-    # 1. Общая выработка (количество партий)
-    total_production = len(all_batches)
-    
-    # 2. Простой (неактивные партии)
-    downtime_batches = len([b for b, u in all_batches if b.status == 'inactive'])
-    
-    # 3. Время работы (активные партии)
-    active_time_batches = len([b for b, u in all_batches if b.status == 'active'])
-    
-    # 4. Количество брака (отмененные партии)
-    defect_batches = len([b for b, u in all_batches if b.status == 'cancelled'])
-    
-    # 5. Нарушения технологий (партии без продукта или оборудования)
-    tech_violations = len([b for b, u in all_batches if not b.product_id or not b.equipment_id])
-    
-    # 6. Эффективность (отношение завершенных к общему количеству)
-    completed_batches = len([b for b, u in all_batches if b.status == 'completed'])
-    efficiency = (completed_batches / total_production * 100) if total_production > 0 else 0
-    
-    # 7. Средняя длительность операций
-    total_duration = 0
-    duration_count = 0
-    for batch, user in all_batches:
-        if batch.end_time and batch.start_time:
-            duration = (batch.end_time - batch.start_time).total_seconds() / 60
-            total_duration += duration
-            duration_count += 1
-    avg_duration = total_duration / duration_count if duration_count > 0 else 0
+    # Статистика активности операторов (GROUP BY, кэш по периоду)
+    operator_stats = get_operator_stats(date_from_obj, date_to_obj) if date_from_obj and date_to_obj else {}
     
     # === ОБЪЕДИНЕННЫЕ ЗАПИСИ МАТЕРИАЛОВ ===
     
-    # Создаем объединенный список записей материалов из всех источников
-    material_entries = []
-    
-    # 1. Записи Entry (заливка)
-    for entry, user in entries:
-        material_entries.append({
-            'type': 'entry',
-            'datetime': datetime.combine(entry.date, datetime.strptime(entry.time, '%H:%M:%S').time()),
-            'user': user,
-            'shift': entry.shift,
-            'cement': entry.cement,
-            'lime': entry.lime,
-            'aluminum_powder': entry.alum_powder,
-            'water': entry.water,
-            'sulfanol': entry.sulfanol,
-            'gypsum': entry.gypsum,
-            'sludge': entry.sludge
-        })
-    
-    # 2. Записи Batch с материалами (резка и автоклав)
-    for batch, user in all_batches:
-        if batch.materials:  # Если у партии есть материалы
-            # Получаем материалы для этой партии
-            batch_materials = {}
-            for bm in batch.materials:
-                batch_materials[bm.material.name] = bm.quantity
-            
-            material_entries.append({
-                'type': 'batch',
-                'datetime': batch.start_time,
-                'user': user,
-                'shift': batch.shift,
-                'cement': batch_materials.get('Цемент', 0),
-                'lime': batch_materials.get('Известь', 0),
-                'aluminum_powder': batch_materials.get('Алюминиевая пудра', 0),
-                'water': batch_materials.get('Вода', 0),
-                'sulfanol': batch_materials.get('Сульфанол', 0),
-                'gypsum': batch_materials.get('Гипс', 0),
-                'sludge': batch_materials.get('Шлам', 0),
-                'batch_type': batch.batch_type,
-                'batch_number': batch.batch_number
-            })
-    
-    # Сортируем по времени (новые сначала)
-    material_entries.sort(key=lambda x: x['datetime'], reverse=True)
+    # Страница сводной таблицы: заливка и партии, по колонке на активный материал
+    materials_page = max(request.args.get('materials_page', 1, type=int), 1)
+    material_columns = reference_data.active_materials
+    material_entries, materials_has_next = material_matrix_page(
+        material_columns, date_from_obj, date_to_obj, materials_page
+    )
     
     return render_template("director_dashboard.html", 
-                         entries=entries,
                          material_entries=material_entries,
-                         total_entries=total_entries,
-                         total_cement=total_cement,
-                         total_lime=total_lime,
-                         total_water=total_water,
-                         day_entries=total_day_operations,
-                         night_entries=total_night_operations,
-                         # Детализация по сменам для каждого типа операций
-                         day_entries_casting=len(day_entries),
-                         night_entries_casting=len(night_entries),
-                         day_entries_cutting=len([b for b in day_batches if b.batch_type == "cutting"]),
-                         night_entries_cutting=len([b for b in night_batches if b.batch_type == "cutting"]),
-                         day_entries_autoclave=len([b for b in day_batches if b.batch_type == "autoclave"]),
-                         night_entries_autoclave=len([b for b in night_batches if b.batch_type == "autoclave"]),
-                         # Аналитика партий
-                         total_cutting_batches=total_cutting_batches,
-                         active_cutting=active_cutting,
-                         completed_cutting=completed_cutting,
-                         avg_cutting_duration=avg_cutting_duration,
-                         total_autoclave_batches=total_autoclave_batches,
-                         active_autoclave=active_autoclave,
-                         completed_autoclave=completed_autoclave,
-                         avg_autoclave_duration=avg_autoclave_duration,
-                         total_casting_batches=total_casting_batches,
-                         cutting_batches=cutting_batches[:10],  # Последние 10
-                         autoclave_batches=autoclave_batches[:10],  # Последние 10
-                         products_stats=products_stats,  # Статистика по продуктам
+                         material_columns=material_columns,
+                         materials_page=materials_page,
+                         materials_has_next=materials_has_next,
+                         # Аналитика партий (последние 10)
+                         cutting_batches=cutting_batches,
+                         autoclave_batches=autoclave_batches,
                          # НОВОЕ: Расход сырья
                          materials_by_batch_type=materials_by_batch_type,  # Расход по типам партий
                          materials_total=materials_total,  # Общий расход всех материалов
                          # Параметры фильтров
                          date_from=date_from,
                          date_to=date_to,
+                         current_filters={
+                             'date_from': date_from,
+                             'date_to': date_to,
+                             'batch_type': batch_type_filter,
+                             'status': status_filter,
+                             'product': product_filter,
+                             'equipment': equipment_filter
+                         },
                          batch_type_filter=batch_type_filter,
                          status_filter=status_filter,
                          product_filter=product_filter,
                          equipment_filter=equipment_filter,
                          # Данные для фильтров
-                         products=Product.query.filter_by(is_active=True).all(),
-                         equipment=Equipment.query.filter_by(status="operational").all(),
+                         products=reference_data.active_products,
+                         equipment=reference_data.operational_equipment(),
                          # Лента операций
                          entries_timeline=entries_timeline,
+                         timeline_cursor=timeline_cursor,
                          operator_stats=operator_stats,
-                         # Производственные метрики
-                         total_production=total_production,
-                         downtime_batches=downtime_batches,
-                         active_time_batches=active_time_batches,
-                         defect_batches=defect_batches,
-                         tech_violations=tech_violations,
-                         efficiency=efficiency,
-                         avg_duration=avg_duration)
+                         # Счетчики по сменам, типам, статусам, продуктам и производственные метрики
+                         **kpis)
+
+@app.route("/timeline")
+@conditional_on_data("entry", "batch", "user")
+def timeline():
+    """Следующая страница ленты операций: ?date_from=...&date_to=...&cursor=...&limit=N"""
+    if session.get("role") not in ["director", "chief_technologist"]:
+        return jsonify({"error": "Доступ запрещен"}), 403
+    
+    date_from = parse_date(request.args.get("date_from"))
+    date_to = parse_date(request.args.get("date_to"))
+    if not date_from or not date_to:
+        return jsonify({"error": "Нужен период date_from и date_to в формате YYYY-MM-DD"}), 400
+    
+    cursor = request.args.get("cursor")
+    try:
+        cursor = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    limit = min(max(request.args.get("limit", TIMELINE_PAGE_SIZE, type=int), 1), TIMELINE_MAX_PAGE_SIZE)
+    
+    items, next_cursor = timeline_page(lambda column: date_range_filter(column, date_from, date_to), cursor, limit)
+    return jsonify({
+        "items": [timeline_item_json(item) for item in items],
+        "next_cursor": next_cursor
+    })
+
+@app.route("/operator_stats")
+@conditional_on_data("entry", "batch", "batch_material", "material", "user")
+def operator_stats():
+    """Активность операторов за период: ?date_from=...&date_to=... (по умолчанию - вся история)"""
+    if session.get("role") not in ["admin", "director", "chief_technologist"]:
+        return jsonify({"error": "Доступ запрещен"}), 403
+    
+    date_from = parse_date(request.args.get("date_from"))
+    date_to = parse_date(request.args.get("date_to"))
+    if bool(date_from) != bool(date_to) or (date_from and date_from > date_to):
+        return jsonify({"error": "Нужен период date_from <= date_to в формате YYYY-MM-DD"}), 400
+    
+    return jsonify({
+        "date_from": date_from.isoformat() if date_from else None,
+        "date_to": date_to.isoformat() if date_to else None,
+        "operators": [
+            dict(stats, user_id=user_id, last_activity=stats["last_activity"].isoformat())
+            for user_id, stats in get_operator_stats(date_from, date_to).items()
+        ]
+    })
+
+@app.route("/duration_stats")
+@conditional_on_data("batch", "equipment", "product")
+def duration_stats_view():
+    """Перцентили и гистограммы длительности резки и автоклава:
+    ?date_from=...&date_to=...&batch_type=cutting|autoclave&bins=N
+    """
+    if session.get("role") not in ["admin", "director", "chief_technologist"]:
+        return jsonify({"error": "Доступ запрещен"}), 403
+
+    date_from = parse_date(request.args.get("date_from"))
+    date_to = parse_date(request.args.get("date_to"))
+    if bool(date_from) != bool(date_to) or (date_from and date_from > date_to):
+        return jsonify({"error": "Нужен период date_from <= date_to в формате YYYY-MM-DD"}), 400
+
+    batch_type = request.args.get("batch_type")
+    if batch_type and batch_type not in DURATION_BATCH_TYPES:
+        return jsonify({"error": f"batch_type: {', '.join(DURATION_BATCH_TYPES)}"}), 400
+    batch_types = (batch_type,) if batch_type else DURATION_BATCH_TYPES
+    bins = parse_bins(request.args.get("bins"))
+
+    stats = get_cached_data(
+        f"duration_stats:{date_from}:{date_to}:{','.join(batch_types)}:{bins}",
+        lambda: duration_stats(
+            lambda column: date_range_filter(column, date_from, date_to),
+            batch_types,
+            bins,
+            reference_data.equipment_names,
+            reference_data.product_names
+        ),
+        ttl_seconds=600,
+        scope=cache_scope(["batch", "equipment", "product"], date_from, date_to, batch_types)
+    )
+    return jsonify({
+        "date_from": date_from.isoformat() if date_from else None,
+        "date_to": date_to.isoformat() if date_to else None,
+        "unit": "min",
+        "batch_types": stats
+    })
+
+# Закрытые дни загрузки оборудования меняются только при правке их партий
+UTILIZATION_DAY_TTL = 24 * 3600
+UTILIZATION_TODAY_TTL = 60
+UTILIZATION_MAX_DAYS = 366
+
+def get_equipment_utilization(date_from, date_to):
+    """Загрузка оборудования за период; показатели каждого дня кэшируются отдельно.
+
+    Недостающие дни считаются одним проходом по интервалам партий. Область
+    кэша дня - все партии, начатые не позже него: правка старой партии
+    сбрасывает дни от ее начала, новые партии прошлые дни не трогают.
+    """
+    today = datetime.now().date()
+    period = [date_from + timedelta(days=offset) for offset in range((date_to - date_from).days + 1)]
+    cached = cache.get_many(f"equipment_utilization:{day}" for day in period)
+    days = {day: cached[f"equipment_utilization:{day}"] for day in period if f"equipment_utilization:{day}" in cached}
+    missing = [day for day in period if day not in days]
+
+    if missing:
+        computed = daily_utilization(missing[0], missing[-1], [item.id for item in reference_data.equipment])
+        cache.set_many([
+            (
+                f"equipment_utilization:{day}",
+                value,
+                UTILIZATION_TODAY_TTL if day >= today else UTILIZATION_DAY_TTL,
+                cache_scope(["batch", "equipment"], None, day)
+            )
+            for day, value in computed.items()
+        ])
+        days.update(computed)
+
+    return summarize_utilization(
+        days,
+        [(item.id, item.name, item.equipment_type) for item in reference_data.equipment]
+    )
+
+@app.route("/equipment_utilization")
+def equipment_utilization():
+    """Загрузка оборудования по сменам и дням: ?date_from=...&date_to=... (по умолчанию - последние 7 дней)"""
+    if session.get("role") not in ["admin", "director", "chief_technologist"]:
+        return jsonify({"error": "Доступ запрещен"}), 403
+
+    today = datetime.now().date()
+    date_from = parse_date(request.args.get("date_from"))
+    date_to = parse_date(request.args.get("date_to"))
+    if not (request.args.get("date_from") or request.args.get("date_to")):
+        date_from, date_to = today - timedelta(days=6), today
+    if not date_from or not date_to or date_from > date_to:
+        return jsonify({"error": "Нужен период date_from <= date_to в формате YYYY-MM-DD"}), 400
+    date_to = min(date_to, today)
+    if date_from > date_to or (date_to - date_from).days >= UTILIZATION_MAX_DAYS:
+        return jsonify({"error": f"Период - от 1 до {UTILIZATION_MAX_DAYS} дней, не позже сегодняшнего"}), 400
+
+    return jsonify({
+        "date_from": date_from.isoformat(),
+        "date_to": date_to.isoformat(),
+        "day_shift": "08:00-20:00",
+        "equipment": get_equipment_utilization(date_from, date_to)
+    })
 
 @app.route("/analytics_data")
+@conditional_on_data("entry", "user")
 def analytics_data():
     if session.get("role") != "director":
         return redirect(url_for("login"))
 
-    # Получаем данные для графиков
-    entries = db.session.query(Entry, User).join(User, Entry.user_id == User.id).all()
+    # Суммы по датам считает SQLite, в Python приходит по строке на день
+    rows = db.session.query(
+        Entry.date,
+        db.func.sum(Entry.cement),
+        db.func.sum(Entry.lime),
+        db.func.sum(Entry.water),
+        db.func.count(Entry.id)
+    ).join(User, Entry.user_id == User.id).group_by(Entry.date).all()
+    
+    total_entries = sum(count for _, _, _, _, count in rows)
+    
+    # ?points=N - не больше N дней, пики и провалы цемента/извести/воды сохраняются
+    points = parse_points(request.args.get("points"))
+    if points and len(rows) > points:
+        rows.sort(key=lambda row: row[0])
+        keep = lttb_indices(
+            [row[0].toordinal() for row in rows],
+            [[row[column] or 0 for row in rows] for column in (1, 2, 3)],
+            points
+        )
+        rows = [rows[index] for index in keep]
     
-    # Группируем по датам
-    daily_data = {}
-    for entry, user in entries:
-        date_str = entry.date.strftime("%Y-%m-%d")
-        if date_str not in daily_data:
-            daily_data[date_str] = {
-                'cement': 0, 'lime': 0, 'water': 0, 'count': 0
-            }
-        daily_data[date_str]['cement'] += entry.cement
-        daily_data[date_str]['lime'] += entry.lime
-        daily_data[date_str]['water'] += entry.water
-        daily_data[date_str]['count'] += 1
+    daily_data = {
+        day.strftime("%Y-%m-%d"): {'cement': cement, 'lime': lime, 'water': water, 'count': count}
+        for day, cement, lime, water, count in rows
+    }
     
     return jsonify({
         'daily_data': daily_data,
-        'total_entries': len(entries)
+        'total_entries': total_entries
     })
 
 # Новые маршруты для системы партий
@@ -758,13 +2042,12 @@ def create_batch():
         
         db.session.add(new_batch)
         db.session.commit()
-        clear_analytics_cache()  # Очищаем кэш при создании новой партии
         
         return redirect(url_for("batch_list"))
     
     # Получаем оборудование и продукты для формы
-    equipment = Equipment.query.filter_by(status="operational").all()
-    products = Product.query.filter_by(is_active=True).all()
+    equipment = reference_data.operational_equipment()
+    products = reference_data.active_products
     return render_template("create_batch.html", equipment=equipment, products=products)
 
 # === ШАБЛОНЫ ПАРТИЙ ===
@@ -777,7 +2060,7 @@ def templates_list():
     if user_role not in ["admin", "director", "chief_technologist"]:
         return "Доступ запрещен", 403
     
-    templates = BatchTemplate.query.filter_by(is_active=True).all()
+    templates = BatchTemplate.query.options(*TEMPLATE_LOADERS).filter_by(is_active=True).all()
     return render_template("templates_list.html", templates=templates)
 
 @app.route("/add_template", methods=["GET", "POST"])
@@ -810,7 +2093,7 @@ def add_template():
         db.session.flush()  # Получаем ID шаблона
         
         # Добавляем материалы
-        materials = Material.query.filter_by(is_active=True).all()
+        materials = reference_data.active_materials
         for material in materials:
             quantity = request.form.get(f"material_{material.id}", type=float)
             if quantity and quantity > 0:
@@ -825,9 +2108,9 @@ def add_template():
         return redirect(url_for("templates_list"))
     
     # Получаем данные для формы
-    equipment = Equipment.query.filter_by(status="operational").all()
-    products = Product.query.filter_by(is_active=True).all()
-    materials = Material.query.filter_by(is_active=True).all()
+    equipment = reference_data.operational_equipment()
+    products = reference_data.active_products
+    materials = reference_data.active_materials
     
     return render_template("add_template.html", equipment=equipment, products=products, materials=materials)
 
@@ -836,7 +2119,7 @@ def create_batch_from_template(template_id):
     if "user_id" not in session:
         return redirect(url_for("login"))
     
-    template = BatchTemplate.query.get_or_404(template_id)
+    template = db.get_or_404(BatchTemplate, template_id, options=TEMPLATE_LOADERS)
     
     if request.method == "POST":
         batch_number = request.form["batch_number"]
@@ -880,7 +2163,7 @@ def duplicate_last_batch():
         return redirect(url_for("login"))
     
     # Находим последнюю партию пользователя
-    last_batch = Batch.query.filter_by(user_id=session["user_id"]).order_by(Batch.start_time.desc()).first()
+    last_batch = Batch.query.options(*BATCH_MATERIALS_LOADERS).filter_by(user_id=session["user_id"]).order_by(Batch.start_time.desc()).first()
     
     if not last_batch:
         return "Нет партий для дублирования", 400
@@ -933,15 +2216,28 @@ def edit_entry(entry_id):
         return f"Время редактирования истекло. Можно редактировать только в течение {edit_time_limit} минут после создания.", 400
     
     if request.method == "POST":
+        # Сначала проверяем форму целиком, чтобы не менять запись наполовину
+        try:
+            quantities = {
+                column: float(request.form.get(column, 0))
+                for column in ("cement", "lime", "alum_powder", "sludge", "gypsum", "water", "sulfanol")
+            }
+        except ValueError:
+            return "Количество материала должно быть числом", 400
+        entry_time = parse_time(request.form.get("time", entry.time))
+        if entry_time is None:
+            return "Некорректное время: нужен формат ЧЧ:ММ или ЧЧ:ММ:СС", 400
+        entry_date = entry.date
+        if request.form.get("date"):
+            entry_date = parse_date(request.form["date"])
+            if entry_date is None:
+                return "Некорректная дата: нужен формат YYYY-MM-DD", 400
+
         # Обновляем данные
-        entry.cement = float(request.form.get("cement", 0))
-        entry.lime = float(request.form.get("lime", 0))
-        entry.alum_powder = float(request.form.get("alum_powder", 0))
-        entry.sludge = float(request.form.get("sludge", 0))
-        entry.gypsum = float(request.form.get("gypsum", 0))
-        entry.water = float(request.form.get("water", 0))
-        entry.sulfanol = float(request.form.get("sulfanol", 0))
-        entry.time = request.form.get("time", entry.time)
+        for column, quantity in quantities.items():
+            setattr(entry, column, quantity)
+        entry.date = entry_date
+        entry.time = entry_time
         entry.shift = request.form.get("shift", entry.shift)
         entry.updated_at = datetime.now()
         
@@ -955,7 +2251,7 @@ def edit_batch(batch_id):
     if "user_id" not in session:
         return redirect(url_for("login"))
     
-    batch = Batch.query.get_or_404(batch_id)
+    batch = db.get_or_404(Batch, batch_id, options=BATCH_MATERIALS_LOADERS)
     
     # Проверяем права доступа
     if batch.user_id != session["user_id"] and session.get("role") not in ["admin", "director", "chief_technologist"]:
@@ -984,21 +2280,100 @@ def edit_batch(batch_id):
         return redirect(url_for("batch_list"))
     
     # Получаем данные для формы
-    equipment = Equipment.query.filter_by(status="operational").all()
-    products = Product.query.filter_by(is_active=True).all()
+    equipment = reference_data.operational_equipment()
+    products = reference_data.active_products
     
     return render_template("edit_batch.html", batch=batch, equipment=equipment, products=products, 
                           time_limit=edit_time_limit, time_remaining=edit_time_limit - time_since_creation)
 
+# === КУРСОРНАЯ ПАГИНАЦИЯ СПИСКА ПАРТИЙ ===
+class KeysetPagination:
+    """Страница списка по курсору (start_time, id) вместо OFFSET.
+
+    Стоимость страницы не зависит от ее номера: запрос начинается с позиции
+    курсора по индексу start_time. Номер страницы передается только для отображения.
+    """
+    def __init__(self, items, page, per_page, total, has_prev, has_next):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.pages = max(1, -(-total // per_page))
+        # Курсор за краем списка (партии удалили) дает пустую страницу без соседей
+        self.has_prev = has_prev and bool(items)
+        self.has_next = has_next and bool(items)
+
+        first_batch = items[0][0] if items else None
+        last_batch = items[-1][0] if items else None
+        self.prev_args = {'before': encode_batch_cursor(first_batch), 'page': page - 1} if self.has_prev else None
+        self.next_args = {'after': encode_batch_cursor(last_batch), 'page': page + 1} if self.has_next else None
+
+    @property
+    def first_index(self):
+        return (self.page - 1) * self.per_page + 1 if self.items else 0
+
+    @property
+    def last_index(self):
+        return self.first_index + len(self.items) - 1 if self.items else 0
+
+def encode_batch_cursor(batch):
+    """Курсор партии: время начала и id"""
+    return f"{batch.start_time.isoformat()}_{batch.id}"
+
+def decode_batch_cursor(value):
+    """Разбирает курсор партии, при ошибке возвращает None"""
+    try:
+        start_time, batch_id = value.rsplit('_', 1)
+        return datetime.fromisoformat(start_time), int(batch_id)
+    except (AttributeError, ValueError):
+        return None
+
+def paginate_batches_keyset(query, per_page, after=None, before=None, page=1, total=0):
+    """Возвращает страницу партий (Batch, User), новые сначала, по курсору after/before"""
+    after_key = decode_batch_cursor(after)
+    before_key = decode_batch_cursor(before)
+
+    if before_key:
+        # Назад: идем по возрастанию от курсора и разворачиваем результат
+        start_time, batch_id = before_key
+        rows = query.filter(db.or_(
+            Batch.start_time > start_time,
+            db.and_(Batch.start_time == start_time, Batch.id > batch_id)
+        )).order_by(Batch.start_time.asc(), Batch.id.asc()).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        has_next = True
+    else:
+        if after_key:
+            start_time, batch_id = after_key
+            query = query.filter(db.or_(
+                Batch.start_time < start_time,
+                db.and_(Batch.start_time == start_time, Batch.id < batch_id)
+            ))
+        else:
+            page = 1
+        rows = query.order_by(Batch.start_time.desc(), Batch.id.desc()).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        has_prev = after_key is not None
+
+    if not has_prev:
+        page = 1
+
+    return KeysetPagination(items, max(page, 1), per_page, total, has_prev, has_next)
+
 @app.route("/batch_list")
+@conditional_on_data("batch", "product", "equipment", "user")
 def batch_list():
     if "user_id" not in session:
         return redirect(url_for("login"))
     
     user_role = session.get("role")
     
-    # Получаем параметры фильтрации
+    # Получаем параметры пагинации (курсор последней/первой партии на соседней странице)
     page = request.args.get('page', 1, type=int)
+    after = request.args.get('after')
+    before = request.args.get('before')
     per_page = 50  # По 50 записей на страницу
     
     # Фильтры
@@ -1030,54 +2405,54 @@ def batch_list():
     if equipment_filter != 'all':
         query = query.filter(Batch.equipment_id == equipment_filter)
     
-    if date_from:
-        try:
-            from_date = datetime.strptime(date_from, '%Y-%m-%d')
-            query = query.filter(Batch.start_time >= from_date)
-        except ValueError:
-            pass
+    # Фильтр по датам (некорректная дата игнорируется)
+    query = query.filter(*date_range_filter(Batch.start_time, parse_date(date_from), parse_date(date_to)))
     
-    if date_to:
-        try:
-            to_date = datetime.strptime(date_to, '%Y-%m-%d')
-            # Добавляем 23:59:59 к дате "до"
-            to_date = to_date.replace(hour=23, minute=59, second=59)
-            query = query.filter(Batch.start_time <= to_date)
-        except ValueError:
-            pass
+    current_filters = {
+        'batch_type': batch_type_filter,
+        'status': status_filter,
+        'product': product_filter,
+        'equipment': equipment_filter,
+        'date_from': date_from,
+        'date_to': date_to
+    }
     
-    # Сортировка по времени создания (новые сначала)
-    query = query.order_by(Batch.start_time.desc())
+    # Общее количество кэшируется по набору фильтров и не пересчитывается при листании
+    owner = "all" if user_role in ["admin", "director", "chief_technologist"] else f"user{session['user_id']}"
+    count_key = "batch_list_count:" + owner + ":" + json.dumps(current_filters, sort_keys=True)
+    total = get_cached_data(
+        count_key,
+        lambda: query.order_by(None).count(),
+        ttl_seconds=120,
+        scope=cache_scope(
+            ["batch"], parse_date(date_from), parse_date(date_to),
+            None if batch_type_filter == 'all' else [batch_type_filter]
+        )
+    )
     
-    # Пагинация
-    batches_pagination = query.paginate(
-        page=page, per_page=per_page, error_out=False
+    # Пагинация по курсору, новые сначала
+    batches_pagination = paginate_batches_keyset(
+        query.options(*BATCH_LIST_LOADERS), per_page, after=after, before=before, page=page, total=total
     )
     
     # Получаем справочники для фильтров
-    products = Product.query.filter_by(is_active=True).all()
-    equipment = Equipment.query.all()
+    products = reference_data.active_products
+    equipment = reference_data.equipment
     
     return render_template("batch_list.html", 
                          batches=batches_pagination.items,
                          pagination=batches_pagination,
                          products=products,
                          equipment=equipment,
-                         current_filters={
-                             'batch_type': batch_type_filter,
-                             'status': status_filter,
-                             'product': product_filter,
-                             'equipment': equipment_filter,
-                             'date_from': date_from,
-                             'date_to': date_to
-                         })
+                         current_filters=current_filters)
 
 @app.route("/batch/<int:batch_id>")
+@conditional_on_data("batch", "batch_material", "material", "product", "equipment", "user")
 def batch_detail(batch_id):
     if "user_id" not in session:
         return redirect(url_for("login"))
     
-    batch = db.session.query(Batch, User).join(User, Batch.user_id == User.id).filter(Batch.id == batch_id).first()
+    batch = db.session.query(Batch, User).join(User, Batch.user_id == User.id).options(*BATCH_LIST_LOADERS).filter(Batch.id == batch_id).first()
     if not batch:
         return "Партия не найдена", 404
     
@@ -1098,7 +2473,7 @@ def add_material_to_batch(batch_id):
     if "user_id" not in session:
         return redirect(url_for("login"))
     
-    batch = Batch.query.get_or_404(batch_id)
+    batch = db.get_or_404(Batch, batch_id, options=BATCH_MATERIALS_LOADERS)
     
     # Проверяем права доступа
     user_role = session.get("role")
@@ -1121,7 +2496,7 @@ def add_material_to_batch(batch_id):
         return redirect(url_for("batch_detail", batch_id=batch_id))
     
     # Получаем все материалы
-    materials = Material.query.filter_by(is_active=True).all()
+    materials = reference_data.active_materials
     return render_template("add_material_to_batch.html", batch=batch, materials=materials)
 
 @app.route("/complete_batch/<int:batch_id>", methods=["POST"])
@@ -1339,8 +2714,13 @@ def init_references():
         ("Сульфанол", "l")
     ]
     
+    # Существующие записи проверяем по справочнику, а не запросом на каждое имя
+    material_names = set(reference_data.material_names.values())
+    equipment_names = set(reference_data.equipment_names.values())
+    product_codes = set(reference_data.product_codes.values())
+    
     for name, unit in materials_data:
-        if not Material.query.filter_by(name=name).first():
+        if name not in material_names:
             material = Material(name=name, unit=unit)
             db.session.add(material)
     
@@ -1355,7 +2735,7 @@ def init_references():
     ]
     
     for name, eq_type in equipment_data:
-        if not Equipment.query.filter_by(name=name).first():
+        if name not in equipment_names:
             equipment = Equipment(name=name, equipment_type=eq_type)
             db.session.add(equipment)
     
@@ -1372,7 +2752,7 @@ def init_references():
     ]
     
     for code, name, description in products_data:
-        if not Product.query.filter_by(product_code=code).first():
+        if code not in product_codes:
             product = Product(product_code=code, name=name, description=description)
             db.session.add(product)
     
@@ -1380,24 +2760,22 @@ def init_references():
     return "Справочники инициализированы (материалы, оборудование, продукты)"
 
 # === ЭКСПОРТ ДАННЫХ ===
-@app.route("/export/batches_csv")
-def export_batches_csv():
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-    
-    user_role = session.get("role")
-    if user_role not in ["admin", "director", "chief_technologist"]:
-        return "Доступ запрещен", 403
-    
-    # Получаем параметры фильтрации
-    date_from = request.args.get('date_from')
-    date_to = request.args.get('date_to')
-    batch_type_filter = request.args.get('batch_type', 'all')
-    status_filter = request.args.get('status', 'all')
-    product_filter = request.args.get('product', 'all')
-    equipment_filter = request.args.get('equipment', 'all')
+# Партии и записи выгружаются потоково (xlsx_export.py): строки читаются курсором
+# порциями по EXPORT_FETCH_SIZE, книга пишется на диск, файл отдается кусками.
+# Готовые файлы кэшируются (export_cache) до изменения данных в их таблицах.
+EXPORT_FETCH_SIZE = 1000
+
+def max_operator_name_length():
+    """Длина самого длинного ФИО - для ширины колонки «Оператор»"""
+    return db.session.query(db.func.max(db.func.length(User.fio))).scalar() or 0
+
+def export_batches_query(args):
+    """Партии с оператором по фильтрам выгрузки (те же параметры, что у списка партий)"""
+    batch_type_filter = args.get('batch_type', 'all')
+    status_filter = args.get('status', 'all')
+    product_filter = args.get('product', 'all')
+    equipment_filter = args.get('equipment', 'all')
     
-    # Строим запрос
     query = db.session.query(Batch, User).join(User, Batch.user_id == User.id)
     
     if batch_type_filter != 'all':
@@ -1412,223 +2790,101 @@ def export_batches_csv():
     if equipment_filter != 'all':
         query = query.filter(Batch.equipment_id == equipment_filter)
     
-    if date_from:
-        try:
-            from_date = datetime.strptime(date_from, '%Y-%m-%d')
-            query = query.filter(Batch.start_time >= from_date)
-        except ValueError:
-            pass
-    
-    if date_to:
-        try:
-            to_date = datetime.strptime(date_to, '%Y-%m-%d')
-            to_date = to_date.replace(hour=23, minute=59, second=59)
-            query = query.filter(Batch.start_time <= to_date)
-        except ValueError:
-            pass
-    
-    batches = query.order_by(Batch.start_time.desc()).all()
-    
-    # Создаем Excel файл с форматированием
-    output = io.BytesIO()
-    workbook = openpyxl.Workbook()
-    worksheet = workbook.active
-    worksheet.title = "Производственные партии"
-    
-    # Стили
-    header_font = Font(bold=True, color="FFFFFF", size=12)
-    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-    header_alignment = Alignment(horizontal="center", vertical="center")
-    
-    # Границы
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # Заголовки
-    headers = [
-        'ID', 'Номер партии', 'Тип', 'Статус', 'Продукт', 'Оборудование',
-        'Оператор', 'Время начала', 'Время окончания', 'Примечания'
-    ]
-    
-    for col, header in enumerate(headers, 1):
-        cell = worksheet.cell(row=1, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = header_alignment
-        cell.border = thin_border
-    
-    # Данные
-    for row, (batch, user) in enumerate(batches, 2):
-        data = [
-            batch.id,
-            batch.batch_number,
-            batch.batch_type,
-            batch.status,
-            batch.product.name if batch.product else '',
-            batch.equipment.name if batch.equipment else '',
-            user.fio,
-            batch.start_time.strftime('%d.%m.%Y %H:%M'),
-            batch.end_time.strftime('%d.%m.%Y %H:%M') if batch.end_time else '',
-            batch.notes or ''
-        ]
-        
-        for col, value in enumerate(data, 1):
-            cell = worksheet.cell(row=row, column=col, value=value)
-            cell.border = thin_border
-            cell.alignment = Alignment(horizontal="left", vertical="center")
-    
-    # Автоширина колонок
-    for column in worksheet.columns:
-        max_length = 0
-        column_letter = get_column_letter(column[0].column)
-        for cell in column:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        adjusted_width = min(max_length + 2, 50)
-        worksheet.column_dimensions[column_letter].width = adjusted_width
-    
-    # Замораживаем первую строку
-    worksheet.freeze_panes = "A2"
-    
-    workbook.save(output)
-    output.seek(0)
-    
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    response.headers['Content-Disposition'] = f'attachment; filename=batches_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-    
-    return response
+    # Фильтр по датам (некорректная дата игнорируется)
+    return query.filter(*date_range_filter(Batch.start_time, parse_date(args.get('date_from')), parse_date(args.get('date_to'))))
 
-@app.route("/export/entries_csv")
-def export_entries_csv():
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-    
-    user_role = session.get("role")
-    if user_role not in ["admin", "director", "chief_technologist"]:
-        return "Доступ запрещен", 403
+def export_entries_query(args):
+    """Записи заливки с оператором по фильтрам выгрузки (период и смена)"""
+    shift_filter = args.get('shift', 'all')
     
-    # Получаем параметры фильтрации
-    date_from = request.args.get('date_from')
-    date_to = request.args.get('date_to')
-    shift_filter = request.args.get('shift', 'all')
-    
-    # Строим запрос
     query = db.session.query(Entry, User).join(User, Entry.user_id == User.id)
     
     if shift_filter != 'all':
         query = query.filter(Entry.shift == shift_filter)
     
-    if date_from:
-        try:
-            from_date = datetime.strptime(date_from, '%Y-%m-%d').date()
-            query = query.filter(Entry.date >= from_date)
-        except ValueError:
-            pass
-    
-    if date_to:
-        try:
-            to_date = datetime.strptime(date_to, '%Y-%m-%d').date()
-            query = query.filter(Entry.date <= to_date)
-        except ValueError:
-            pass
-    
-    entries = query.order_by(Entry.date.desc(), Entry.time.desc()).all()
-    
-    # Создаем Excel файл с форматированием
-    output = io.BytesIO()
-    workbook = openpyxl.Workbook()
-    worksheet = workbook.active
-    worksheet.title = "Записи ввода материалов"
+    # Фильтр по датам (некорректная дата игнорируется)
+    return query.filter(*date_range_filter(Entry.recorded_at, parse_date(args.get('date_from')), parse_date(args.get('date_to'))))
+
+def batches_xlsx_sheet(args):
+    """Лист выгрузки партий: (название, колонки, строки, цвет заголовка)"""
+    # Только нужные колонки, порциями по курсору - без ORM-объектов и полной выборки в памяти
+    rows = export_batches_query(args).with_entities(
+        Batch.id, Batch.batch_number, Batch.batch_type, Batch.status,
+        Batch.product_id, Batch.equipment_id, User.fio,
+        Batch.start_time, Batch.end_time, Batch.notes
+    ).order_by(Batch.start_time.desc()).yield_per(EXPORT_FETCH_SIZE)
+    product_names = reference_data.product_names
+    equipment_names = reference_data.equipment_names
+    
+    def batch_rows():
+        for batch_id, number, batch_type, status, product_id, equipment_id, fio, start_time, end_time, notes in rows:
+            yield [
+                batch_id,
+                number,
+                batch_type,
+                status,
+                product_names.get(product_id, ''),
+                equipment_names.get(equipment_id, ''),
+                fio,
+                start_time.strftime('%d.%m.%Y %H:%M'),
+                end_time.strftime('%d.%m.%Y %H:%M') if end_time else '',
+                notes or ''
+            ]
+    
+    # Ширина колонок известна до выгрузки: по заголовку и максимальной длине значений
+    columns = [
+        ('ID', column_width('ID', 8), False),
+        ('Номер партии', column_width('Номер партии', 20), False),
+        ('Тип', column_width('Тип', len('autoclave')), False),
+        ('Статус', column_width('Статус', len('completed')), False),
+        ('Продукт', column_width('Продукт', max(map(len, product_names.values()), default=0)), False),
+        ('Оборудование', column_width('Оборудование', max(map(len, equipment_names.values()), default=0)), False),
+        ('Оператор', column_width('Оператор', max_operator_name_length()), False),
+        ('Время начала', column_width('Время начала', 16), False),
+        ('Время окончания', column_width('Время окончания', 16), False),
+        ('Примечания', column_width('Примечания', MAX_COLUMN_WIDTH), False),
+    ]
     
-    # Стили
-    header_font = Font(bold=True, color="FFFFFF", size=12)
-    header_fill = PatternFill(start_color="2E7D32", end_color="2E7D32", fill_type="solid")
-    header_alignment = Alignment(horizontal="center", vertical="center")
+    return "Производственные партии", columns, batch_rows(), "366092"
+
+def entries_xlsx_sheet(args):
+    """Лист выгрузки записей заливки: (название, колонки, строки, цвет заголовка)"""
+    rows = export_entries_query(args).with_entities(
+        Entry.id, Entry.date, Entry.time, Entry.shift, User.fio,
+        *(getattr(Entry, column) for column, _, _ in ENTRY_MATERIALS)
+    ).order_by(Entry.recorded_at.desc()).yield_per(EXPORT_FETCH_SIZE)
     
-    # Границы
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
+    def entry_rows():
+        for entry_id, day, entry_time, shift, fio, *materials in rows:
+            yield [entry_id, day.strftime('%d.%m.%Y'), entry_time, shift, fio, *materials]
     
-    # Заголовки
-    headers = [
-        'ID', 'Дата', 'Время', 'Смена', 'Оператор',
+    material_headers = [
         'Цемент (кг)', 'Известь (кг)', 'Ал. пудра (кг)', 'Шлам (л)',
         'Гипс (кг)', 'Вода (л)', 'Сульфанол (л)'
     ]
+    columns = [
+        ('ID', column_width('ID', 8), False),
+        ('Дата', column_width('Дата', 10), False),
+        ('Время', column_width('Время', 8), False),
+        ('Смена', column_width('Смена', 10), False),
+        ('Оператор', column_width('Оператор', max_operator_name_length()), False),
+    ] + [(header, column_width(header, 10), True) for header in material_headers]
     
-    for col, header in enumerate(headers, 1):
-        cell = worksheet.cell(row=1, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = header_alignment
-        cell.border = thin_border
-    
-    # Данные
-    for row, (entry, user) in enumerate(entries, 2):
-        data = [
-            entry.id,
-            entry.date.strftime('%d.%m.%Y'),
-            entry.time,
-            entry.shift,
-            user.fio,
-            entry.cement,
-            entry.lime,
-            entry.alum_powder,
-            entry.sludge,
-            entry.gypsum,
-            entry.water,
-            entry.sulfanol
-        ]
-        
-        for col, value in enumerate(data, 1):
-            cell = worksheet.cell(row=row, column=col, value=value)
-            cell.border = thin_border
-            cell.alignment = Alignment(horizontal="left", vertical="center")
-            
-            # Форматирование числовых значений
-            if col >= 6:  # Материалы
-                if value and str(value).replace('.', '').replace(',', '').isdigit():
-                    cell.number_format = '0.00'
-    
-    # Автоширина колонок
-    for column in worksheet.columns:
-        max_length = 0
-        column_letter = get_column_letter(column[0].column)
-        for cell in column:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        adjusted_width = min(max_length + 2, 50)
-        worksheet.column_dimensions[column_letter].width = adjusted_width
-    
-    # Замораживаем первую строку
-    worksheet.freeze_panes = "A2"
-    
-    workbook.save(output)
-    output.seek(0)
+    return "Записи ввода материалов", columns, entry_rows(), "2E7D32"
+
+@app.route("/export/batches_csv")
+def export_batches_csv():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
     
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    response.headers['Content-Disposition'] = f'attachment; filename=entries_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+    user_role = session.get("role")
+    if user_role not in ["admin", "director", "chief_technologist"]:
+        return "Доступ запрещен", 403
     
-    return response
+    return cached_export_response("batches", "xlsx")
 
-@app.route("/export/analytics_csv")
-def export_analytics_csv():
+@app.route("/export/entries_csv")
+def export_entries_csv():
     if "user_id" not in session:
         return redirect(url_for("login"))
     
@@ -1636,32 +2892,22 @@ def export_analytics_csv():
     if user_role not in ["admin", "director", "chief_technologist"]:
         return "Доступ запрещен", 403
     
-    # Получаем параметры фильтрации
-    date_from = request.args.get('date_from')
-    date_to = request.args.get('date_to')
+    return cached_export_response("entries", "xlsx")
+
+def build_analytics_workbook(args):
+    """Книга аналитики производства по партиям за период"""
+    date_from = args.get('date_from')
+    date_to = args.get('date_to')
     
     # Строим запрос для партий
     batch_query = db.session.query(Batch, User).join(User, Batch.user_id == User.id)
     
-    if date_from:
-        try:
-            from_date = datetime.strptime(date_from, '%Y-%m-%d')
-            batch_query = batch_query.filter(Batch.start_time >= from_date)
-        except ValueError:
-            pass
-    
-    if date_to:
-        try:
-            to_date = datetime.strptime(date_to, '%Y-%m-%d')
-            to_date = to_date.replace(hour=23, minute=59, second=59)
-            batch_query = batch_query.filter(Batch.start_time <= to_date)
-        except ValueError:
-            pass
+    # Фильтр по датам (некорректная дата игнорируется)
+    batch_query = batch_query.filter(*date_range_filter(Batch.start_time, parse_date(date_from), parse_date(date_to)))
     
     batches = batch_query.all()
     
     # Создаем Excel файл с аналитикой
-    output = io.BytesIO()
     workbook = openpyxl.Workbook()
     worksheet = workbook.active
     worksheet.title = "Аналитика производства"
@@ -1747,15 +2993,337 @@ def export_analytics_csv():
     # Замораживаем первую строку
     worksheet.freeze_panes = "A2"
     
-    workbook.save(output)
-    output.seek(0)
+    return workbook
+
+@app.route("/export/analytics_csv")
+def export_analytics_csv():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
     
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    response.headers['Content-Disposition'] = f'attachment; filename=analytics_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+    user_role = session.get("role")
+    if user_role not in ["admin", "director", "chief_technologist"]:
+        return "Доступ запрещен", 403
     
+    return cached_export_response("analytics", "xlsx")
+
+# === ПОТОКОВЫЙ ЭКСПОРТ В CSV ===
+# Для ночных выгрузок во внешние системы: те же фильтры, что у XLSX, строки идут
+# клиенту по мере чтения курсора, названия подставляются JOIN-ами в SQL.
+# Вариант .csv.gz сжимается на лету. Даты в ISO-формате, числа без округления.
+CSV_ROWS_PER_CHUNK = 1000
+
+def iter_csv(header, rows, compress=False):
+    """Генератор кусков CSV (UTF-8): по CSV_ROWS_PER_CHUNK строк за раз, при compress - gzip"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # 31 - формат gzip
+
+    def flush():
+        data = buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    writer.writerow(header)
+    pending = 0
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending >= CSV_ROWS_PER_CHUNK:
+            chunk = flush()
+            pending = 0
+            if chunk:
+                yield chunk
+
+    chunk = flush()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+def csv_response(header, rows, name):
+    """Потоковый ответ CSV; формат (csv или csv.gz) определяется по адресу запроса"""
+    compress = request.path.endswith(".gz")
+    extension = "csv.gz" if compress else "csv"
+    response = Response(
+        stream_with_context(iter_csv(header, rows, compress)),
+        mimetype="application/gzip" if compress else "text/csv"
+    )
+    if not compress:
+        response.mimetype_params["charset"] = "utf-8"
+    response.headers['Content-Disposition'] = f'attachment; filename={name}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{extension}'
     return response
 
+def iso(value):
+    return value.isoformat(sep=" ") if value else ""
+
+@app.route("/export/batches.csv")
+@app.route("/export/batches.csv.gz")
+def export_batches_stream():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    
+    if session.get("role") not in ["admin", "director", "chief_technologist"]:
+        return "Доступ запрещен", 403
+    
+    return csv_response(*batches_csv_rows(request.args), "batches")
+
+def batches_csv_rows(args):
+    """Заголовок и строки CSV партий, названия подставляются JOIN-ами"""
+    rows = export_batches_query(args).outerjoin(
+        Product, Batch.product_id == Product.id
+    ).outerjoin(
+        Equipment, Batch.equipment_id == Equipment.id
+    ).with_entities(
+        Batch.id, Batch.batch_number, Batch.batch_type, Batch.status, Batch.shift,
+        Product.product_code, Product.name, Equipment.name, User.fio,
+        Batch.start_time, Batch.end_time, Batch.notes
+    ).order_by(Batch.start_time.desc()).yield_per(EXPORT_FETCH_SIZE)
+    
+    header = [
+        'id', 'batch_number', 'batch_type', 'status', 'shift', 'product_code', 'product',
+        'equipment', 'operator', 'start_time', 'end_time', 'notes'
+    ]
+    return header, (
+        (batch_id, number, batch_type, status, shift, code or '', product or '', equipment or '',
+         fio, iso(start_time), iso(end_time), notes or '')
+        for batch_id, number, batch_type, status, shift, code, product, equipment, fio, start_time, end_time, notes in rows
+    )
+
+@app.route("/export/entries.csv")
+@app.route("/export/entries.csv.gz")
+def export_entries_stream():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    
+    if session.get("role") not in ["admin", "director", "chief_technologist"]:
+        return "Доступ запрещен", 403
+    
+    return csv_response(*entries_csv_rows(request.args), "entries")
+
+def entries_csv_rows(args):
+    """Заголовок и строки CSV записей заливки"""
+    rows = export_entries_query(args).with_entities(
+        Entry.id, Entry.date, Entry.time, Entry.shift, User.fio,
+        *(getattr(Entry, column) for column, _, _ in ENTRY_MATERIALS)
+    ).order_by(Entry.recorded_at.desc()).yield_per(EXPORT_FETCH_SIZE)
+    
+    header = ['id', 'date', 'time', 'shift', 'operator'] + [column for column, _, _ in ENTRY_MATERIALS]
+    return header, (
+        (entry_id, day.isoformat(), entry_time, shift, fio, *materials)
+        for entry_id, day, entry_time, shift, fio, *materials in rows
+    )
+
+@app.route("/export/analytics.csv")
+@app.route("/export/analytics.csv.gz")
+def export_analytics_stream():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    
+    if session.get("role") not in ["admin", "director", "chief_technologist"]:
+        return "Доступ запрещен", 403
+    
+    return csv_response(*analytics_csv_rows(request.args), "analytics")
+
+def analytics_csv_rows(args):
+    """Количество партий по типу и статусу за период - одним GROUP BY"""
+    rows = db.session.query(
+        Batch.batch_type, Batch.status, db.func.count(Batch.id)
+    ).filter(
+        *date_range_filter(Batch.start_time, parse_date(args.get('date_from')), parse_date(args.get('date_to')))
+    ).group_by(Batch.batch_type, Batch.status).order_by(Batch.batch_type, Batch.status)
+    
+    return ['batch_type', 'status', 'count'], rows
+
+def write_csv_file(path, header, rows, compress=False):
+    """Записывает CSV (или csv.gz) в файл, возвращает количество строк"""
+    count = 0
+    
+    def counted():
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+    
+    with open(path, "wb") as file:
+        for chunk in iter_csv(header, counted(), compress):
+            file.write(chunk)
+    return count
+
+# === ФОНОВЫЕ ВЫГРУЗКИ ===
+# POST /export/jobs создает задачу, файл строится в пуле потоков (export_jobs.py),
+# клиент опрашивает /export/jobs/<id> и скачивает /export/jobs/<id>/download.
+app.config["EXPORT_DIR"] = os.environ.get("EXPORT_DIR") or os.path.join(app.instance_path, "exports")
+export_queue = ExportQueue(
+    max_workers=int(os.environ.get("EXPORT_WORKERS", 2)),
+    ttl_seconds=int(os.environ.get("EXPORT_JOB_TTL", 3600))
+)
+export_queue.init_app(app)
+
+BATCH_EXPORT_FILTERS = ("date_from", "date_to", "batch_type", "status", "product", "equipment")
+ENTRY_EXPORT_FILTERS = ("date_from", "date_to", "shift")
+ANALYTICS_EXPORT_FILTERS = ("date_from", "date_to")
+
+def save_analytics_workbook(args, path):
+    build_analytics_workbook(args).save(path)
+
+# Построители файлов: (фильтры, путь) -> количество строк
+export_queue.register("batches", "xlsx", lambda args, path: write_xlsx(path, *batches_xlsx_sheet(args)), BATCH_EXPORT_FILTERS)
+export_queue.register("batches", "csv", lambda args, path: write_csv_file(path, *batches_csv_rows(args)), BATCH_EXPORT_FILTERS)
+export_queue.register("batches", "csv.gz", lambda args, path: write_csv_file(path, *batches_csv_rows(args), compress=True), BATCH_EXPORT_FILTERS)
+export_queue.register("entries", "xlsx", lambda args, path: write_xlsx(path, *entries_xlsx_sheet(args)), ENTRY_EXPORT_FILTERS)
+export_queue.register("entries", "csv", lambda args, path: write_csv_file(path, *entries_csv_rows(args)), ENTRY_EXPORT_FILTERS)
+export_queue.register("entries", "csv.gz", lambda args, path: write_csv_file(path, *entries_csv_rows(args), compress=True), ENTRY_EXPORT_FILTERS)
+export_queue.register("analytics", "xlsx", save_analytics_workbook, ANALYTICS_EXPORT_FILTERS)
+export_queue.register("analytics", "csv", lambda args, path: write_csv_file(path, *analytics_csv_rows(args)), ANALYTICS_EXPORT_FILTERS)
+export_queue.register("analytics", "csv.gz", lambda args, path: write_csv_file(path, *analytics_csv_rows(args), compress=True), ANALYTICS_EXPORT_FILTERS)
+
+# Кэш готовых файлов синхронных выгрузок: ключ включает версии этих таблиц
+export_cache = ExportFileCache(
+    os.path.join(app.config["EXPORT_DIR"], "cache"),
+    max_files=int(os.environ.get("EXPORT_CACHE_FILES", 50))
+)
+
+EXPORT_TABLES = {
+    "batches": ("batch", "product", "equipment", "user"),
+    "entries": ("entry", "user"),
+    "analytics": ("batch", "user"),
+    "batch_materials": ("batch_material", "batch", "material", "user"),
+}
+
+EXPORT_MIMETYPES = {
+    "xlsx": XLSX_MIMETYPE,
+    "csv": "text/csv",
+    "csv.gz": "application/gzip",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+def cached_export_response(kind, fmt):
+    """Отдает выгрузку из кэша файлов (при промахе строит ее) с Content-Length и Range"""
+    params = export_queue.normalize(kind, fmt, request.args)
+    versions, _ = get_data_versions(EXPORT_TABLES[kind])
+    path = export_cache.get_or_build(kind, fmt, params, versions, export_queue.writers[(kind, fmt)])
+    return send_file(
+        path,
+        mimetype=EXPORT_MIMETYPES.get(fmt),
+        as_attachment=True,
+        download_name=f'{kind}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{fmt}',
+        conditional=True,
+        max_age=0
+    )
+
+def export_job_response(job, status_code=200):
+    data = job_status(job)
+    data["status_url"] = url_for("export_job_status", job_id=job.id)
+    if job.status == "done":
+        data["download_url"] = url_for("export_job_download", job_id=job.id)
+    return jsonify(data), status_code
+
+@app.route("/export/jobs", methods=["POST"])
+def create_export_job():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    
+    if session.get("role") not in ["admin", "director", "chief_technologist"]:
+        return "Доступ запрещен", 403
+    
+    # Параметры из формы или JSON: kind, format и фильтры той же выгрузки
+    params = request.get_json(silent=True) or request.form.to_dict() or request.args.to_dict()
+    kind = params.get("kind")
+    fmt = params.get("format", "xlsx")
+    if not export_queue.supports(kind, fmt):
+        return jsonify({"error": f"Неизвестная выгрузка: {kind} / {fmt}"}), 400
+    
+    job, created = export_queue.submit(kind, fmt, params, session["user_id"])
+    return export_job_response(job, 202 if created else 200)
+
+@app.route("/export/jobs/<job_id>")
+def export_job_status(job_id):
+    if session.get("role") not in ["admin", "director", "chief_technologist"]:
+        return jsonify({"error": "Доступ запрещен"}), 403
+    
+    return export_job_response(db.get_or_404(ExportJob, job_id))
+
+@app.route("/export/jobs/<job_id>/download")
+def export_job_download(job_id):
+    if session.get("role") not in ["admin", "director", "chief_technologist"]:
+        return redirect(url_for("login"))
+    
+    job = db.get_or_404(ExportJob, job_id)
+    if job.status != "done" or not job.file_path or not os.path.exists(job.file_path):
+        return "Файл выгрузки не готов или удален", 404
+    
+    return send_file(
+        job.file_path,
+        as_attachment=True,
+        download_name=f'{job.kind}_{job.created_at.strftime("%Y%m%d_%H%M%S")}.{job.format}'
+    )
+
+# === ВЫГРУЗКА В PARQUET ===
+# Типизированные таблицы для аналитиков (parquet_export.py): сортировка по id,
+# since_id - выгрузить только строки новее последнего id прошлой выгрузки.
+def since_id_filter(column, args):
+    try:
+        since_id = int(args.get("since_id") or 0)
+    except ValueError:
+        since_id = 0
+    return column > since_id
+
+def write_entries_parquet(args, path):
+    rows = export_entries_query(args).filter(since_id_filter(Entry.id, args)).with_entities(
+        Entry.id, Entry.date, Entry.time, Entry.recorded_at, Entry.shift, Entry.user_id, User.fio,
+        *(getattr(Entry, column) for column, _, _ in ENTRY_MATERIALS),
+        Entry.created_at
+    ).order_by(Entry.id).yield_per(EXPORT_FETCH_SIZE)
+    return write_parquet(path, ENTRY_SCHEMA, rows)
+
+def write_batches_parquet(args, path):
+    rows = export_batches_query(args).filter(since_id_filter(Batch.id, args)).outerjoin(
+        Product, Batch.product_id == Product.id
+    ).outerjoin(
+        Equipment, Batch.equipment_id == Equipment.id
+    ).with_entities(
+        Batch.id, Batch.batch_number, Batch.batch_type, Batch.status, Batch.shift,
+        Batch.product_id, Product.product_code, Product.name,
+        Batch.equipment_id, Equipment.name,
+        Batch.user_id, User.fio,
+        Batch.start_time, Batch.end_time, Batch.notes, Batch.created_at
+    ).order_by(Batch.id).yield_per(EXPORT_FETCH_SIZE)
+    return write_parquet(path, BATCH_SCHEMA, rows)
+
+def write_batch_materials_parquet(args, path):
+    # Фильтры партий (период, тип, статус...) применяются через JOIN с партией
+    rows = export_batches_query(args).join(
+        BatchMaterial, BatchMaterial.batch_id == Batch.id
+    ).join(
+        Material, BatchMaterial.material_id == Material.id
+    ).filter(since_id_filter(BatchMaterial.id, args)).with_entities(
+        BatchMaterial.id, BatchMaterial.batch_id, Batch.batch_number, Batch.batch_type, Batch.start_time,
+        BatchMaterial.material_id, Material.name, Material.unit, BatchMaterial.quantity
+    ).order_by(BatchMaterial.id).yield_per(EXPORT_FETCH_SIZE)
+    return write_parquet(path, BATCH_MATERIAL_SCHEMA, rows)
+
+if parquet_available():
+    export_queue.register("entries", "parquet", write_entries_parquet, ENTRY_EXPORT_FILTERS + ("since_id",))
+    export_queue.register("batches", "parquet", write_batches_parquet, BATCH_EXPORT_FILTERS + ("since_id",))
+    export_queue.register("batch_materials", "parquet", write_batch_materials_parquet, BATCH_EXPORT_FILTERS + ("since_id",))
+
+@app.route("/export/<kind>.parquet")
+def export_parquet(kind):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    
+    if session.get("role") not in ["admin", "director", "chief_technologist"]:
+        return "Доступ запрещен", 403
+    
+    if not parquet_available():
+        return "Выгрузка в Parquet недоступна: не установлен pyarrow", 501
+    
+    if not export_queue.supports(kind, "parquet"):
+        return "Неизвестная выгрузка", 404
+    
+    return cached_export_response(kind, "parquet")
+
 # === УПРАВЛЕНИЕ КЭШЕМ ===
 @app.route("/cache/clear")
 def clear_cache():
@@ -1778,12 +3346,7 @@ def cache_status():
     if user_role not in ["admin", "director", "chief_technologist"]:
         return "Доступ запрещен", 403
     
-    status = {
-        "cache_size": len(cache.cache),
-        "cached_keys": list(cache.cache.keys()),
-        "cache_ttl": {k: cache.cache_ttl.get(k, 0) - time.time() for k in cache.cache.keys()}
-    }
-    return jsonify(status)
+    return jsonify(cache.status())
 
 # === ОПТИМИЗИРОВАННЫЕ ФУНКЦИИ ДЛЯ КЭШИРОВАНИЯ ===
 def get_daily_analytics_data():
@@ -1792,12 +3355,12 @@ def get_daily_analytics_data():
     
     # Записи за сегодня
     today_entries = db.session.query(Entry, User).join(User, Entry.user_id == User.id).filter(
-        Entry.date == today
+        *date_range_filter(Entry.recorded_at, today, today)
     ).all()
     
     # Партии за сегодня
     today_batches = db.session.query(Batch, User).join(User, Batch.user_id == User.id).filter(
-        db.func.date(Batch.start_time) == today
+        *date_range_filter(Batch.start_time, today, today)
     ).all()
     
     return {
@@ -1813,7 +3376,7 @@ def get_weekly_analytics_data():
     
     # Записи за неделю
     week_entries = db.session.query(Entry, User).join(User, Entry.user_id == User.id).filter(
-        Entry.date >= week_ago.date()
+        *date_range_filter(Entry.recorded_at, week_ago.date())
     ).all()
     
     # Партии за неделю
@@ -1828,86 +3391,20 @@ def get_weekly_analytics_data():
         "total_batches": len(week_batches)
     }
 
-def get_material_consumption_data():
-    """Получает данные о расходе материалов"""
-    # Материалы из Entry записей
-    entry_materials = db.session.query(
-        db.literal('entry').label('source'),
-        db.literal('casting').label('batch_type'),
-        db.literal('Цемент').label('material_name'),
-        db.literal('kg').label('unit'),
-        db.func.sum(Entry.cement).label('total_quantity')
-    ).group_by(db.literal(1)).union_all(
-        db.session.query(
-            db.literal('entry').label('source'),
-            db.literal('casting').label('batch_type'),
-            db.literal('Известь').label('material_name'),
-            db.literal('kg').label('unit'),
-            db.func.sum(Entry.lime).label('total_quantity')
-        ).group_by(db.literal(1))
-    ).union_all(
-        db.session.query(
-            db.literal('entry').label('source'),
-            db.literal('casting').label('batch_type'),
-            db.literal('Алюминиевая пудра').label('material_name'),
-            db.literal('kg').label('unit'),
-            db.func.sum(Entry.alum_powder).label('total_quantity')
-        ).group_by(db.literal(1))
-    ).union_all(
-        db.session.query(
-            db.literal('entry').label('source'),
-            db.literal('casting').label('batch_type'),
-            db.literal('Шлам').label('material_name'),
-            db.literal('l').label('unit'),
-            db.func.sum(Entry.sludge).label('total_quantity')
-        ).group_by(db.literal(1))
-    ).union_all(
-        db.session.query(
-            db.literal('entry').label('source'),
-            db.literal('casting').label('batch_type'),
-            db.literal('Гипс').label('material_name'),
-            db.literal('kg').label('unit'),
-            db.func.sum(Entry.gypsum).label('total_quantity')
-        ).group_by(db.literal(1))
-    ).union_all(
-        db.session.query(
-            db.literal('entry').label('source'),
-            db.literal('casting').label('batch_type'),
-            db.literal('Вода').label('material_name'),
-            db.literal('l').label('unit'),
-            db.func.sum(Entry.water).label('total_quantity')
-        ).group_by(db.literal(1))
-    ).union_all(
-        db.session.query(
-            db.literal('entry').label('source'),
-            db.literal('casting').label('batch_type'),
-            db.literal('Сульфанол').label('material_name'),
-            db.literal('l').label('unit'),
-            db.func.sum(Entry.sulfanol).label('total_quantity')
-        ).group_by(db.literal(1))
-    )
-
-    # Материалы из BatchMaterial
-    batch_materials = db.session.query(
-        db.literal('batch').label('source'),
-        Batch.batch_type,
-        Material.name.label('material_name'),
-        Material.unit,
-        db.func.sum(BatchMaterial.quantity).label('total_quantity')
-    ).join(
-        BatchMaterial, Batch.id == BatchMaterial.batch_id
-    ).join(
-        Material, BatchMaterial.material_id == Material.id
+def get_material_consumption_data(date_from=None, date_to=None):
+    """Получает данные о расходе материалов из суточных итогов (daily_material_rollup)"""
+    query = db.session.query(
+        DailyMaterialRollup.batch_type,
+        DailyMaterialRollup.material_name,
+        db.func.max(DailyMaterialRollup.unit),
+        db.func.sum(DailyMaterialRollup.quantity)
+    ).filter(
+        *date_range_filter(DailyMaterialRollup.date, date_from, date_to)
     ).group_by(
-        Batch.batch_type,
-        Material.name,
-        Material.unit
+        DailyMaterialRollup.batch_type,
+        DailyMaterialRollup.material_name
     )
 
-    # Объединяем все источники
-    all_materials_query = entry_materials.union_all(batch_materials)
-    all_materials_data = all_materials_query.all()
-
     # Структурируем данные
     materials_by_batch_type = {
         'casting': {},
@@ -1917,7 +3414,13 @@ def get_material_consumption_data():
 
     materials_total = {}
 
-    for source, batch_type, material_name, unit, total_qty in all_materials_data:
+    # Сначала материалы заливки в привычном порядке, затем остальные по алфавиту
+    entry_order = [material_name for _, material_name, _ in ENTRY_MATERIALS]
+    rows = sorted(query.all(), key=lambda row: (
+        entry_order.index(row[1]) if row[1] in entry_order else len(entry_order), row[1] or ''
+    ))
+
+    for batch_type, material_name, unit, total_qty in rows:
         if not material_name or not total_qty:
             continue
 
@@ -1927,25 +3430,179 @@ def get_material_consumption_data():
                 'unit': unit,
                 'quantity': 0
             }
-        materials_total[material_name]['quantity'] += float(total_qty) if total_qty else 0
+        materials_total[material_name]['quantity'] += float(total_qty)
 
         # Добавляем в словарь по типам партий
         if batch_type and batch_type in materials_by_batch_type:
-            if material_name not in materials_by_batch_type[batch_type]:
-                materials_by_batch_type[batch_type][material_name] = {
-                    'unit': unit,
-                    'quantity': 0
-                }
-            materials_by_batch_type[batch_type][material_name]['quantity'] += float(total_qty) if total_qty else 0
+            materials_by_batch_type[batch_type][material_name] = {
+                'unit': unit,
+                'quantity': float(total_qty)
+            }
 
     return {
         "materials_by_batch_type": materials_by_batch_type,
         "materials_total": materials_total
     }
 
+# === ВРЕМЕННЫЕ РЯДЫ РАСХОДА ===
+# Смена, день, неделя и месяц считаются по суточным итогам daily_material_rollup
+# (строк столько, сколько дней x смен x материалов, а не записей). Часы в итогах
+# не хранятся, поэтому ряд по часам - GROUP BY по журналу material_ledger за период,
+# и период для него ограничен TIMESERIES_MAX_HOUR_DAYS.
+TIMESERIES_BUCKETS = ("hour", "shift", "day", "week", "month")
+TIMESERIES_BATCH_TYPE_ORDER = ("casting", "cutting", "autoclave")
+TIMESERIES_MAX_HOUR_DAYS = 93
+
+def timeseries_rollup_label(bucket):
+    day = DailyMaterialRollup.date
+    if bucket == "shift":
+        return db.func.strftime("%Y-%m-%d", day) + db.literal(" ") + DailyMaterialRollup.shift
+    if bucket == "week":
+        return db.func.date(day, "weekday 0", "-6 days")  # понедельник недели
+    if bucket == "month":
+        return db.func.strftime("%Y-%m", day)
+    return db.func.strftime("%Y-%m-%d", day)
+
+def timeseries_bucket_labels(bucket, date_from, date_to):
+    """Все метки корзин периода по порядку (для смен метки берутся из данных)"""
+    labels = []
+    if bucket == "hour":
+        day = date_from
+        while day <= date_to:
+            labels.extend(f"{day.isoformat()} {hour:02d}" for hour in range(24))
+            day += timedelta(days=1)
+    elif bucket == "day":
+        labels = [(date_from + timedelta(days=offset)).isoformat() for offset in range((date_to - date_from).days + 1)]
+    elif bucket == "week":
+        week = date_from - timedelta(days=date_from.weekday())
+        while week <= date_to:
+            labels.append(week.isoformat())
+            week += timedelta(days=7)
+    elif bucket == "month":
+        month = date_from.replace(day=1)
+        while month <= date_to:
+            labels.append(month.strftime("%Y-%m"))
+            month = month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+    return labels
+
+def timeseries_rollup_rows(bucket, date_from, date_to):
+    label = timeseries_rollup_label(bucket)
+    return db.session.query(
+        label,
+        DailyMaterialRollup.batch_type,
+        DailyMaterialRollup.material_name,
+        db.func.max(DailyMaterialRollup.unit),
+        db.func.sum(DailyMaterialRollup.quantity)
+    ).filter(
+        *date_range_filter(DailyMaterialRollup.date, date_from, date_to)
+    ).group_by(
+        label, DailyMaterialRollup.batch_type, DailyMaterialRollup.material_name
+    ).all()
+
+def timeseries_hourly_rows(date_from, date_to):
+    # Заливка и материалы партий - одна агрегация по журналу расхода
+    label = db.func.strftime("%Y-%m-%d %H", MaterialLedger.recorded_at)
+    return db.session.query(
+        label,
+        MaterialLedger.batch_type,
+        Material.name,
+        db.func.max(Material.unit),
+        db.func.sum(MaterialLedger.quantity)
+    ).join(
+        Material, MaterialLedger.material_id == Material.id
+    ).filter(
+        *date_range_filter(MaterialLedger.recorded_at, date_from, date_to)
+    ).group_by(label, MaterialLedger.batch_type, Material.name).all()
+
+def timeseries_series_order(key):
+    batch_type, material_name = key
+    entry_order = [name for _, name, _ in ENTRY_MATERIALS]
+    return (
+        TIMESERIES_BATCH_TYPE_ORDER.index(batch_type) if batch_type in TIMESERIES_BATCH_TYPE_ORDER else len(TIMESERIES_BATCH_TYPE_ORDER),
+        batch_type or "",
+        entry_order.index(material_name) if material_name in entry_order else len(entry_order),
+        material_name or "",
+    )
+
+def material_timeseries(bucket, date_from, date_to):
+    """Ряды расхода по корзинам bucket за период [date_from, date_to] в колоночном виде"""
+    rows = timeseries_hourly_rows(date_from, date_to) if bucket == "hour" else timeseries_rollup_rows(bucket, date_from, date_to)
+
+    labels = timeseries_bucket_labels(bucket, date_from, date_to)
+    if bucket == "shift":
+        labels = sorted({row[0] for row in rows})
+    positions = {label: index for index, label in enumerate(labels)}
+
+    series = {}
+    for label, batch_type, material_name, unit, total in rows:
+        if not total or label not in positions:
+            continue
+        key = (batch_type, material_name)
+        if key not in series:
+            series[key] = {"batch_type": batch_type, "material": material_name, "unit": unit, "values": [0.0] * len(labels)}
+        series[key]["values"][positions[label]] += float(total)
+
+    ordered = [series[key] for key in sorted(series, key=timeseries_series_order)]
+    for item in ordered:
+        item["values"] = [round(value, 3) for value in item["values"]]
+
+    return {
+        "bucket": bucket,
+        "date_from": date_from.isoformat(),
+        "date_to": date_to.isoformat(),
+        "labels": labels,
+        "series": ordered,
+    }
+
+def downsample_timeseries(data, points):
+    """Копия рядов, прореженная LTTB до points меток (общих для всех рядов)"""
+    labels = data["labels"]
+    if not data["series"] or len(labels) <= points:
+        return data
+    keep = lttb_indices(range(len(labels)), [item["values"] for item in data["series"]], points)
+    return {
+        **data,
+        "labels": [labels[index] for index in keep],
+        "series": [{**item, "values": [item["values"][index] for index in keep]} for item in data["series"]],
+        "downsampled": True,
+        "source_points": len(labels),
+    }
+
+@app.route("/analytics/timeseries")
+@conditional_on_data("entry", "batch", "batch_material", "material")
+def analytics_timeseries():
+    """Ряды расхода материалов: ?bucket=hour|shift|day|week|month&date_from=...&date_to=...[&points=N]"""
+    if session.get("role") not in ["director", "chief_technologist"]:
+        return jsonify({"error": "Доступ запрещен"}), 403
+    
+    bucket = request.args.get("bucket", "day")
+    date_from = parse_date(request.args.get("date_from"))
+    date_to = parse_date(request.args.get("date_to"))
+    if bucket not in TIMESERIES_BUCKETS:
+        return jsonify({"error": f"bucket должен быть одним из: {', '.join(TIMESERIES_BUCKETS)}"}), 400
+    if not date_from or not date_to or date_from > date_to:
+        return jsonify({"error": "Нужен период date_from <= date_to в формате YYYY-MM-DD"}), 400
+    if bucket == "hour" and (date_to - date_from).days >= TIMESERIES_MAX_HOUR_DAYS:
+        return jsonify({"error": f"Для bucket=hour период не больше {TIMESERIES_MAX_HOUR_DAYS} дней"}), 400
+    
+    data = get_cached_data(
+        f"material_timeseries:{bucket}:{date_from}:{date_to}",
+        lambda: material_timeseries(bucket, date_from, date_to),
+        ttl_seconds=600,
+        scope=cache_scope(["entry", "batch", "batch_material", "material"], date_from, date_to)
+    )
+    # Прореживается уже закэшированный полный ряд, поэтому points не входит в ключ кэша
+    points = parse_points(request.args.get("points"))
+    if points:
+        data = downsample_timeseries(data, points)
+    return jsonify(data)
+
 if __name__ == "__main__":
+    from migrations import apply_migrations
+
     with app.app_context():
         db.create_all()
+        apply_migrations()
     
     # Для Railway и продакшена
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Прореживание рядов для графиков (Largest-Triangle-Three-Buckets, NumPy).
+
+Ряды на графиках дашборда делят одну ось X (метки дат), поэтому точки
+выбираются общие для всех рядов: в каждой корзине берется точка с
+наибольшей суммарной площадью треугольников по всем рядам. Ряды заранее
+нормируются к [0, 1], чтобы крупные значения (вода) не заглушали мелкие
+(алюминиевая пудра). Пики и провалы любого ряда дают большую площадь и
+поэтому сохраняются. Внутри корзины расчет векторный, цикл - только по корзинам.
+"""
+
+import numpy as np
+
+MIN_POINTS = 3
+
+def lttb_indices(x, ys, threshold):
+    """Индексы выбранных точек (по возрастанию) для оси x и рядов ys (ряды x точки).
+
+    Первая и последняя точки сохраняются всегда. Если точек не больше
+    threshold, возвращаются все индексы.
+    """
+    x = np.asarray(x, dtype=float)
+    ys = np.atleast_2d(np.asarray(ys, dtype=float))
+    count = x.size
+    if threshold >= count or threshold < MIN_POINTS:
+        return np.arange(count)
+
+    low = ys.min(axis=1, keepdims=True)
+    span = ys.max(axis=1, keepdims=True) - low
+    span[span == 0] = 1
+    ys = (ys - low) / span
+    x_span = (x[-1] - x[0]) or 1
+    x = (x - x[0]) / x_span
+
+    # Внутренние точки 1..count-2 делятся на threshold-2 корзины
+    edges = np.linspace(1, count - 1, threshold - 1).astype(int)
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = count - 1
+
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < edges.size:
+            next_start, next_end = edges[bucket + 1], edges[bucket + 2]
+        else:
+            next_start, next_end = count - 1, count  # за последней корзиной - последняя точка
+
+        average_x = x[next_start:next_end].mean()
+        average_y = ys[:, next_start:next_end].mean(axis=1, keepdims=True)
+        previous_x = x[previous]
+        previous_y = ys[:, [previous]]
+
+        areas = np.abs(
+            (previous_x - average_x) * (ys[:, start:end] - previous_y)
+            - (previous_x - x[start:end]) * (average_y - previous_y)
+        ).sum(axis=0)
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+
+    return selected
+
+def parse_points(value, maximum=5000):
+    """Целевое число точек из параметра запроса: None, если прореживание не нужно"""
+    try:
+        points = int(value)
+    except (TypeError, ValueError):
+        return None
+    if points < MIN_POINTS:
+        return None
+    return min(points, maximum)
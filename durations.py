@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Статистика длительности циклов резки и автоклава (NumPy).
+
+Средняя длительность сильно искажается забытыми циклами, которые остановили
+через сутки-другие, поэтому для планирования такта нужны перцентили:
+p50 - типичный цикл, p90/p99 - запас на медленные. База отдает только
+компактные колонки (тип, оборудование, продукт, минуты), дальше все
+считается векторно над массивами: перцентили, гистограмма и разбивка по
+оборудованию и продукту (сортировка по ключу группы и разрезание массива).
+
+Гистограмма строится до p99, все длиннее попадает в overflow - один
+забытый цикл не растягивает шкалу. Незавершенные партии (без end_time)
+в длительностях не участвуют и считаются отдельно как open_cycles.
+"""
+
+import numpy as np
+
+from models import db, Batch
+
+DURATION_BATCH_TYPES = ("cutting", "autoclave")
+PERCENTILES = (50, 90, 99)
+HISTOGRAM_BINS = 20
+MAX_HISTOGRAM_BINS = 200
+NO_GROUP = -1  # партия без оборудования или продукта
+DURATION_DECIMALS = 3  # точность минут (~0.06 с)
+
+BATCH_DURATION_MINUTES = (db.func.julianday(Batch.end_time) - db.func.julianday(Batch.start_time)) * 1440.0
+
+def duration_samples(date_filter, batch_type):
+    """Массивы (минуты, id оборудования, id продукта) завершенных партий типа за период.
+
+    date_filter(колонка) возвращает условия периода (см. date_range_filter в app.py).
+    """
+    rows = db.session.query(
+        BATCH_DURATION_MINUTES,
+        db.func.coalesce(Batch.equipment_id, NO_GROUP),
+        db.func.coalesce(Batch.product_id, NO_GROUP)
+    ).filter(
+        Batch.batch_type == batch_type,
+        Batch.status == "completed",
+        Batch.end_time.isnot(None),
+        Batch.end_time >= Batch.start_time,
+        *date_filter(Batch.start_time)
+    ).all()
+
+    samples = np.array(rows, dtype=float).reshape(-1, 3)
+    # Разность julianday дает погрешность в миллисекунды (20 мин -> 19.99999) - округляем
+    minutes = np.round(samples[:, 0], DURATION_DECIMALS)
+    return minutes, samples[:, 1].astype(np.int64), samples[:, 2].astype(np.int64)
+
+def open_cycles(date_filter, batch_type):
+    """Число незавершенных циклов типа за период"""
+    return db.session.query(db.func.count(Batch.id)).filter(
+        Batch.batch_type == batch_type,
+        Batch.end_time.is_(None),
+        Batch.status.in_(("active", "inactive")),
+        *date_filter(Batch.start_time)
+    ).scalar()
+
+def summarize(minutes):
+    """Число, среднее, минимум, максимум и перцентили длительности (в минутах)"""
+    if not minutes.size:
+        return {"count": 0, "mean": None, "min": None, "max": None, **{f"p{p}": None for p in PERCENTILES}}
+    values = np.percentile(minutes, PERCENTILES)
+    return {
+        "count": int(minutes.size),
+        "mean": float(minutes.mean()),
+        "min": float(minutes.min()),
+        "max": float(minutes.max()),
+        **{f"p{p}": float(value) for p, value in zip(PERCENTILES, values)},
+    }
+
+def histogram(minutes, bins=HISTOGRAM_BINS):
+    """Гистограмма от 0 до p99 и число циклов длиннее p99"""
+    if not minutes.size:
+        return {"edges": [], "counts": [], "overflow": 0}
+    upper = float(np.percentile(minutes, PERCENTILES[-1])) or float(minutes.max()) or 1.0
+    counts, edges = np.histogram(minutes, bins=bins, range=(0.0, upper))
+    return {
+        "edges": [round(float(edge), 2) for edge in edges],
+        "counts": counts.tolist(),
+        "overflow": int(np.count_nonzero(minutes > upper)),
+    }
+
+def breakdown(minutes, keys, names):
+    """Статистика по группам (оборудование или продукт): сортировка по ключу и разрезание массива"""
+    if not minutes.size:
+        return []
+    order = np.argsort(keys, kind="stable")
+    keys, minutes = keys[order], minutes[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+    groups = []
+    for key, part in zip(keys[starts], np.split(minutes, starts[1:])):
+        group_id = None if key == NO_GROUP else int(key)
+        groups.append({"id": group_id, "name": names.get(group_id), **summarize(part)})
+    groups.sort(key=lambda group: group["count"], reverse=True)
+    return groups
+
+def duration_stats(date_filter, batch_types=DURATION_BATCH_TYPES, bins=HISTOGRAM_BINS, equipment_names=None, product_names=None):
+    """Перцентили, гистограмма и разбивка длительности по типам партий"""
+    result = {}
+    for batch_type in batch_types:
+        minutes, equipment_ids, product_ids = duration_samples(date_filter, batch_type)
+        result[batch_type] = {
+            **summarize(minutes),
+            "open_cycles": open_cycles(date_filter, batch_type),
+            "histogram": histogram(minutes, bins),
+            "by_equipment": breakdown(minutes, equipment_ids, equipment_names or {}),
+            "by_product": breakdown(minutes, product_ids, product_names or {}),
+        }
+    return result
+
+def parse_bins(value):
+    """Число корзин гистограммы из параметра запроса"""
+    try:
+        bins = int(value)
+    except (TypeError, ValueError):
+        return HISTOGRAM_BINS
+    return min(max(bins, 1), MAX_HISTOGRAM_BINS)
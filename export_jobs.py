@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Очередь фоновых выгрузок (таблица export_job).
+
+Запрос только создает задачу, файл строится в пуле потоков текущего воркера
+и сохраняется в instance/exports, так что тяжелая выгрузка не занимает
+воркер, принимающий записи операторов. Клиент опрашивает статус задачи и
+скачивает готовый файл.
+
+Одинаковые незавершенные задачи (тот же вид, формат и фильтры) не
+дублируются - в том числе между воркерами gunicorn, за это отвечает частичный
+уникальный индекс uq_export_job_in_flight. Готовые файлы хранятся
+EXPORT_JOB_TTL секунд и удаляются при очистке.
+
+ExportFileCache хранит файлы синхронных выгрузок: повторная выгрузка с теми же
+фильтрами отдается готовым файлом, пока не изменились данные.
+
+Запуск как скрипта удаляет просроченные файлы задач и кэша (например, из cron):
+    python export_jobs.py
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, ExportJob
+
+IN_FLIGHT = ("queued", "running")
+
+class ExportQueue:
+    """Пул фоновых выгрузок процесса и реестр построителей файлов"""
+    def __init__(self, max_workers=2, ttl_seconds=3600, stale_seconds=3600, cleanup_interval=60):
+        self.max_workers = max_workers
+        self.ttl_seconds = ttl_seconds  # сколько хранится готовый файл
+        self.stale_seconds = stale_seconds  # задача дольше этого считается прерванной (воркер перезапущен)
+        self.cleanup_interval = cleanup_interval
+        self.writers = {}  # (вид, формат) -> функция (фильтры, путь) -> число строк
+        self.filters = {}  # (вид, формат) -> допустимые параметры фильтра
+        self.app = None
+        self.directory = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._last_cleanup = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.directory = app.config.get("EXPORT_DIR") or os.path.join(app.instance_path, "exports")
+
+    def register(self, kind, fmt, writer, filters):
+        """Регистрирует построитель файла вида kind в формате fmt"""
+        self.writers[(kind, fmt)] = writer
+        self.filters[(kind, fmt)] = tuple(filters)
+
+    def supports(self, kind, fmt):
+        return (kind, fmt) in self.writers
+
+    def normalize(self, kind, fmt, args):
+        """Оставляет только фильтры этой выгрузки; пустое значение и 'all' - то же, что отсутствие"""
+        return {
+            name: args.get(name)
+            for name in self.filters[(kind, fmt)]
+            if args.get(name) not in (None, "", "all")
+        }
+
+    @staticmethod
+    def params_key(kind, fmt, params):
+        payload = json.dumps([kind, fmt, params], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def _executor_instance(self):
+        # Пул создается лениво - после fork воркера gunicorn, а не в мастер-процессе
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="export")
+            return self._executor
+
+    def submit(self, kind, fmt, args, user_id=None):
+        """Создает задачу или возвращает уже идущую с теми же параметрами: (задача, создана ли)"""
+        self.cleanup()
+        params = self.normalize(kind, fmt, args)
+        key = self.params_key(kind, fmt, params)
+
+        existing = ExportJob.query.filter(ExportJob.params_key == key, ExportJob.status.in_(IN_FLIGHT)).first()
+        if existing:
+            return existing, False
+
+        job = ExportJob(
+            id=uuid.uuid4().hex,
+            kind=kind,
+            format=fmt,
+            params=json.dumps(params, sort_keys=True, ensure_ascii=False),
+            params_key=key,
+            status="queued",
+            created_by=user_id
+        )
+        db.session.add(job)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Такую же задачу только что создал другой воркер
+            db.session.rollback()
+            return ExportJob.query.filter(ExportJob.params_key == key, ExportJob.status.in_(IN_FLIGHT)).first(), False
+
+        self._executor_instance().submit(self._run, job.id)
+        return job, True
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            job = db.session.get(ExportJob, job_id)
+            job.status = "running"
+            job.started_at = datetime.now()
+            db.session.commit()
+
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{job.id}.{job.format}")
+            try:
+                rows = self.writers[(job.kind, job.format)](json.loads(job.params), path)
+            except Exception as e:
+                db.session.rollback()
+                if os.path.exists(path):
+                    os.remove(path)
+                job = db.session.get(ExportJob, job_id)
+                job.status = "failed"
+                job.error = str(e)
+                self.app.logger.exception("Ошибка фоновой выгрузки %s", job_id)
+            else:
+                job.status = "done"
+                job.file_path = path
+                job.file_size = os.path.getsize(path)
+                job.rows = rows
+            job.finished_at = datetime.now()
+            job.expires_at = job.finished_at + timedelta(seconds=self.ttl_seconds)
+            db.session.commit()
+
+    def cleanup(self, force=False):
+        """Удаляет просроченные файлы и задачи, прерванные задачи помечает ошибкой.
+
+        Вызывается при создании задач не чаще раза в cleanup_interval секунд.
+        """
+        now = time.time()
+        if not force and now - self._last_cleanup < self.cleanup_interval:
+            return 0
+        self._last_cleanup = now
+
+        current = datetime.now()
+        expired = ExportJob.query.filter(ExportJob.expires_at < current).all()
+        for job in expired:
+            if job.file_path and os.path.exists(job.file_path):
+                os.remove(job.file_path)
+            db.session.delete(job)
+
+        stale_before = current - timedelta(seconds=self.stale_seconds)
+        for job in ExportJob.query.filter(ExportJob.status.in_(IN_FLIGHT), ExportJob.created_at < stale_before):
+            job.status = "failed"
+            job.error = "Выгрузка прервана"
+            job.finished_at = current
+            job.expires_at = current + timedelta(seconds=self.ttl_seconds)
+
+        db.session.commit()
+        return len(expired)
+
+class ExportFileCache:
+    """Готовые файлы выгрузок на диске по ключу (вид, формат, фильтры, версии данных).
+
+    Версии таблиц входят в ключ, поэтому после изменения данных ключ меняется
+    и файл строится заново, а старые файлы вытесняются по количеству и возрасту.
+    Файл сначала пишется во временный и затем атомарно переименовывается, так
+    что параллельные воркеры никогда не отдадут недописанный файл.
+    """
+    def __init__(self, directory, max_files=50, max_age_seconds=86400):
+        self.directory = directory
+        self.max_files = max_files
+        self.max_age_seconds = max_age_seconds
+
+    def path_for(self, kind, fmt, params, versions):
+        payload = json.dumps([kind, fmt, params, versions], sort_keys=True, ensure_ascii=False)
+        digest = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{kind}_{digest}.{fmt}")
+
+    def get_or_build(self, kind, fmt, params, versions, writer):
+        """Путь к готовому файлу; при промахе строит его writer(фильтры, путь)"""
+        path = self.path_for(kind, fmt, params, versions)
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            writer(params, temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.prune()
+        return path
+
+    def prune(self):
+        """Оставляет max_files самых новых файлов моложе max_age_seconds"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        files = []
+        for name in names:
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                files.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                continue  # уже удален другим воркером
+        files.sort(reverse=True)
+
+        oldest_allowed = time.time() - self.max_age_seconds
+        removed = 0
+        for index, (modified, path) in enumerate(files):
+            if index >= self.max_files or modified < oldest_allowed:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+def job_status(job):
+    """Состояние задачи для JSON-ответа"""
+    def iso(value):
+        return value.isoformat() if value else None
+
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "format": job.format,
+        "params": json.loads(job.params),
+        "status": job.status,
+        "rows": job.rows,
+        "file_size": job.file_size,
+        "error": job.error,
+        "created_at": iso(job.created_at),
+        "started_at": iso(job.started_at),
+        "finished_at": iso(job.finished_at),
+        "expires_at": iso(job.expires_at),
+    }
+
+if __name__ == "__main__":
+    from app import app, export_cache, export_queue
+
+    with app.app_context():
+        removed = export_queue.cleanup(force=True)
+        removed += export_cache.prune()
+        print(f"🧹 Удалено просроченных выгрузок: {removed}")
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from app import app, db, Product, Equipment, Material, User
+from migrations import apply_migrations
 from werkzeug.security import generate_password_hash
 from datetime import datetime
 
@@ -10,8 +11,9 @@ def init_all_data():
         print("🚀 Инициализация всех данных...")
         print("=" * 50)
         
-        # Создаем таблицы
+        # Создаем таблицы и применяем миграции схемы
         db.create_all()
+        apply_migrations()
         print("✅ Таблицы созданы")
         
         # Проверяем и создаем продукты
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Журнал расхода материалов (таблица material_ledger).
+
+Заливка хранит расход в колонках Entry (cement, lime, ...), партии - строками
+BatchMaterial. Журнал сводит оба источника в один длинный формат: строка на
+материал записи с временем, сменой, типом партии и material_id. Любой расход
+за период - одна агрегация по диапазону индекса recorded_at, а новый материал
+не требует изменения схемы.
+
+Журнал обновляется в той же транзакции, что и исходные записи (обработчик
+after_flush в app.py вызывает sync_entries/sync_batches). Строки документа
+пересобираются целиком: удаляются и вставляются одним INSERT ... SELECT, а
+суточные итоги (material_rollup.py) получают разницу старых и новых строк.
+
+Запуск как скрипта заново заполняет журнал из Entry и BatchMaterial частями,
+не блокируя запись операторов надолго, и пересчитывает суточные итоги:
+    python material_ledger.py
+"""
+
+from models import db, Entry, Batch, BatchMaterial, Material, MaterialLedger
+from material_rollup import ENTRY_MATERIALS, apply_ledger_to_rollup, rebuild_material_rollup
+
+LEDGER_CHUNK_SIZE = 5000
+
+LEDGER_COLUMNS = ["source", "entry_id", "batch_id", "user_id", "recorded_at", "shift", "batch_type", "material_id", "quantity"]
+
+# Время заливки из date и time в формате DateTime SQLAlchemy - то же значение,
+# что и Entry.recorded_at. Колонку журнал не читает: миграция 5 заполняет его
+# раньше, чем миграция 6 добавляет entry.recorded_at.
+ENTRY_RECORDED_AT = db.type_coerce(
+    db.type_coerce(Entry.date, db.String) + " " + db.func.substr(Entry.time + ":00", 1, 8) + ".000000",
+    db.DateTime
+)
+
+def entry_ledger_select(condition):
+    """Строки журнала для записей заливки под условием: SELECT на каждую колонку материала"""
+    # Название материала в справочнике не уникально - берется первый материал с этим названием
+    materials = db.select(Material.name, db.func.min(Material.id).label("id")).group_by(Material.name).subquery()
+    return db.union_all(*[
+        db.select(
+            db.literal("entry"),
+            Entry.id,
+            db.null(),
+            Entry.user_id,
+            ENTRY_RECORDED_AT,
+            Entry.shift,
+            db.literal("casting"),
+            materials.c.id,
+            getattr(Entry, column)
+        ).join(
+            materials, materials.c.name == material_name
+        ).where(condition, getattr(Entry, column) != 0)
+        for column, material_name, _ in ENTRY_MATERIALS
+    ])
+
+def batch_ledger_select(condition):
+    """Строки журнала для материалов партий под условием"""
+    return db.select(
+        db.literal("batch"),
+        db.null(),
+        Batch.id,
+        Batch.user_id,
+        Batch.start_time,
+        Batch.shift,
+        Batch.batch_type,
+        BatchMaterial.material_id,
+        BatchMaterial.quantity
+    ).join(
+        Batch, BatchMaterial.batch_id == Batch.id
+    ).where(condition, BatchMaterial.quantity != 0)
+
+def sync_entries(connection, entry_ids, rollup=True):
+    """Пересобирает строки журнала записей заливки (удаленные записи просто исчезают).
+
+    rollup - снять старые строки из суточных итогов и добавить новые.
+    """
+    if not entry_ids:
+        return
+    entry_ids = sorted(entry_ids)
+    ledger_rows = MaterialLedger.entry_id.in_(entry_ids)
+    if rollup:
+        apply_ledger_to_rollup(connection, ledger_rows, sign=-1)
+    connection.execute(db.delete(MaterialLedger).where(ledger_rows))
+    connection.execute(db.insert(MaterialLedger).from_select(LEDGER_COLUMNS, entry_ledger_select(Entry.id.in_(entry_ids))))
+    if rollup:
+        apply_ledger_to_rollup(connection, ledger_rows)
+
+def sync_batches(connection, batch_ids, rollup=True):
+    """Пересобирает строки журнала партий: материалы, время начала, смена и тип"""
+    if not batch_ids:
+        return
+    batch_ids = sorted(batch_ids)
+    ledger_rows = MaterialLedger.batch_id.in_(batch_ids)
+    if rollup:
+        apply_ledger_to_rollup(connection, ledger_rows, sign=-1)
+    connection.execute(db.delete(MaterialLedger).where(ledger_rows))
+    connection.execute(db.insert(MaterialLedger).from_select(LEDGER_COLUMNS, batch_ledger_select(Batch.id.in_(batch_ids))))
+    if rollup:
+        apply_ledger_to_rollup(connection, ledger_rows)
+
+def ensure_entry_materials():
+    """Создает справочные материалы для колонок Entry, если их нет (иначе строкам журнала не на что ссылаться)"""
+    existing = {name for (name,) in db.session.query(Material.name)}
+    for _, material_name, unit in ENTRY_MATERIALS:
+        if material_name not in existing:
+            db.session.add(Material(name=material_name, unit=unit, is_active=True))
+    db.session.commit()
+
+def backfill_material_ledger(chunk_size=LEDGER_CHUNK_SIZE):
+    """Заполняет журнал из Entry и BatchMaterial диапазонами id по chunk_size.
+
+    Каждый диапазон - отдельная короткая транзакция (удаление + вставка), так
+    что повторный запуск безопасен, а новые записи тем временем попадают в
+    журнал через обработчик after_flush. Суточные итоги здесь не меняются -
+    после заполнения их пересчитывает rebuild_material_rollup.
+    """
+    ensure_entry_materials()
+
+    for model, ledger_column, sync in ((Entry, MaterialLedger.entry_id, sync_entries), (Batch, MaterialLedger.batch_id, sync_batches)):
+        low, high = db.session.query(db.func.min(model.id), db.func.max(model.id)).one()
+        db.session.commit()
+        if low is None:
+            continue
+        for start in range(low, high + 1, chunk_size):
+            with db.engine.begin() as connection:
+                ids = connection.execute(
+                    db.select(model.id).where(model.id >= start, model.id < start + chunk_size)
+                ).scalars().all()
+                # Строки удаленных за это время документов тоже убираются
+                connection.execute(db.delete(MaterialLedger).where(ledger_column >= start, ledger_column < start + chunk_size))
+                sync(connection, ids, rollup=False)
+
+    return MaterialLedger.query.count()
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        print("🔄 Заполнение журнала расхода материалов...")
+        rows = backfill_material_ledger()
+        print(f"✅ Строк журнала: {rows}")
+        print(f"✅ Строк суточных итогов: {rebuild_material_rollup()}")
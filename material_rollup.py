@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Суточные итоги расхода материалов (таблица daily_material_rollup).
+
+Итоги обновляются вместе с журналом расхода (material_ledger.py) в той же
+транзакции, что и записи заливки и материалы партий, поэтому расход за любой
+период считается по нескольким тысячам строк итогов, а не по всей истории
+Entry и BatchMaterial.
+
+Запуск как скрипта полностью пересчитывает итоги по журналу расхода (material_ledger.py):
+    python material_rollup.py
+"""
+
+from sqlalchemy.dialects.sqlite import insert
+
+from models import db, Material, MaterialLedger, DailyMaterialRollup
+
+# Колонки материалов в Entry: (колонка, название материала, единица)
+ENTRY_MATERIALS = [
+    ("cement", "Цемент", "kg"),
+    ("lime", "Известь", "kg"),
+    ("alum_powder", "Алюминиевая пудра", "kg"),
+    ("sludge", "Шлам", "l"),
+    ("gypsum", "Гипс", "kg"),
+    ("water", "Вода", "l"),
+    ("sulfanol", "Сульфанол", "l"),
+]
+
+ROLLUP_COLUMNS = ["date", "shift", "batch_type", "material_name", "unit", "quantity", "count"]
+
+def ledger_rollup_select(condition, sign=1):
+    """Вклад строк журнала под условием в суточные итоги (sign=-1 - со знаком минус)"""
+    day = db.func.date(MaterialLedger.recorded_at)
+    return db.select(
+        day,
+        MaterialLedger.shift,
+        MaterialLedger.batch_type,
+        Material.name,
+        db.func.max(Material.unit),
+        sign * db.func.sum(MaterialLedger.quantity),
+        sign * db.func.count()
+    ).join(
+        Material, MaterialLedger.material_id == Material.id
+    ).where(
+        condition
+    ).group_by(
+        day, MaterialLedger.shift, MaterialLedger.batch_type, Material.name
+    )
+
+def apply_ledger_to_rollup(connection, condition, sign=1):
+    """Прибавляет (sign=1) или вычитает (sign=-1) строки журнала из суточных итогов.
+
+    Вызывается из sync_entries/sync_batches вокруг пересборки строк журнала, то
+    есть из обработчика after_flush в той же транзакции, что и исходная запись -
+    итоги не зависят от того, какой маршрут или скрипт изменил данные.
+    """
+    statement = insert(DailyMaterialRollup).from_select(ROLLUP_COLUMNS, ledger_rollup_select(condition, sign))
+    statement = statement.on_conflict_do_update(
+        index_elements=["date", "shift", "batch_type", "material_name"],
+        set_={
+            "quantity": DailyMaterialRollup.quantity + statement.excluded.quantity,
+            "count": DailyMaterialRollup.count + statement.excluded.count,
+        }
+    )
+    connection.execute(statement)
+
+def rebuild_material_rollup():
+    """Полностью пересчитывает итоги по журналу расхода material_ledger (для первичного заполнения)"""
+    DailyMaterialRollup.query.delete()
+    # Заливка из Entry и партии заливки попадают в одну строку итогов
+    db.session.execute(db.insert(DailyMaterialRollup).from_select(ROLLUP_COLUMNS, ledger_rollup_select(db.true())))
+    db.session.commit()
+    return DailyMaterialRollup.query.count()
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        print("🔄 Пересчет суточных итогов расхода материалов...")
+        rows = rebuild_material_rollup()
+        print(f"✅ Строк итогов: {rows}")
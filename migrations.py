@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Версионные миграции схемы базы данных.
+
+db.create_all() создает только отсутствующие таблицы и не трогает уже
+существующие, поэтому индексы и колонки для старых таблиц добавляются здесь.
+Каждая миграция применяется один раз, номер версии сохраняется в schema_migration.
+"""
+
+from sqlalchemy import inspect, text
+
+from models import db, SchemaMigration, DailyMaterialRollup, DataVersion, ExportJob, KpiSnapshot, MaterialLedger
+
+MIGRATIONS = []
+
+def migration(version, description):
+    """Регистрирует функцию миграции под номером версии"""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+def create_indexes(*names):
+    """Создает индексы из метаданных моделей по имени, если их еще нет"""
+    with db.engine.begin() as connection:
+        existing = set()
+        inspector = inspect(connection)
+        for table_name in inspector.get_table_names():
+            existing.update(index["name"] for index in inspector.get_indexes(table_name))
+
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in names and index.name not in existing:
+                    index.create(connection)
+
+@migration(1, "Составные индексы для Batch, Entry и BatchMaterial")
+def add_composite_indexes():
+    create_indexes(
+        "ix_batch_user_type_status_end",
+        "ix_batch_user_type_start",
+        "ix_batch_type_start",
+        "ix_batch_start_time",
+        "ix_batch_material_batch",
+        "ix_entry_date_shift",
+        "ix_entry_user_date_time",
+    )
+
+@migration(2, "Суточные итоги расхода материалов (daily_material_rollup)")
+def add_daily_material_rollup():
+    from material_rollup import rebuild_material_rollup
+
+    DailyMaterialRollup.__table__.create(db.engine, checkfirst=True)
+    rebuild_material_rollup()
+
+@migration(3, "Версии данных по таблицам для ETag (data_version)")
+def add_data_version():
+    DataVersion.__table__.create(db.engine, checkfirst=True)
+
+@migration(4, "Очередь фоновых выгрузок (export_job)")
+def add_export_job():
+    ExportJob.__table__.create(db.engine, checkfirst=True)
+
+@migration(5, "Журнал расхода материалов (material_ledger) с заполнением из Entry и BatchMaterial")
+def add_material_ledger():
+    from material_ledger import backfill_material_ledger
+    from material_rollup import rebuild_material_rollup
+
+    MaterialLedger.__table__.create(db.engine, checkfirst=True)
+    backfill_material_ledger()
+    rebuild_material_rollup()  # итоги теперь считаются по журналу
+
+@migration(6, "Колонка entry.recorded_at (дата и время записи) с индексами")
+def add_entry_recorded_at(chunk_size=5000):
+    """Добавляет и заполняет recorded_at диапазонами id; повторный вызов ничего не ломает"""
+    with db.engine.begin() as connection:
+        columns = {column["name"] for column in inspect(connection).get_columns("entry")}
+        if "recorded_at" not in columns:
+            connection.execute(text("ALTER TABLE entry ADD COLUMN recorded_at DATETIME"))
+        low, high = connection.execute(text("SELECT min(id), max(id) FROM entry")).one()
+
+    # Короткие транзакции, чтобы не блокировать запись операторов; формат - как у DateTime SQLAlchemy
+    for start in range(low or 0, (high or -1) + 1, chunk_size):
+        with db.engine.begin() as connection:
+            connection.execute(text(
+                "UPDATE entry SET recorded_at = date || ' ' || substr(time || '\\:00', 1, 8) || '.000000' "
+                "WHERE recorded_at IS NULL AND id >= :start AND id < :end"
+            ), {"start": start, "end": start + chunk_size})
+
+    create_indexes("ix_entry_recorded_at", "ix_entry_user_recorded_at")
+
+@migration(7, "Снимки KPI закрытых дней (kpi_snapshot)")
+def add_kpi_snapshot():
+    KpiSnapshot.__table__.create(db.engine, checkfirst=True)
+
+def apply_migrations():
+    """Применяет все еще не примененные миграции по порядку версий"""
+    db.create_all()
+    applied = {m.version for m in SchemaMigration.query.all()}
+
+    for version, description, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        func()
+        db.session.add(SchemaMigration(version=version, description=description))
+        db.session.commit()
+        print(f"✅ Миграция {version}: {description}")
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        print("🚀 Применение миграций схемы...")
+        apply_migrations()
+        print("🎉 Схема актуальна")
@@ -1,5 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from sqlalchemy import event
+from datetime import datetime, time
 
 db = SQLAlchemy()
 
@@ -31,6 +32,14 @@ class Batch(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
     updated_at = db.Column(db.DateTime, nullable=True)
     
+    # индексы под дашборды операторов и фильтры по периоду
+    __table_args__ = (
+        db.Index("ix_batch_user_type_status_end", "user_id", "batch_type", "status", "end_time"),
+        db.Index("ix_batch_user_type_start", "user_id", "batch_type", "start_time"),
+        db.Index("ix_batch_type_start", "batch_type", "start_time"),
+        db.Index("ix_batch_start_time", "start_time"),
+    )
+    
     # связи
     materials = db.relationship("BatchMaterial", backref="batch")
 
@@ -67,6 +76,10 @@ class BatchMaterial(db.Model):
     quantity = db.Column(db.Float, nullable=False)
     recorded_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
     
+    __table_args__ = (
+        db.Index("ix_batch_material_batch", "batch_id", "material_id"),
+    )
+    
     # связи
     material = db.relationship("Material", backref="batch_materials")
 
@@ -113,5 +126,116 @@ class Entry(db.Model):
     time = db.Column(db.String(10), nullable=False)
     shift = db.Column(db.String(50), nullable=False)
     date = db.Column(db.Date, nullable=False, default=datetime.now().date())
+    recorded_at = db.Column(db.DateTime, nullable=True)  # date + time, заполняется при записи (set_entry_recorded_at)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
     updated_at = db.Column(db.DateTime, nullable=True)
+
+    # индексы под фильтры по периоду, смене и оператору
+    __table_args__ = (
+        db.Index("ix_entry_date_shift", "date", "shift"),
+        db.Index("ix_entry_user_date_time", "user_id", "date", "time"),
+        db.Index("ix_entry_recorded_at", "recorded_at"),
+        db.Index("ix_entry_user_recorded_at", "user_id", "recorded_at"),
+    )
+
+@event.listens_for(Entry, "before_insert")
+@event.listens_for(Entry, "before_update")
+def set_entry_recorded_at(mapper, connection, entry):
+    """Держит recorded_at в соответствии с date и time (время - 'HH:MM' или 'HH:MM:SS')"""
+    if entry.date is None:
+        entry.date = datetime.now().date()
+    try:
+        entry_time = time.fromisoformat(entry.time)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Некорректное время записи заливки {entry.id}: {entry.time!r} (нужно ЧЧ:ММ или ЧЧ:ММ:СС)") from e
+    entry.recorded_at = datetime.combine(entry.date, entry_time)
+
+class SchemaMigration(db.Model):
+    """Примененные версии миграций схемы (см. migrations.py)"""
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+class DailyMaterialRollup(db.Model):
+    """Суточные итоги расхода материалов по смене и типу партии (см. material_rollup.py)"""
+    __tablename__ = "daily_material_rollup"
+
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False)
+    shift = db.Column(db.String(50), nullable=False)
+    batch_type = db.Column(db.String(20), nullable=False)  # casting, cutting, autoclave
+    material_name = db.Column(db.String(100), nullable=False)
+    unit = db.Column(db.String(20), nullable=False)
+    quantity = db.Column(db.Float, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)  # количество записей с ненулевым расходом
+
+    __table_args__ = (
+        db.UniqueConstraint("date", "shift", "batch_type", "material_name", name="uq_daily_material_rollup"),
+    )
+
+class MaterialLedger(db.Model):
+    """Журнал расхода: строка на материал записи заливки или партии (см. material_ledger.py)"""
+    __tablename__ = "material_ledger"
+
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String(10), nullable=False)  # entry, batch
+    entry_id = db.Column(db.Integer, db.ForeignKey("entry.id"), nullable=True)
+    batch_id = db.Column(db.Integer, db.ForeignKey("batch.id"), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)
+    recorded_at = db.Column(db.DateTime, nullable=False)  # время записи заливки или начала партии
+    shift = db.Column(db.String(50), nullable=False)
+    batch_type = db.Column(db.String(20), nullable=False)  # casting, cutting, autoclave
+    material_id = db.Column(db.Integer, db.ForeignKey("material.id"), nullable=False)
+    quantity = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_material_ledger_recorded", "recorded_at"),
+        db.Index("ix_material_ledger_material_recorded", "material_id", "recorded_at"),
+        db.Index("ix_material_ledger_entry", "entry_id"),
+        db.Index("ix_material_ledger_batch", "batch_id"),
+    )
+
+class KpiSnapshot(db.Model):
+    """Замороженные группы KPI закрытого дня в JSON (см. period_kpi_groups в app.py)"""
+    __tablename__ = "kpi_snapshot"
+
+    date = db.Column(db.Date, primary_key=True)
+    payload = db.Column(db.Text, nullable=False)  # группы заливки, партий и активность операторов
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+class DataVersion(db.Model):
+    """Счетчик изменений таблицы: увеличивается при каждой записи в нее (для ETag)"""
+    __tablename__ = "data_version"
+
+    table_name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+class ExportJob(db.Model):
+    """Фоновая выгрузка: параметры, состояние и готовый файл (см. export_jobs.py)"""
+    __tablename__ = "export_job"
+
+    id = db.Column(db.String(32), primary_key=True)  # uuid4().hex
+    kind = db.Column(db.String(20), nullable=False)  # batches, entries, analytics
+    format = db.Column(db.String(10), nullable=False)  # xlsx, csv, csv.gz
+    params = db.Column(db.Text, nullable=False)  # фильтры в JSON
+    params_key = db.Column(db.String(40), nullable=False)  # sha1 от вида, формата и фильтров
+    status = db.Column(db.String(20), nullable=False, default="queued")  # queued, running, done, failed
+    file_path = db.Column(db.String(500), nullable=True)
+    file_size = db.Column(db.Integer, nullable=True)
+    rows = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_by = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True)
+
+    # одна незавершенная задача на набор параметров - защита от дублей между воркерами
+    __table_args__ = (
+        db.Index(
+            "uq_export_job_in_flight", "params_key", unique=True,
+            sqlite_where=db.text("status IN ('queued', 'running')")
+        ),
+        db.Index("ix_export_job_expires", "expires_at"),
+    )
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Колоночная выгрузка в Parquet для аналитиков (Entry, Batch, BatchMaterial).
+
+Строки читаются из курсора и пишутся группами строк (row group) по
+PARQUET_ROW_GROUP_SIZE, поэтому в памяти одновременно находится только одна
+группа. Типы колонок сохраняются (даты, время, числа), в отличие от XLSX.
+
+pyarrow - необязательная зависимость: без него маршруты Parquet отвечают 501.
+    pip install pyarrow
+"""
+
+from itertools import islice
+
+from material_rollup import ENTRY_MATERIALS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - зависит от окружения
+    pa = pq = None
+
+PARQUET_ROW_GROUP_SIZE = 50000
+
+def parquet_available():
+    return pq is not None
+
+if pa is not None:
+    # Поля в том же порядке, что и колонки запросов в app.py
+    ENTRY_SCHEMA = pa.schema(
+        [
+            ("id", pa.int64()),
+            ("date", pa.date32()),
+            ("time", pa.string()),
+            ("recorded_at", pa.timestamp("us")),
+            ("shift", pa.string()),
+            ("user_id", pa.int64()),
+            ("operator", pa.string()),
+        ]
+        + [(column, pa.float64()) for column, _, _ in ENTRY_MATERIALS]
+        + [("created_at", pa.timestamp("us"))]
+    )
+
+    BATCH_SCHEMA = pa.schema([
+        ("id", pa.int64()),
+        ("batch_number", pa.string()),
+        ("batch_type", pa.string()),
+        ("status", pa.string()),
+        ("shift", pa.string()),
+        ("product_id", pa.int64()),
+        ("product_code", pa.string()),
+        ("product", pa.string()),
+        ("equipment_id", pa.int64()),
+        ("equipment", pa.string()),
+        ("user_id", pa.int64()),
+        ("operator", pa.string()),
+        ("start_time", pa.timestamp("us")),
+        ("end_time", pa.timestamp("us")),
+        ("notes", pa.string()),
+        ("created_at", pa.timestamp("us")),
+    ])
+
+    BATCH_MATERIAL_SCHEMA = pa.schema([
+        ("id", pa.int64()),
+        ("batch_id", pa.int64()),
+        ("batch_number", pa.string()),
+        ("batch_type", pa.string()),
+        ("batch_start_time", pa.timestamp("us")),
+        ("material_id", pa.int64()),
+        ("material", pa.string()),
+        ("unit", pa.string()),
+        ("quantity", pa.float64()),
+    ])
+else:
+    ENTRY_SCHEMA = BATCH_SCHEMA = BATCH_MATERIAL_SCHEMA = None
+
+def write_parquet(path, schema, rows, row_group_size=PARQUET_ROW_GROUP_SIZE):
+    """Пишет строки (кортежи в порядке полей schema) в файл группами строк.
+
+    Возвращает количество записанных строк; пустая выборка дает файл только со схемой.
+    """
+    rows = iter(rows)
+    count = 0
+    with pq.ParquetWriter(path, schema, compression="snappy") as writer:
+        while True:
+            chunk = list(islice(rows, row_group_size))
+            if not chunk:
+                break
+            columns = zip(*chunk)
+            table = pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                schema=schema
+            )
+            writer.write_table(table, row_group_size=row_group_size)
+            count += len(chunk)
+    return count
@@ -3,9 +3,55 @@
 Скрипт для тестирования расширенной системы управления заводом
 """
 
+from contextlib import contextmanager
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import event
+from werkzeug.http import http_date
 from werkzeug.security import generate_password_hash
-from models import db, User, Batch, Equipment, Material
-from app import app
+from models import db, User, Batch, BatchMaterial, DailyMaterialRollup, DataVersion, Entry, Equipment, ExportJob, KpiSnapshot, Material, MaterialLedger, Product
+from app import app, aggregate_batch_groups, aggregate_entry_groups, build_dashboard_kpis, cache, cache_scope, date_range_filter, get_cached_data, export_queue, LRUCache, reference_data
+
+# Бюджет SQL-запросов на один запрос к маршруту. Не должен зависеть от числа партий:
+# если новый шаблон начнет лениво читать связи в цикле, тест упадет.
+QUERY_BUDGETS = {
+    "/director_dashboard": 20,
+    "/batch_list": 6,
+    "/export/batches_csv": 4,
+}
+
+@contextmanager
+def count_queries():
+    """Считает SQL-запросы, выполненные внутри блока"""
+    counter = {"count": 0}
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        counter["count"] += 1
+
+    event.listen(db.engine, "before_cursor_execute", on_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(db.engine, "before_cursor_execute", on_execute)
+
+def explain_query_plan(query):
+    """Возвращает план SQLite (EXPLAIN QUERY PLAN) для запроса SQLAlchemy одной строкой"""
+    compiled = query.statement.compile(db.engine)
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    with db.engine.connect() as connection:
+        rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), params).all()
+    return " | ".join(row[-1] for row in rows)
+
+def login_as(client, role):
+    """Авторизует тестовый клиент пользователем с указанной ролью"""
+    user = User.query.filter_by(role=role).first()
+    with client.session_transaction() as sess:
+        sess["user_id"] = user.id
+        sess["role"] = user.role
+    return user
 
 def test_system():
     with app.app_context():
@@ -75,5 +121,1156 @@ def test_system():
         print("   • Инициализация справочников: /init_references")
         print("   • Аналитика: /director_dashboard")
 
+def test_query_budgets():
+    with app.app_context():
+        print("🧪 Проверка бюджета SQL-запросов маршрутов...")
+
+        director = User.query.filter_by(role="director").first()
+        product = Product.query.first()
+        equipment = Equipment.query.first()
+        materials = Material.query.limit(3).all()
+
+        # Несколько партий с материалами, чтобы N+1 был заметен
+        test_batches = []
+        for i in range(10):
+            batch = Batch(
+                user_id=director.id,
+                product_id=product.id if product else None,
+                equipment_id=equipment.id if equipment else None,
+                batch_number=f"QUERY-BUDGET-{i}",
+                batch_type=["casting", "cutting", "autoclave"][i % 3],
+                start_time=datetime.now()
+            )
+            db.session.add(batch)
+            db.session.flush()
+            for material in materials:
+                db.session.add(BatchMaterial(batch_id=batch.id, material_id=material.id, quantity=1.0))
+            test_batches.append(batch)
+        db.session.commit()
+
+        try:
+            client = app.test_client()
+            login_as(client, "director")
+            for route, budget in QUERY_BUDGETS.items():
+                # Бюджет - для запроса с пустым кэшем на воркере, где справочники уже загружены:
+                # результат не зависит от того, что прогрели тесты раньше
+                cache.clear()
+                with app.test_request_context():
+                    reference_data.products
+                with count_queries() as counter:
+                    response = client.get(route)
+                assert response.status_code == 200, route
+                assert counter["count"] <= budget, f"{route}: {counter['count']} запросов при бюджете {budget}"
+                print(f"✅ {route}: {counter['count']} запросов (бюджет {budget})")
+        finally:
+            for batch in test_batches:
+                BatchMaterial.query.filter_by(batch_id=batch.id).delete()
+                db.session.delete(batch)
+            db.session.commit()
+
+def test_eager_loading():
+    """Связи партий приходят вместе со списком: число запросов не растет с числом партий"""
+    from app import BATCH_LIST_LOADERS, BATCH_MATERIALS_LOADERS
+
+    with app.app_context():
+        director = User.query.filter_by(role="director").first()
+        products, equipment, materials = Product.query.all(), Equipment.query.all(), Material.query.limit(3).all()
+        client = app.test_client()
+        login_as(client, "director")
+        routes = ["/batch_list", "/export/batches_csv", "/director_dashboard"]
+
+        test_batches = []
+
+        def add_batches(count):
+            for i in range(len(test_batches), len(test_batches) + count):
+                batch = Batch(
+                    user_id=director.id,
+                    product_id=products[i % len(products)].id if products else None,
+                    equipment_id=equipment[i % len(equipment)].id if equipment else None,
+                    batch_number=f"EAGER-{i}",
+                    batch_type=["casting", "cutting", "autoclave"][i % 3],
+                    start_time=datetime.now()
+                )
+                db.session.add(batch)
+                db.session.flush()
+                for material in materials:
+                    db.session.add(BatchMaterial(batch_id=batch.id, material_id=material.id, quantity=1.0))
+                test_batches.append(batch)
+            db.session.commit()
+
+        def route_queries():
+            """Запросы повторного обращения: кэш счетчиков и справочников уже прогрет после коммита"""
+            counts = {}
+            for route in routes:
+                client.get(route)
+                with count_queries() as counter:
+                    assert client.get(route).status_code == 200, route
+                counts[route] = counter["count"]
+            return counts
+
+        try:
+            add_batches(3)
+            before = route_queries()
+            add_batches(9)
+            after = route_queries()
+            assert after == before, f"запросы растут с числом партий: {before} -> {after}"
+
+            # Обход загруженных партий не делает ленивых запросов
+            db.session.expire_all()
+            batches = Batch.query.options(*BATCH_LIST_LOADERS, *BATCH_MATERIALS_LOADERS).filter(
+                Batch.batch_number.like("EAGER-%")
+            ).all()
+            with count_queries() as counter:
+                for batch in batches:
+                    batch.product, batch.equipment
+                    [item.material.name for item in batch.materials]
+            assert len(batches) == 12 and counter["count"] == 0, f"{counter['count']} ленивых запросов"
+            print(f"✅ Жадная загрузка связей: {before}")
+        finally:
+            for batch in test_batches:
+                BatchMaterial.query.filter_by(batch_id=batch.id).delete()
+                db.session.delete(batch)
+            db.session.commit()
+
+def test_index_usage():
+    with app.app_context():
+        print("🧪 Проверка планов запросов (EXPLAIN QUERY PLAN)...")
+        today = datetime.now().date()
+        week_ago = today - timedelta(days=7)
+
+        plans = {
+            # Сегодняшние партии резчика (cutting_dashboard)
+            "ix_batch_user_type_start": Batch.query.filter_by(user_id=1, batch_type="cutting").filter(
+                *date_range_filter(Batch.start_time, today, today)
+            ).order_by(Batch.start_time.desc()),
+            # Завершенные партии оператора, новые сначала
+            "ix_batch_user_type_status_end": Batch.query.filter_by(
+                user_id=1, batch_type="autoclave", status="completed"
+            ).order_by(Batch.end_time.desc()),
+            # Партии за период (дашборд директора, экспорт)
+            "ix_batch_start_time": Batch.query.filter(*date_range_filter(Batch.start_time, week_ago, today)),
+            # Записи заливки за период
+            "ix_entry_date_shift": Entry.query.filter(*date_range_filter(Entry.date, week_ago, today)),
+            # История оператора за день (employee_dashboard)
+            "ix_entry_user_date_time": Entry.query.filter_by(user_id=1, date=today).order_by(Entry.time.desc()),
+        }
+
+        for index_name, query in plans.items():
+            plan = explain_query_plan(query)
+            assert index_name in plan, f"{index_name} не используется: {plan}"
+            print(f"✅ {index_name}: {plan}")
+
+def test_cache_invalidation():
+    """Коммит сбрасывает только значения, чья область затронута изменением"""
+    with app.app_context():
+        today = datetime.now().date()
+        past = today - timedelta(days=400)
+        user = User.query.first()
+
+        get_cached_data("test_entries_past", lambda: "past", scope=cache_scope(["entry"], past, past))
+        get_cached_data("test_entries_today", lambda: "today", scope=cache_scope(["entry"], today, today))
+        get_cached_data("test_cutting", lambda: "cutting", scope=cache_scope(["batch"], batch_types=["cutting"]))
+
+        entry = Entry(user_id=user.id, date=today, time="00:00:00", shift="TEST")
+        db.session.add(entry)
+        db.session.commit()
+        try:
+            assert cache.get("test_entries_today") is None, "значение за сегодня не сброшено"
+            assert cache.get("test_entries_past") == "past", "сброшено значение за прошлый период"
+            assert cache.get("test_cutting") == "cutting", "сброшено значение другой таблицы"
+
+            # Перенос записи в прошлое сбрасывает и старую, и новую дату
+            get_cached_data("test_entries_today", lambda: "today", scope=cache_scope(["entry"], today, today))
+            entry.date = past
+            db.session.commit()
+            assert cache.get("test_entries_today") is None
+            assert cache.get("test_entries_past") is None
+            print("✅ Кэш сбрасывается по области изменений")
+        finally:
+            db.session.delete(entry)
+            db.session.commit()
+            for key in ["test_entries_past", "test_entries_today", "test_cutting"]:
+                cache.delete(key)
+
+def test_cache_batch_move():
+    """Перенос партии на другую дату и тип сбрасывает области старых и новых значений, остальные живут"""
+    with app.app_context():
+        today = datetime.now().date()
+        past, other = today - timedelta(days=300), today - timedelta(days=200)
+        user = User.query.first()
+        material = Material.query.first()
+        batch = Batch(user_id=user.id, batch_number="CACHE-MOVE", batch_type="cutting",
+                      start_time=datetime.combine(past, datetime.min.time()).replace(hour=12))
+        db.session.add(batch)
+        db.session.commit()
+
+        scopes = {
+            "test_move_past_cutting": cache_scope(["batch"], past, past, ["cutting"]),
+            "test_move_today_autoclave": cache_scope(["batch"], today, today, ["autoclave"]),
+            "test_move_past_casting": cache_scope(["batch"], past, past, ["casting"]),
+            "test_move_other_day": cache_scope(["batch"], other, other),
+            "test_move_entries": cache_scope(["entry"], past, today),
+            "test_move_materials": cache_scope(["batch_material"], past, past),
+        }
+        fill = lambda: [get_cached_data(key, lambda: key, scope=scope) for key, scope in scopes.items()]
+        cached = lambda: {key for key in scopes if cache.get(key) == key}
+        try:
+            fill()
+            batch.start_time = datetime.combine(today, datetime.min.time())
+            batch.batch_type = "autoclave"
+            db.session.commit()
+            assert cached() == {"test_move_past_casting", "test_move_other_day", "test_move_entries", "test_move_materials"}, cached()
+
+            # Материал партии относится к ее дате: сбрасывается область сегодняшнего дня, а не прошлого
+            fill()
+            db.session.add(BatchMaterial(batch_id=batch.id, material_id=material.id, quantity=1.0))
+            db.session.commit()
+            assert cached() == set(scopes), cached()
+            print("✅ Кэш: перенос партии сбрасывает старую и новую дату")
+        finally:
+            BatchMaterial.query.filter_by(batch_id=batch.id).delete()
+            db.session.delete(batch)
+            db.session.commit()
+            for key in scopes:
+                cache.delete(key)
+
+def test_cache_single_flight():
+    """Параллельные промахи по одному ключу запускают загрузку ровно один раз"""
+    lru = LRUCache()
+    for round_number in range(5):
+        key = f"single-flight-{round_number}"
+        calls, results = [], []
+        start = threading.Barrier(16)
+
+        def loader():
+            calls.append(1)
+            time.sleep(0.05)
+            return key
+
+        def worker(delay):
+            start.wait()
+            time.sleep(delay)  # часть потоков приходит, пока загрузка идет
+            results.append(lru.get_or_load(key, loader, ttl_seconds=60))
+
+        threads = [threading.Thread(target=worker, args=(i * 0.005,)) for i in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(calls) == 1, f"загрузка выполнена {len(calls)} раз"
+        assert results == [key] * 16
+    assert lru._load_locks == {}, "блокировки загрузки не удалены"
+    print("✅ Кэш: single-flight загрузка")
+
+def test_reference_data_reload():
+    """Справочник перечитывается, когда другой воркер меняет таблицу, и не ходит в базу без изменений"""
+    from app import reference_data
+
+    bump_version = (
+        "INSERT INTO data_version (table_name, version, updated_at) VALUES ('equipment', 1, :now)"
+        " ON CONFLICT (table_name) DO UPDATE SET version = version + 1, updated_at = :now"
+    )
+
+    def worker_write(statement, **params):
+        """Запись другого воркера: мимо сессии этого процесса, без сброса снимка в apply_cache_changes"""
+        with app.app_context(), db.engine.begin() as connection:
+            connection.execute(db.text(statement), params)
+
+    # Каждый блок - отдельный запрос со своим контекстом приложения (и своим g)
+    with app.test_request_context():
+        equipment_id = Equipment.query.first().id
+        name = reference_data.equipment_names[equipment_id]
+    try:
+        worker_write("UPDATE equipment SET name = :name WHERE id = :id", name=name + " (другой воркер)", id=equipment_id)
+        with app.test_request_context():
+            with count_queries() as counter:
+                assert reference_data.equipment_names[equipment_id] == name, "снимок перечитан без смены версии"
+            assert counter["count"] == 1, "кроме версий справочник читался из базы"
+
+        worker_write(bump_version, now=datetime.now())
+        with app.test_request_context():
+            assert reference_data.equipment_names[equipment_id] == name + " (другой воркер)"
+            with count_queries() as counter:
+                reference_data.products, reference_data.materials, reference_data.equipment
+            assert counter["count"] == 0, "версии читаются больше одного раза за запрос"
+        print("✅ Справочники перечитываются после записи другого воркера")
+    finally:
+        worker_write("UPDATE equipment SET name = :name WHERE id = :id", name=name, id=equipment_id)
+        worker_write(bump_version, now=datetime.now())
+
+def test_conditional_requests():
+    """Повторный запрос с тем же ETag получает 304 без тяжелых запросов, запись сбрасывает ETag"""
+    with app.app_context():
+        client = app.test_client()
+        user = login_as(client, "director")
+
+        first = client.get("/director_dashboard")
+        assert first.status_code == 200 and first.headers.get("ETag")
+        etag = first.headers["ETag"]
+
+        with count_queries() as counter:
+            cached = client.get("/director_dashboard", headers={"If-None-Match": etag})
+        assert cached.status_code == 304, cached.status_code
+        assert counter["count"] <= 1, f"304 стоил {counter['count']} запросов"
+
+        # Только If-Modified-Since: 304 на свою же копию
+        last_modified = first.headers["Last-Modified"]
+        assert first.last_modified >= datetime.combine(datetime.now().date(), datetime.min.time()).astimezone(timezone.utc)
+        assert client.get("/director_dashboard", headers={"If-Modified-Since": last_modified}).status_code == 304
+
+        # Данные не менялись со вчерашнего дня, клиент хранит вчерашнюю копию: страница
+        # все равно новее - периоды по умолчанию считаются от сегодняшнего дня
+        saved = db.session.execute(db.select(DataVersion.table_name, DataVersion.updated_at)).all()
+        db.session.execute(db.update(DataVersion).values(updated_at=datetime.now() - timedelta(days=2)))
+        db.session.commit()
+        try:
+            yesterday = datetime.combine(datetime.now().date(), datetime.min.time()) - timedelta(seconds=1)
+            rolled = client.get("/director_dashboard", headers={"If-Modified-Since": http_date(yesterday.astimezone(timezone.utc))})
+        finally:
+            for table_name, updated_at in saved:
+                db.session.execute(db.update(DataVersion).where(DataVersion.table_name == table_name).values(updated_at=updated_at))
+            db.session.commit()
+        assert rolled.status_code == 200, "вчерашний If-Modified-Since дал 304"
+
+        entry = Entry(user_id=user.id, date=datetime.now().date(), time="00:00:00", shift="TEST")
+        db.session.add(entry)
+        db.session.commit()
+        try:
+            changed = client.get("/director_dashboard", headers={"If-None-Match": etag})
+            assert changed.status_code == 200, "ETag не изменился после записи"
+            assert changed.headers["ETag"] != etag
+            print("✅ ETag/304 для дашборда директора")
+        finally:
+            db.session.delete(entry)
+            db.session.commit()
+
+def test_xlsx_export():
+    """Потоковая XLSX-выгрузка партий и записей: заголовки, значения, порядок и форматы ячеек"""
+    import io
+    import openpyxl
+
+    with app.app_context():
+        client = app.test_client()
+        user = login_as(client, "director")
+        equipment = Equipment.query.first()
+        moment = datetime(2005, 6, 1, 8, 30)
+        records = [
+            Batch(user_id=user.id, batch_number=f"XLSX-{i}", batch_type="cutting", status="completed",
+                  equipment_id=equipment.id, start_time=moment + timedelta(hours=i),
+                  end_time=moment + timedelta(hours=i, minutes=40), notes=f"примечание {i}")
+            for i in range(3)
+        ]
+        records.append(Entry(user_id=user.id, date=moment.date(), time="08:30:00", shift="day", cement=12.5, water=3))
+        db.session.add_all(records)
+        db.session.commit()
+        try:
+            period = "date_from=2005-06-01&date_to=2005-06-01"
+            response = client.get(f"/export/batches_csv?{period}")
+            assert response.status_code == 200
+            sheet = openpyxl.load_workbook(io.BytesIO(response.data)).active
+            rows = list(sheet.iter_rows(values_only=True))
+            assert sheet.title == "Производственные партии" and sheet.freeze_panes == "A2"
+            assert rows[0][:4] == ("ID", "Номер партии", "Тип", "Статус")
+            # Новые сначала, даты в формате списка партий; пустой продукт читается обратно как None
+            assert [row[1] for row in rows[1:]] == ["XLSX-2", "XLSX-1", "XLSX-0"], rows
+            assert rows[1][2:] == ("cutting", "completed", None, equipment.name, user.fio,
+                                   "01.06.2005 10:30", "01.06.2005 11:10", "примечание 2"), rows[1]
+
+            response = client.get(f"/export/entries_csv?{period}")
+            sheet = openpyxl.load_workbook(io.BytesIO(response.data)).active
+            rows = list(sheet.iter_rows(values_only=True))
+            assert len(rows) == 2 and rows[0][5] == "Цемент (кг)"
+            assert rows[1][:6] == (records[-1].id, "01.06.2005", "08:30:00", "day", user.fio, 12.5), rows[1]
+            assert sheet.cell(row=2, column=6).number_format == "0.00"
+            assert sheet.cell(row=1, column=1).font.bold
+            print("✅ Выгрузка XLSX: содержимое листов партий и записей")
+        finally:
+            for record in records:
+                db.session.delete(record)
+            db.session.commit()
+
+def test_csv_export():
+    """CSV и csv.gz: одинаковое содержимое, экранирование, ISO-даты и пустые значения"""
+    import csv
+    import gzip
+    import io
+    from app import CSV_ROWS_PER_CHUNK, iter_csv
+
+    with app.app_context():
+        client = app.test_client()
+        user = login_as(client, "director")
+        moment = datetime(2005, 7, 1, 8, 30)
+        records = [
+            Batch(user_id=user.id, batch_number="CSV-DONE", batch_type="cutting", status="completed", shift="day",
+                  start_time=moment, end_time=moment + timedelta(minutes=45), notes='брак, "трещины"\nвторая строка'),
+            Batch(user_id=user.id, batch_number="CSV-OPEN", batch_type="cutting", status="active", shift="day",
+                  start_time=moment + timedelta(hours=1)),
+            Entry(user_id=user.id, date=moment.date(), time="08:30:00", shift="day", cement=12.5),
+        ]
+        db.session.add_all(records)
+        db.session.commit()
+        try:
+            period = "date_from=2005-07-01&date_to=2005-07-01"
+            plain = client.get(f"/export/batches.csv?{period}")
+            compressed = client.get(f"/export/batches.csv.gz?{period}")
+            assert plain.mimetype == "text/csv" and compressed.mimetype == "application/gzip"
+            assert compressed.headers["Content-Disposition"].endswith(".csv.gz")
+            assert gzip.decompress(compressed.data) == plain.data
+
+            rows = list(csv.reader(io.StringIO(plain.data.decode("utf-8"))))
+            assert rows[0] == ["id", "batch_number", "batch_type", "status", "shift", "product_code", "product",
+                               "equipment", "operator", "start_time", "end_time", "notes"]
+            assert [row[1] for row in rows[1:]] == ["CSV-OPEN", "CSV-DONE"]
+            assert rows[1][9:] == ["2005-07-01 09:30:00", "", ""]
+            assert rows[2][9:] == ["2005-07-01 08:30:00", "2005-07-01 09:15:00", 'брак, "трещины"\nвторая строка']
+            assert rows[2][5:9] == ["", "", "", user.fio]
+
+            rows = list(csv.reader(io.StringIO(client.get(f"/export/entries.csv?{period}").data.decode("utf-8"))))
+            assert len(rows) == 2 and rows[1][:5] == [str(records[-1].id), "2005-07-01", "08:30:00", "day", user.fio]
+            assert rows[1][rows[0].index("cement")] == "12.5"
+
+            rows = list(csv.reader(io.StringIO(client.get(f"/export/analytics.csv?{period}").data.decode("utf-8"))))
+            assert rows == [["batch_type", "status", "count"], ["cutting", "active", "1"], ["cutting", "completed", "1"]]
+
+            # Куски по CSV_ROWS_PER_CHUNK строк вместе дают один корректный gzip-поток
+            many = [(i, f"строка {i}") for i in range(CSV_ROWS_PER_CHUNK * 2 + 5)]
+            assert len(list(iter_csv(["id", "name"], iter(many)))) == 3
+            chunks = list(iter_csv(["id", "name"], iter(many), compress=True))
+            rows = list(csv.reader(io.StringIO(gzip.decompress(b"".join(chunks)).decode("utf-8"))))
+            assert rows[1:] == [[str(i), name] for i, name in many]
+            print("✅ Выгрузка CSV и csv.gz: содержимое совпадает")
+        finally:
+            for record in records:
+                db.session.delete(record)
+            db.session.commit()
+
+def test_export_jobs():
+    """Фоновая выгрузка: одинаковая задача не дублируется, готовый файл скачивается со всеми строками"""
+    import csv
+    import io
+    from app import CSV_ROWS_PER_CHUNK, EXPORT_FETCH_SIZE
+
+    with app.app_context(), tempfile.TemporaryDirectory() as export_dir:
+        directory, export_queue.directory = export_queue.directory, export_dir
+        client = app.test_client()
+        user = login_as(client, "director")
+        # Строк больше порции курсора и куска CSV, чтобы выгрузка прошла через несколько порций
+        count = max(CSV_ROWS_PER_CHUNK, EXPORT_FETCH_SIZE) + 205
+        day = datetime(2009, 5, 1).date()
+        entries = [
+            Entry(user_id=user.id, date=day, time=f"{8 + i // 3600 % 12:02d}:{i // 60 % 60:02d}:{i % 60:02d}",
+                  shift="day", cement=float(i))
+            for i in range(count)
+        ]
+        entries.append(Entry(user_id=user.id, date=day, time="23:00:00", shift="night", cement=1))
+        db.session.add_all(entries)
+        db.session.commit()
+        job_ids = set()
+        try:
+            params = {"kind": "entries", "format": "csv", "shift": "day", "date_from": "2009-05-01", "date_to": "2009-05-01"}
+
+            # Задача с теми же фильтрами, пока первая в очереди, не создается заново (лишние параметры не в счет)
+            queued, created = export_queue.submit("entries", "csv", dict(params, batch_type="all", status=""))
+            job_ids.add(queued.id)
+            duplicate = client.post("/export/jobs", data=dict(params, batch_type="all"))
+            assert duplicate.get_json()["id"] == queued.id, "дубликат незавершенной задачи"
+
+            for _ in range(200):
+                db.session.expire_all()  # запросы клиента идут в той же сессии, что и тест
+                status = client.get(f"/export/jobs/{queued.id}").get_json()
+                if status["status"] in ("done", "failed"):
+                    break
+                time.sleep(0.05)
+            assert status["status"] == "done", status
+            assert status["rows"] == count
+
+            download = client.get(status["download_url"])
+            assert download.status_code == 200
+            rows = list(csv.reader(io.StringIO(download.data.decode("utf-8"))))
+            assert len(rows) == count + 1
+            assert sorted(int(row[0]) for row in rows[1:]) == sorted(entry.id for entry in entries[:-1])
+            assert {row[3] for row in rows[1:]} == {"day"}
+
+            # Готовая задача не мешает новой
+            again = client.post("/export/jobs", data=params).get_json()
+            job_ids.add(again["id"])
+            assert again["id"] != queued.id
+            print(f"✅ Фоновая выгрузка: {status['rows']} строк")
+        finally:
+            export_queue.directory = directory
+            for _ in range(200):
+                if not ExportJob.query.filter(ExportJob.id.in_(job_ids), ExportJob.status.in_(("queued", "running"))).count():
+                    break
+                time.sleep(0.05)
+                db.session.expire_all()
+            for job in ExportJob.query.filter(ExportJob.id.in_(job_ids)):
+                if job.file_path and os.path.exists(job.file_path):
+                    os.remove(job.file_path)
+                db.session.delete(job)
+            for entry in entries:
+                db.session.delete(entry)
+            db.session.commit()
+
+def test_batch_keyset_pages():
+    """Страницы batch_list по курсорам after/before стыкуются без пропусков и повторов на одинаковом времени"""
+    from app import encode_batch_cursor, paginate_batches_keyset
+
+    with app.app_context():
+        user = User.query.filter_by(role="director").first()
+        moment = datetime(2004, 5, 1, 10)
+        # 8 партий, шесть из них в одну секунду - границы страниц по 3 попадают внутрь совпадающего времени
+        batches = [
+            Batch(user_id=user.id, batch_number=f"KEYSET-{i}", batch_type="casting",
+                  start_time=moment if i < 6 else moment + timedelta(minutes=i))
+            for i in range(8)
+        ]
+        db.session.add_all(batches)
+        db.session.commit()
+        try:
+            query = db.session.query(Batch, User).join(User, Batch.user_id == User.id).filter(
+                Batch.batch_number.like("KEYSET-%")
+            )
+            expected = [batch.id for batch in sorted(batches, key=lambda batch: (batch.start_time, batch.id), reverse=True)]
+            ids = lambda pagination: [batch.id for batch, _ in pagination.items]
+
+            # Вперед по after
+            pages = [paginate_batches_keyset(query, 3, total=8)]
+            while pages[-1].has_next:
+                pages.append(paginate_batches_keyset(query, 3, total=8, **pages[-1].next_args))
+            assert [ids(page) for page in pages] == [expected[0:3], expected[3:6], expected[6:8]]
+            assert [page.page for page in pages] == [1, 2, 3]
+            assert not pages[0].has_prev and pages[0].prev_args is None
+            assert pages[-1].has_prev and not pages[-1].has_next
+
+            # Назад по before с последней страницы возвращает те же страницы
+            back = paginate_batches_keyset(query, 3, total=8, **pages[-1].prev_args)
+            assert ids(back) == expected[3:6] and back.page == 2 and back.has_prev and back.has_next
+            first = paginate_batches_keyset(query, 3, total=8, **back.prev_args)
+            assert ids(first) == expected[0:3] and first.page == 1 and not first.has_prev
+
+            # За крайними партиями страниц нет
+            newest, oldest = db.session.get(Batch, expected[0]), db.session.get(Batch, expected[-1])
+            assert ids(paginate_batches_keyset(query, 3, before=encode_batch_cursor(newest), total=8)) == []
+            assert ids(paginate_batches_keyset(query, 3, after=encode_batch_cursor(oldest), total=8)) == []
+            # Негодный курсор - первая страница
+            assert ids(paginate_batches_keyset(query, 3, after="not-a-cursor", page=5, total=8)) == expected[0:3]
+            print("✅ Постраничный список партий по курсору")
+        finally:
+            for batch in batches:
+                db.session.delete(batch)
+            db.session.commit()
+
+def test_operator_stats():
+    """Активность операторов: записи и партии по сменам, типам и единицам материалов, порядок по последней активности"""
+    with app.app_context():
+        client = app.test_client()
+        login_as(client, "director")
+        first, second = User.query.order_by(User.id).limit(2).all()
+        cement = Material.query.filter_by(name="Цемент").first()
+        day = datetime(2007, 3, 1)
+        records = [
+            Entry(user_id=first.id, date=day.date(), time="09:00:00", shift="day", cement=10, water=5),
+            Entry(user_id=first.id, date=day.date(), time="11:00:00", shift="day"),
+            Entry(user_id=first.id, date=day.date(), time="22:00:00", shift="night", cement=1),
+            Batch(user_id=first.id, batch_number="OPERATOR-CUT", batch_type="cutting", shift="night",
+                  start_time=day.replace(hour=23)),
+            Batch(user_id=first.id, batch_number="OPERATOR-AUTOCLAVE", batch_type="autoclave", shift="day",
+                  start_time=day + timedelta(days=1, hours=15)),
+            Entry(user_id=second.id, date=day.date(), time="07:00:00", shift="night", lime=2),
+            # Вне периода - не учитывается
+            Entry(user_id=second.id, date=(day + timedelta(days=5)).date(), time="07:00:00", shift="day", lime=100),
+        ]
+        db.session.add_all(records)
+        db.session.flush()
+        records.append(BatchMaterial(batch_id=records[3].id, material_id=cement.id, quantity=4))
+        db.session.add(records[-1])
+        db.session.commit()
+        try:
+            response = client.get("/operator_stats?date_from=2007-03-01&date_to=2007-03-02")
+            assert response.status_code == 200
+            operators = response.get_json()["operators"]
+            assert [item["user_id"] for item in operators] == [first.id, second.id], "порядок не по последней активности"
+
+            stats = operators[0]
+            assert (stats["entries_count"], stats["batches_count"]) == (3, 2)
+            assert stats["batches_by_type"] == {"cutting": 1, "autoclave": 1}
+            assert stats["shifts"] == {"day": 3, "night": 2}, stats["shifts"]
+            assert stats["materials"] == {"kg": 15, "l": 5}, stats["materials"]
+            assert stats["last_activity"] == "2007-03-02T15:00:00"
+
+            stats = operators[1]
+            assert stats["shifts"] == {"night": 1} and stats["materials"] == {"kg": 2} and stats["batches_count"] == 0
+            assert stats["last_activity"] == "2007-03-01T07:00:00"
+
+            assert client.get("/operator_stats?date_from=2007-03-01").status_code == 400
+            print("✅ Активность операторов по сменам")
+        finally:
+            for record in reversed(records):
+                db.session.delete(record)
+            db.session.commit()
+
+def test_material_matrix():
+    """Сводная таблица материалов: колонка на каждый активный материал, новые и отключенные учитываются сразу"""
+    from app import material_matrix_page, reference_data
+
+    with app.app_context():
+        client = app.test_client()
+        user = login_as(client, "director")
+        cement = Material.query.filter_by(name="Цемент").first()
+        additive = Material(name="Тестовая добавка", unit="kg", is_active=True)
+        day = datetime(2008, 4, 1)
+        entry = Entry(user_id=user.id, date=day.date(), time="09:00:00", shift="day", cement=10)
+        batch = Batch(user_id=user.id, batch_number="MATRIX-TEST", batch_type="cutting", shift="night",
+                      start_time=day.replace(hour=21))
+        db.session.add_all([additive, entry, batch])
+        db.session.flush()
+        db.session.add_all([
+            BatchMaterial(batch_id=batch.id, material_id=additive.id, quantity=3),
+            BatchMaterial(batch_id=batch.id, material_id=cement.id, quantity=4),
+        ])
+        db.session.commit()
+
+        def matrix():
+            with app.test_request_context():
+                columns = reference_data.active_materials
+                rows, has_next = material_matrix_page(columns, day.date(), day.date())
+                names = [material.name for material in columns]
+                return names, {(row["type"], row["id"]): dict(zip(names, row["quantities"])) for row in rows}, has_next
+
+        def dashboard_header():
+            return client.get("/director_dashboard?date_from=2008-04-01&date_to=2008-04-01").data.decode("utf-8")
+
+        try:
+            names, rows, has_next = matrix()
+            assert "Тестовая добавка" in names and not has_next
+            assert rows[("batch", batch.id)]["Тестовая добавка"] == 3 and rows[("batch", batch.id)]["Цемент"] == 4
+            assert rows[("entry", entry.id)]["Цемент"] == 10 and rows[("entry", entry.id)]["Тестовая добавка"] == 0
+            assert sum(rows[("entry", entry.id)].values()) == 10, "расход записи попал в чужие колонки"
+            assert "Тестовая добавка (kg)" in dashboard_header()
+
+            # Отключенный материал пропадает из колонок, остальные значения остаются на своих местах
+            additive.is_active = False
+            db.session.commit()
+            names, rows, _ = matrix()
+            assert "Тестовая добавка" not in names
+            assert all(len(quantities) == len(names) for quantities in rows.values())
+            assert rows[("batch", batch.id)]["Цемент"] == 4 and rows[("entry", entry.id)]["Цемент"] == 10
+            assert "Тестовая добавка (kg)" not in dashboard_header()
+
+            # Листание таблицы сохраняет остальные фильтры дашборда
+            page = client.get(
+                "/director_dashboard?date_from=2008-04-01&date_to=2008-04-01&batch_type=cutting"
+                "&status=completed&product=all&equipment=all&materials_page=2"
+            ).data.decode("utf-8")
+            link = next(line for line in page.splitlines() if "← Новее" in line)
+            for arg in ("date_from=2008-04-01", "batch_type=cutting", "status=completed", "materials_page=1"):
+                assert arg in link, f"{arg} потерян в ссылке листания: {link}"
+            print(f"✅ Сводная таблица материалов: {len(names)} колонок")
+        finally:
+            BatchMaterial.query.filter_by(batch_id=batch.id).delete()
+            db.session.delete(batch)
+            db.session.delete(entry)
+            db.session.commit()
+            db.session.delete(additive)
+            db.session.commit()
+
+def test_timeline_pages():
+    """Страницы ленты по курсору идут подряд, без пропусков и повторов, даже при одинаковом времени"""
+    with app.app_context():
+        client = app.test_client()
+        user = login_as(client, "director")
+        day = datetime(2001, 1, 1)
+        moment = day.replace(hour=10)
+
+        # Семь событий в одну и ту же секунду - они точно попадут на границы страниц по 3
+        records = [Entry(user_id=user.id, date=day.date(), time="10:00:00", shift="day") for _ in range(4)]
+        records += [
+            Batch(user_id=user.id, batch_number=f"TIMELINE-{i}", batch_type="casting", start_time=moment)
+            for i in range(3)
+        ]
+        records += [
+            Entry(user_id=user.id, date=day.date(), time="09:59:59", shift="day"),
+            Batch(user_id=user.id, batch_number="TIMELINE-LATE", batch_type="cutting", start_time=moment.replace(second=1)),
+        ]
+        db.session.add_all(records)
+        db.session.commit()
+        try:
+            expected = sorted(
+                ((record.recorded_at if isinstance(record, Entry) else record.start_time,
+                  "entry" if isinstance(record, Entry) else "batch", record.id) for record in records),
+                reverse=True
+            )
+            period = "date_from=2001-01-01&date_to=2001-01-01"
+
+            seen, cursor, pages = [], "", 0
+            while True:
+                response = client.get(f"/timeline?{period}&limit=3&cursor={cursor}")
+                assert response.status_code == 200
+                page = response.get_json()
+                assert len(page["items"]) <= 3
+                seen += [(datetime.fromisoformat(item["datetime"]), item["type"], item["id"]) for item in page["items"]]
+                pages += 1
+                cursor = page["next_cursor"]
+                if not cursor:
+                    break
+                assert pages < 10, "курсор не продвигается"
+
+            assert seen == expected, "страницы по курсору не совпадают с полным порядком"
+            assert pages == 3
+
+            assert client.get(f"/timeline?{period}&cursor=not-a-cursor").status_code == 400
+
+            # Период из адреса попадает в скрипт «Показать еще» только как JSON-строка
+            html = client.get("/director_dashboard", query_string={"date_from": "x';alert(1)//</script>"}).data.decode("utf-8")
+            assert "alert(1)//</script>" not in html
+            assert 'date_from: "x\\u0027;alert(1)//\\u003c/script\\u003e"' in html
+            print(f"✅ Лента операций по курсору: {len(seen)} событий на {pages} страницах")
+        finally:
+            for record in records:
+                db.session.delete(record)
+            db.session.commit()
+
+def test_material_ledger():
+    """Журнал расхода и суточные итоги повторяют запись заливки и партию при создании, изменении и удалении"""
+    with app.app_context():
+        user = User.query.first()
+        material = Material.query.filter_by(name="Цемент").first()
+        entry = Entry(user_id=user.id, date=datetime.now().date(), time="00:00:00", shift="TEST", cement=5, water=2)
+        batch = Batch(user_id=user.id, batch_number="LEDGER-TEST", batch_type="cutting", shift="TEST", start_time=datetime(2001, 2, 1, 9))
+        db.session.add_all([entry, batch])
+        db.session.flush()
+        db.session.add(BatchMaterial(batch_id=batch.id, material_id=material.id, quantity=4))
+        db.session.commit()
+        entry_id = entry.id
+
+        def ledger():
+            return dict(db.session.query(Material.name, MaterialLedger.quantity).join(
+                Material, MaterialLedger.material_id == Material.id
+            ).filter(MaterialLedger.entry_id == entry_id).all())
+
+        def rollup():
+            # Строки смены TEST принадлежат только этому тесту
+            return {
+                (day.isoformat(), batch_type, name): quantity
+                for day, batch_type, name, quantity in db.session.query(
+                    DailyMaterialRollup.date, DailyMaterialRollup.batch_type,
+                    DailyMaterialRollup.material_name, DailyMaterialRollup.quantity
+                ).filter(DailyMaterialRollup.shift == "TEST", DailyMaterialRollup.count != 0)
+            }
+
+        today = datetime.now().date().isoformat()
+        try:
+            assert ledger() == {"Цемент": 5, "Вода": 2}, ledger()
+            assert rollup() == {
+                (today, "casting", "Цемент"): 5, (today, "casting", "Вода"): 2, ("2001-02-01", "cutting", "Цемент"): 4
+            }, rollup()
+
+            entry.cement = 0
+            entry.lime = 3
+            batch.materials[0].quantity = 6
+            batch.start_time = datetime(2001, 2, 2, 9)  # перенос партии переносит и итоги
+            db.session.commit()
+            assert ledger() == {"Известь": 3, "Вода": 2}, ledger()
+            assert rollup() == {
+                (today, "casting", "Известь"): 3, (today, "casting", "Вода"): 2, ("2001-02-02", "cutting", "Цемент"): 6
+            }, rollup()
+        finally:
+            db.session.delete(batch.materials[0])
+            db.session.delete(batch)
+            db.session.delete(entry)
+            db.session.commit()
+        assert ledger() == {}
+        assert rollup() == {}, rollup()
+        print("✅ Журнал расхода и суточные итоги синхронизированы с Entry и Batch")
+
+def test_duration_stats():
+    """Перцентили, гистограмма, overflow и open_cycles по партиям с известной длительностью"""
+    with app.app_context():
+        client = app.test_client()
+        user = login_as(client, "director")
+        equipment = Equipment.query.first()
+        start = datetime(2002, 3, 1, 8)
+
+        # Резка 1..100 минут (половина - на оборудовании), один забытый цикл на 10000 минут,
+        # одна незавершенная и одна отмененная партия - последние две в длительностях не участвуют
+        batches = [
+            Batch(user_id=user.id, batch_number=f"DURATION-{minutes}", batch_type="cutting", status="completed",
+                  equipment_id=equipment.id if minutes % 2 else None,
+                  start_time=start, end_time=start + timedelta(minutes=minutes))
+            for minutes in list(range(1, 101)) + [10000]
+        ]
+        batches += [
+            Batch(user_id=user.id, batch_number="DURATION-OPEN", batch_type="cutting", status="active", start_time=start),
+            Batch(user_id=user.id, batch_number="DURATION-CANCELLED", batch_type="cutting", status="cancelled",
+                  start_time=start, end_time=start + timedelta(minutes=5)),
+        ]
+        db.session.add_all(batches)
+        db.session.commit()
+        try:
+            response = client.get("/duration_stats?batch_type=cutting&bins=10&date_from=2002-03-01&date_to=2002-03-01")
+            stats = response.get_json()["batch_types"]["cutting"]
+
+            assert stats["count"] == 101 and stats["open_cycles"] == 1
+            # Линейная интерполяция NumPy по 101 значению: индексы 50, 90 и 99
+            assert (round(stats["p50"], 3), round(stats["p90"], 3), round(stats["p99"], 3)) == (51, 91, 100), stats
+            assert round(stats["max"]) == 10000
+
+            histogram = stats["histogram"]
+            assert histogram["edges"][0] == 0 and histogram["edges"][-1] == 100
+            assert histogram["counts"] == [9] + [10] * 8 + [11], histogram["counts"]
+            assert histogram["overflow"] == 1
+
+            by_equipment = {group["id"]: group["count"] for group in stats["by_equipment"]}
+            assert by_equipment == {equipment.id: 50, None: 51}, by_equipment
+            print(f"✅ Длительность резки: p50 = {stats['p50']:.0f}, p99 = {stats['p99']:.0f}, overflow = {histogram['overflow']}")
+        finally:
+            for batch in batches:
+                db.session.delete(batch)
+            db.session.commit()
+
+def test_equipment_sweep():
+    """Линия заметания находит занятость, конфликты и пары одновременных партий"""
+    from utilization import sweep, split_by_shift
+
+    start = datetime(2026, 1, 1, 19, 0)
+    hours = lambda value: start + timedelta(hours=value)
+    busy, overlaps, conflicts = sweep([
+        (hours(0), hours(2), 1),
+        (hours(1), hours(3), 2),
+        (hours(3), hours(4), 3),  # стыкуется с партией 2 - не конфликт
+        (hours(6), hours(7), 4),
+    ])
+    assert busy == [[hours(0), hours(4)], [hours(6), hours(7)]], busy
+    assert overlaps == [[hours(1), hours(2)]], overlaps
+    assert conflicts == [(1, 2, hours(1), hours(2))], conflicts
+
+    # Партия 7 стартует ровно в конце партии 5, пока идет партия 6: с 5 не конфликтует,
+    # а отрезки конфликта 5-6 и 6-7 сливаются в один
+    busy, overlaps, conflicts = sweep([
+        (hours(0), hours(2), 5),
+        (hours(1), hours(3), 6),
+        (hours(2), hours(4), 7),
+    ])
+    assert busy == [[hours(0), hours(4)]], busy
+    assert overlaps == [[hours(1), hours(3)]], overlaps
+    assert conflicts == [(5, 6, hours(1), hours(2)), (6, 7, hours(2), hours(3))], conflicts
+
+    # 19:00-21:00 - час дневной смены и час ночной
+    assert [(shift, minutes) for _, shift, minutes in split_by_shift(hours(0), hours(2))] == [("day", 60), ("night", 60)]
+    print("✅ Загрузка оборудования: занятость и конфликты")
+
+def test_equipment_open_batches():
+    """Незавершенная партия занимает оборудование до текущего момента, дни периода кэшируются пачкой"""
+    from app import get_equipment_utilization
+    from utilization import daily_utilization
+
+    with app.app_context():
+        user = User.query.filter_by(role="director").first()
+        equipment = Equipment.query.first()
+        day = datetime(2003, 4, 1).date()
+        at = lambda hour: datetime.combine(day, datetime.min.time()) + timedelta(hours=hour)
+        batches = [
+            Batch(user_id=user.id, batch_number="UTILIZATION-OPEN", batch_type="cutting", status="active",
+                  equipment_id=equipment.id, start_time=at(10)),
+            Batch(user_id=user.id, batch_number="UTILIZATION-DONE", batch_type="cutting", status="completed",
+                  equipment_id=equipment.id, start_time=at(9), end_time=at(11)),
+        ]
+        db.session.add_all(batches)
+        db.session.commit()
+        try:
+            # "Сейчас" - 12:00: открытая партия занята 10:00-12:00, вместе с завершенной - 09:00-12:00
+            usage = daily_utilization(day, day, [equipment.id], now=at(12))[day]
+            assert round(usage["equipment"][equipment.id]["busy"]) == 180, usage
+            assert round(usage["equipment"][equipment.id]["conflict"]) == 60, usage
+            assert [conflict["minutes"] for conflict in usage["conflicts"]] == [60]
+
+            # Дни периода читаются и пишутся в кэш одним обращением
+            keys = [f"equipment_utilization:{day + timedelta(days=offset)}" for offset in range(3)]
+            for key in keys:
+                cache.delete(key)
+            summary = {item["id"]: item for item in get_equipment_utilization(day, day + timedelta(days=2))}
+            assert summary[equipment.id]["batches"] == 2
+            assert sorted(cache.get_many(keys + ["equipment_utilization:missing"])) == sorted(keys)
+            print("✅ Загрузка оборудования: незавершенные партии и пакетный кэш дней")
+        finally:
+            for batch in batches:
+                db.session.delete(batch)
+            db.session.commit()
+
+def test_parquet_export():
+    """Parquet-выгрузка читается обратно с типами колонок, since_id отдает только новые строки"""
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("⚠️ pyarrow не установлен - проверка Parquet пропущена (pip install -r requirements-optional.txt)")
+        return
+    from app import write_batch_materials_parquet, write_batches_parquet, write_entries_parquet
+    from parquet_export import ENTRY_SCHEMA, write_parquet
+
+    with app.app_context(), tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "entries.parquet")
+        rows = [(i, datetime(2026, 1, 1).date(), "08:00:00", datetime(2026, 1, 1, 8), "day", 1, "Оператор")
+                + (float(i),) * (len(ENTRY_SCHEMA) - 8) + (datetime(2026, 1, 1, 8),) for i in range(5)]
+        assert write_parquet(path, ENTRY_SCHEMA, iter(rows), row_group_size=2) == 5
+        parquet_file = pq.ParquetFile(path)
+        assert parquet_file.metadata.num_row_groups == 3
+        table = parquet_file.read()
+        assert table.schema.equals(ENTRY_SCHEMA)
+        assert table.column("id").to_pylist() == [0, 1, 2, 3, 4]
+
+        user = User.query.filter_by(role="director").first()
+        product, equipment = Product.query.first(), Equipment.query.first()
+        cement = Material.query.filter_by(name="Цемент").first()
+        day = datetime(2009, 6, 1)
+        entries = [
+            Entry(user_id=user.id, date=day.date(), time=f"{8 + i:02d}:15:00", shift="day" if i < 4 else "night", cement=i + 0.5)
+            for i in range(6)
+        ]
+        batch = Batch(user_id=user.id, batch_number="PARQUET-1", batch_type="cutting", status="completed", shift="day",
+                      product_id=product.id, equipment_id=equipment.id,
+                      start_time=day.replace(hour=9), end_time=day.replace(hour=10))
+        db.session.add_all(entries + [batch])
+        db.session.flush()
+        material = BatchMaterial(batch_id=batch.id, material_id=cement.id, quantity=4.25)
+        db.session.add(material)
+        db.session.commit()
+        try:
+            period = {"date_from": "2009-06-01", "date_to": "2009-06-01"}
+            ids = [entry.id for entry in entries]
+            assert write_entries_parquet(period, path) == 6
+            table = pq.read_table(path)
+            assert table.column("id").to_pylist() == ids
+            assert table.column("cement").to_pylist() == [i + 0.5 for i in range(6)]
+            assert table.column("operator").to_pylist() == [user.fio] * 6
+            assert table.column("recorded_at").to_pylist()[0] == day.replace(hour=8, minute=15)
+
+            assert write_entries_parquet(dict(period, since_id=str(ids[2])), path) == 3
+            assert pq.read_table(path).column("id").to_pylist() == ids[3:]
+            assert write_entries_parquet(dict(period, shift="night"), path) == 2
+
+            assert write_batches_parquet(period, path) == 1
+            row = pq.read_table(path).to_pylist()[0]
+            assert (row["batch_number"], row["product_code"], row["equipment"]) == ("PARQUET-1", product.product_code, equipment.name), row
+            assert write_batch_materials_parquet(period, path) == 1
+            row = pq.read_table(path).to_pylist()[0]
+            assert (row["batch_id"], row["material"], row["quantity"]) == (batch.id, "Цемент", 4.25), row
+            print(f"✅ Выгрузка в Parquet: {len(ids)} записей и партия с материалом")
+        finally:
+            db.session.delete(material)
+            db.session.delete(batch)
+            for entry in entries:
+                db.session.delete(entry)
+            db.session.commit()
+
+def test_edit_entry_validation():
+    """Некорректное время или дата в edit_entry дают 400 и не меняют запись"""
+    with app.app_context():
+        client = app.test_client()
+        user = login_as(client, "director")
+        entry = Entry(user_id=user.id, date=datetime.now().date(), time="08:00:00", shift="TEST", cement=5)
+        db.session.add(entry)
+        db.session.commit()
+        try:
+            form = {"cement": "7", "time": "25:99", "shift": "TEST"}
+            assert client.post(f"/edit_entry/{entry.id}", data=form).status_code == 400
+            assert client.post(f"/edit_entry/{entry.id}", data=dict(form, time="09:30", date="2026-13-01")).status_code == 400
+            assert client.post(f"/edit_entry/{entry.id}", data=dict(form, time="09:30", cement="много")).status_code == 400
+            db.session.refresh(entry)
+            assert (entry.time, entry.cement) == ("08:00:00", 5), "запись изменена некорректной формой"
+
+            assert client.post(f"/edit_entry/{entry.id}", data=dict(form, time="09:30")).status_code == 302
+            db.session.refresh(entry)
+            assert (entry.time, entry.cement) == ("09:30:00", 7)
+            assert entry.recorded_at == datetime.combine(entry.date, datetime.strptime("09:30", "%H:%M").time())
+
+            # Запись в обход формы с негодным временем падает с понятной ошибкой, а не внутри fromisoformat
+            entry.time = "полдень"
+            try:
+                db.session.flush()
+                raise AssertionError("некорректное время сохранено")
+            except ValueError as e:
+                assert "Некорректное время записи заливки" in str(e)
+            db.session.rollback()
+            print("✅ Проверка времени и даты при редактировании записи")
+        finally:
+            db.session.rollback()
+            db.session.delete(db.session.get(Entry, entry.id))
+            db.session.commit()
+
+def test_kpi_snapshots():
+    """Снимки KPI: совпадают с прямым расчетом, не коммитят сессию, не пишутся до первых данных и после параллельной правки"""
+    from app import SNAPSHOT_DAY_TABLES, SNAPSHOT_GLOBAL_TABLES, first_data_day, get_data_versions, period_kpi_groups, store_kpi_snapshots
+
+    with app.app_context():
+        today = datetime.now().date()
+        date_from = datetime(1980, 1, 1).date()
+        user = User.query.filter_by(role="director").first()
+        cement = Material.query.filter_by(name="Цемент").first()
+        # Снимки из базы сохраняются и возвращаются в конце - тест их не теряет
+        saved = [
+            {"date": snapshot.date, "payload": snapshot.payload, "created_at": snapshot.created_at}
+            for snapshot in KpiSnapshot.query.all()
+        ]
+
+        # Свои записи в закрытых днях, чтобы снимкам было что замораживать и на пустой базе
+        records = [
+            Entry(user_id=user.id, date=today - timedelta(days=5), time="09:00:00", shift="day", cement=7),
+            Entry(user_id=user.id, date=today - timedelta(days=2), time="21:00:00", shift="night", water=3),
+            Batch(user_id=user.id, batch_number="KPI-SNAPSHOT", batch_type="cutting", status="completed", shift="day",
+                  start_time=datetime.combine(today - timedelta(days=3), datetime.min.time()).replace(hour=10),
+                  end_time=datetime.combine(today - timedelta(days=3), datetime.min.time()).replace(hour=11)),
+        ]
+        db.session.add_all(records)
+        db.session.flush()
+        records.append(BatchMaterial(batch_id=records[2].id, material_id=cement.id, quantity=4))
+        db.session.add(records[-1])
+        db.session.commit()
+
+        def direct():
+            return build_dashboard_kpis(aggregate_entry_groups(date_from, today), aggregate_batch_groups(date_from, today))
+
+        def via_snapshots():
+            with app.test_request_context():
+                groups = period_kpi_groups(date_from, today)
+                return build_dashboard_kpis(groups["entry_groups"], groups["batch_groups"])
+
+        def same(left, right):
+            return all(
+                abs(left[key] - right[key]) < 1e-6 if isinstance(left[key], float) else left[key] == right[key]
+                for key in left
+            )
+
+        def drop_snapshots():
+            KpiSnapshot.query.delete()
+            db.session.commit()
+
+        extra = []
+        try:
+            drop_snapshots()
+            assert same(via_snapshots(), direct()), "KPI по снимкам отличаются от прямого расчета"
+            first_day = first_data_day()
+            assert first_day is not None and first_day <= today - timedelta(days=5), first_day
+            stored = [day for (day,) in db.session.query(KpiSnapshot.date)]
+            assert all(first_day <= day < today for day in stored), "заморожены дни без данных или сегодняшний"
+            assert len(stored) == (today - first_day).days
+            assert same(via_snapshots(), direct()), "KPI по готовым снимкам отличаются от прямого расчета"
+
+            # Чтение не коммитит чужие изменения сессии и не замораживает их
+            drop_snapshots()
+            db.session.add(Entry(user_id=user.id, date=today - timedelta(days=1), time="12:00:00", shift="TEST", cement=1))
+            via_snapshots()
+            db.session.rollback()
+            assert Entry.query.filter_by(shift="TEST").count() == 0, "чтение закоммитило сессию"
+            assert KpiSnapshot.query.count() == 0, "заморожены незакоммиченные данные"
+
+            # Правка, закоммиченная между расчетом и записью снимков, отменяет запись
+            versions, _ = get_data_versions(SNAPSHOT_DAY_TABLES + SNAPSHOT_GLOBAL_TABLES)
+            rows = [{"date": today - timedelta(days=2), "payload": "{}", "created_at": datetime.now()}]
+            records[1].water = 5
+            db.session.commit()
+            assert not store_kpi_snapshots(rows, versions), "снимок записан поверх параллельной правки"
+            assert KpiSnapshot.query.count() == 0
+            versions, _ = get_data_versions(SNAPSHOT_DAY_TABLES + SNAPSHOT_GLOBAL_TABLES)
+            assert store_kpi_snapshots(rows, versions) and KpiSnapshot.query.count() == 1
+            drop_snapshots()
+
+            # Правка прошлой записи сбрасывает снимок ее дня
+            via_snapshots()
+            extra.append(Entry(user_id=user.id, date=today - timedelta(days=1), time="12:00:00", shift="TEST", cement=1))
+            db.session.add(extra[-1])
+            db.session.commit()
+            assert db.session.get(KpiSnapshot, today - timedelta(days=1)) is None
+            assert same(via_snapshots(), direct())
+            print(f"✅ Снимки KPI закрытых дней: {len(stored)} дней")
+        finally:
+            db.session.rollback()
+            for record in reversed(records + extra):
+                db.session.delete(record)
+            db.session.commit()
+            drop_snapshots()
+            if saved:
+                db.session.execute(db.insert(KpiSnapshot), saved)
+                db.session.commit()
+
+def test_timeseries_buckets():
+    """Ряды расхода: метки корзин по всему периоду, нули в пустых корзинах, суммы в своих корзинах"""
+    with app.app_context():
+        client = app.test_client()
+        user = login_as(client, "director")
+        # 2006-01-29 - воскресенье, 2006-01-30 - понедельник
+        entries = [
+            Entry(user_id=user.id, date=datetime(2006, 1, 29).date(), time="21:00:00", shift="night", cement=1),
+            Entry(user_id=user.id, date=datetime(2006, 1, 30).date(), time="10:15:00", shift="day", cement=2),
+            Entry(user_id=user.id, date=datetime(2006, 1, 30).date(), time="10:45:00", shift="day", cement=3),
+            Entry(user_id=user.id, date=datetime(2006, 2, 13).date(), time="08:00:00", shift="day", cement=4, water=7),
+        ]
+        db.session.add_all(entries)
+        db.session.commit()
+
+        def series(bucket, date_from="2006-01-29", date_to="2006-02-14"):
+            response = client.get(f"/analytics/timeseries?bucket={bucket}&date_from={date_from}&date_to={date_to}")
+            assert response.status_code == 200, response.get_json()
+            data = response.get_json()
+            return data["labels"], {(item["batch_type"], item["material"]): item["values"] for item in data["series"]}
+
+        try:
+            labels, values = series("day")
+            assert len(labels) == 17 and labels[0] == "2006-01-29" and labels[-1] == "2006-02-14"
+            cement = values[("casting", "Цемент")]
+            assert cement[0] == 1 and cement[1] == 5 and cement[15] == 4 and sum(cement) == 10
+            assert cement.count(0) == 14, "пустые дни не заполнены нулями"
+            assert list(values) == [("casting", "Цемент"), ("casting", "Вода")], "порядок рядов не как в записи заливки"
+
+            # Неделя - с понедельника; воскресенье 29.01 относится к неделе с 23.01
+            labels, values = series("week")
+            assert labels == ["2006-01-23", "2006-01-30", "2006-02-06", "2006-02-13"]
+            assert values[("casting", "Цемент")] == [1, 5, 0, 4]
+
+            labels, values = series("month")
+            assert labels == ["2006-01", "2006-02"] and values[("casting", "Цемент")] == [6, 4]
+
+            labels, values = series("shift")
+            assert labels == ["2006-01-29 night", "2006-01-30 day", "2006-02-13 day"]
+            assert values[("casting", "Вода")] == [0, 0, 7]
+
+            labels, values = series("hour", "2006-01-30", "2006-01-30")
+            assert len(labels) == 24 and labels[10] == "2006-01-30 10"
+            assert values[("casting", "Цемент")] == [0] * 10 + [5] + [0] * 13
+
+            assert client.get("/analytics/timeseries?bucket=year&date_from=2006-01-01&date_to=2006-02-01").status_code == 400
+            assert client.get("/analytics/timeseries?bucket=day&date_from=2006-02-01&date_to=2006-01-01").status_code == 400
+            print("✅ Ряды расхода: метки корзин и нули в пустых корзинах")
+        finally:
+            for entry in entries:
+                db.session.delete(entry)
+            db.session.commit()
+
+def test_downsample():
+    """LTTB сохраняет края, пики и провалы рядов; parse_points отбрасывает негодные значения"""
+    from downsample import lttb_indices, parse_points
+
+    x = list(range(1000))
+    flat = [1.0] * 1000
+    spiky = [0.0] * 1000
+    spiky[137], spiky[700] = 50.0, -30.0  # пик одного ряда и провал другого не должны пропасть
+    flat[420] = 9.0
+
+    indices = lttb_indices(x, [spiky, flat], 40)
+    assert len(indices) == 40
+    assert indices[0] == 0 and indices[-1] == 999
+    assert list(indices) == sorted(set(indices.tolist())), "индексы не по возрастанию или повторяются"
+    assert {137, 700, 420} <= set(indices.tolist())
+    assert list(lttb_indices(x[:10], [flat[:10]], 40)) == list(range(10)), "короткий ряд прорежен"
+
+    assert parse_points("500") == 500
+    assert parse_points("100000") == 5000
+    assert parse_points("2") is None and parse_points("abc") is None and parse_points(None) is None
+    print("✅ Прореживание рядов LTTB")
+
 if __name__ == "__main__":
-    test_system()
+    # Тот же порядок, что у pytest, - по порядку в файле. Каждый тест сам создает и
+    # удаляет свои записи и не зависит от того, какие тесты шли до него.
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
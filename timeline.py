@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Лента операций: записи заливки (Entry) и созданные партии (Batch).
+
+Оба потока уже отсортированы базой (новые сначала) и сливаются лениво через
+heapq.merge, поэтому для страницы из N событий из каждой таблицы читается не
+больше N + 1 строк - первая страница за 90 дней стоит столько же, сколько за день.
+
+Следующая страница запрашивается по курсору - ключу последнего показанного
+события (время, тип, id). Порядок при равном времени задан типом и id, так
+что события не теряются и не повторяются между страницами.
+"""
+
+import base64
+import heapq
+import json
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import and_, or_
+
+from models import db, Entry, Batch, User
+
+TIMELINE_PAGE_SIZE = 15
+TIMELINE_MAX_PAGE_SIZE = 100
+STREAM_FETCH_SIZE = 500
+
+BATCH_STATUS_TEXT = {
+    "cancelled": " (ОТМЕНЕНА)",
+    "completed": " (ЗАВЕРШЕНА)",
+    "inactive": " (ПРИОСТАНОВЛЕНА)",
+}
+
+def encode_cursor(item):
+    payload = json.dumps([item["datetime"].isoformat(), item["type"], item["data"].id])
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+def decode_cursor(value):
+    """Ключ (время, тип, id) из курсора; ValueError, если курсор испорчен"""
+    try:
+        moment, kind, item_id = json.loads(base64.urlsafe_b64decode(value.encode("ascii")))
+        if kind not in ("entry", "batch"):
+            raise ValueError(kind)
+        return datetime.fromisoformat(moment), kind, int(item_id)
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"Некорректный курсор: {value}") from e
+
+def _limited(query, limit):
+    return query.limit(limit) if limit else query.yield_per(STREAM_FETCH_SIZE)
+
+def entry_stream(date_filter, cursor=None, limit=None):
+    """События заливки, новые сначала"""
+    query = db.session.query(Entry, User).join(User, Entry.user_id == User.id).filter(*date_filter(Entry.recorded_at))
+    if cursor:
+        moment, kind, item_id = cursor
+        if kind == "entry":
+            # При равном времени запись заливки идет после записи с большим id
+            query = query.filter(or_(Entry.recorded_at < moment, and_(Entry.recorded_at == moment, Entry.id < item_id)))
+        else:
+            query = query.filter(Entry.recorded_at < moment)
+    query = query.order_by(Entry.recorded_at.desc(), Entry.id.desc())
+
+    for entry, user in _limited(query, limit):
+        yield {
+            "type": "entry",
+            "datetime": entry.recorded_at,
+            "user": user,
+            "data": entry,
+            "description": f"Ввод данных заливки - {entry.shift} смена",
+        }
+
+def batch_stream(date_filter, cursor=None, limit=None):
+    """События создания партий, новые сначала"""
+    query = db.session.query(Batch, User).join(User, Batch.user_id == User.id).filter(*date_filter(Batch.start_time))
+    if cursor:
+        moment, kind, item_id = cursor
+        if kind == "batch":
+            query = query.filter(or_(Batch.start_time < moment, and_(Batch.start_time == moment, Batch.id < item_id)))
+        else:
+            # При равном времени партия идет после записи заливки
+            query = query.filter(Batch.start_time <= moment)
+    query = query.order_by(Batch.start_time.desc(), Batch.id.desc())
+
+    for batch, user in _limited(query, limit):
+        yield {
+            "type": "batch",
+            "datetime": batch.start_time,
+            "user": user,
+            "data": batch,
+            "description": f"Создание партии {batch.batch_type} - {batch.batch_number}{BATCH_STATUS_TEXT.get(batch.status, '')}",
+        }
+
+def sort_key(item):
+    return item["datetime"], item["type"], item["data"].id
+
+def iter_timeline(date_filter, cursor=None, limit=None):
+    """Все события после курсора, новые сначала; limit ограничивает чтение каждого потока.
+
+    date_filter(колонка) возвращает условия периода (см. date_range_filter в app.py).
+    """
+    return heapq.merge(
+        entry_stream(date_filter, cursor, limit),
+        batch_stream(date_filter, cursor, limit),
+        key=sort_key,
+        reverse=True
+    )
+
+def timeline_page(date_filter, cursor=None, limit=TIMELINE_PAGE_SIZE):
+    """Страница ленты: (события, курсор следующей страницы или None)"""
+    items = list(islice(iter_timeline(date_filter, cursor, limit + 1), limit + 1))
+    if len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    return items, encode_cursor(items[-1])
+
+def timeline_item_json(item):
+    """Событие ленты для JSON-ответа"""
+    data = item["data"]
+    result = {
+        "type": item["type"],
+        "id": data.id,
+        "datetime": item["datetime"].isoformat(),
+        "user": item["user"].fio,
+        "description": item["description"],
+    }
+    if item["type"] == "batch":
+        result["batch_type"] = data.batch_type
+        result["status"] = data.status
+    return result
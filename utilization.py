@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Загрузка оборудования: занятость, простой и одновременные партии.
+
+Интервалы партий (start_time, end_time) каждой единицы оборудования
+читаются одним запросом, уже отсортированными по началу, и проходятся
+линией заметания: события начала и конца упорядочены по времени, счетчик
+активных партий дает отрезки занятости (>= 1) и конфликтов (>= 2). Пары
+пересекающихся партий находятся тем же проходом - при старте партия
+сравнивается только с еще активными, поэтому год партий обрабатывается за
+O(n log n) без попарного сравнения всех интервалов.
+
+Отрезки режутся по суткам и сменам: дневная смена - с 08:00 до 20:00,
+ночная - остальные часы календарного дня. Незавершенные партии считаются
+занятыми до текущего момента, отмененные не учитываются.
+"""
+
+import heapq
+from datetime import datetime, time, timedelta
+
+from models import db, Batch
+
+DAY_SHIFT_START = time(8, 0)
+DAY_SHIFT_END = time(20, 0)
+SHIFTS = ("day", "night")
+
+def utilization_intervals(period_start, period_end, now):
+    """Интервалы партий с оборудованием, пересекающие [period_start, period_end):
+    {equipment_id: [(начало, конец, id партии), ...]} по возрастанию начала
+    """
+    query = db.session.query(Batch.equipment_id, Batch.start_time, Batch.end_time, Batch.id).filter(
+        Batch.equipment_id.isnot(None),
+        Batch.status != "cancelled",
+        Batch.start_time < period_end,
+        db.or_(
+            Batch.end_time > period_start,
+            db.and_(Batch.end_time.is_(None), Batch.status.in_(("active", "inactive")))
+        )
+    ).order_by(Batch.equipment_id, Batch.start_time, Batch.id)
+
+    intervals = {}
+    for equipment_id, start, end, batch_id in query:
+        end = end or now
+        if end > start:
+            intervals.setdefault(equipment_id, []).append((start, end, batch_id))
+    return intervals
+
+def sweep(intervals):
+    """Отрезки занятости и конфликтов и пересекающиеся пары для интервалов одной единицы.
+
+    Возвращает (busy, overlaps, conflicts): busy и overlaps - списки (начало,
+    конец) без пересечений, conflicts - (партия, партия, начало, конец) для
+    каждой пары одновременно активных партий.
+    """
+    busy, overlaps, conflicts = [], [], []
+    active = []  # куча (конец, id партии) активных партий
+    for start, end, batch_id in intervals:
+        while active and active[0][0] <= start:
+            finished, _ = heapq.heappop(active)
+            _close_segments(busy, overlaps, active, finished)
+
+        for other_end, other_id in active:
+            conflicts.append((other_id, batch_id, start, min(end, other_end)))
+
+        _open_segments(busy, overlaps, active, start)
+        heapq.heappush(active, (end, batch_id))
+
+    while active:
+        finished, _ = heapq.heappop(active)
+        _close_segments(busy, overlaps, active, finished)
+    return busy, overlaps, conflicts
+
+def _open_segments(busy, overlaps, active, moment):
+    """Старт партии: начинается занятость (0 -> 1 активная) или конфликт (1 -> 2)"""
+    if not active:
+        if busy and busy[-1][1] == moment:
+            busy[-1][1] = None  # партия встык к предыдущей продолжает занятость
+        else:
+            busy.append([moment, None])
+    elif len(active) == 1:
+        if overlaps and overlaps[-1][1] == moment:
+            overlaps[-1][1] = None
+        else:
+            overlaps.append([moment, None])
+
+def _close_segments(busy, overlaps, active, moment):
+    """Конец партии (уже снятой с кучи): закрывается конфликт (2 -> 1) или занятость (1 -> 0)"""
+    if len(active) == 1:
+        overlaps[-1][1] = moment
+    elif not active:
+        busy[-1][1] = moment
+
+def split_by_shift(start, end):
+    """Части отрезка по суткам и сменам: (дата, смена, минуты)"""
+    while start < end:
+        day = start.date()
+        day_start = datetime.combine(day, DAY_SHIFT_START)
+        day_end = datetime.combine(day, DAY_SHIFT_END)
+        if start < day_start:
+            boundary, shift = day_start, "night"
+        elif start < day_end:
+            boundary, shift = day_end, "day"
+        else:
+            boundary, shift = datetime.combine(day + timedelta(days=1), time.min), "night"
+        piece_end = min(end, boundary)
+        yield day, shift, (piece_end - start).total_seconds() / 60
+        start = piece_end
+
+def shift_windows(day, now):
+    """Длительность смен дня в минутах (сегодняшний день - только прошедшая часть)"""
+    windows = dict.fromkeys(SHIFTS, 0.0)
+    day_start = datetime.combine(day, time.min)
+    for _, shift, minutes in split_by_shift(day_start, min(day_start + timedelta(days=1), now)):
+        windows[shift] += minutes
+    return windows
+
+def empty_day_usage(day, now):
+    windows = shift_windows(day, now)
+    return {
+        "busy": 0.0,
+        "conflict": 0.0,
+        "batches": 0,
+        "shifts": {shift: {"busy": 0.0, "window": windows[shift]} for shift in SHIFTS},
+        "window": sum(windows.values()),
+    }
+
+def daily_utilization(date_from, date_to, equipment_ids, now=None):
+    """Загрузка по дням периода: {дата: {"equipment": {id: показатели}, "conflicts": [...]}}
+
+    Показатели единицы за день - минуты занятости (busy), конфликтов (conflict),
+    число начатых партий и окна смен. Конфликт пары относится ко дню его начала.
+    """
+    now = now or datetime.now()
+    period_start = datetime.combine(date_from, time.min)
+    period_end = min(datetime.combine(date_to + timedelta(days=1), time.min), now)
+    days = {}
+    day = date_from
+    while day <= date_to:
+        days[day] = {
+            "equipment": {equipment_id: empty_day_usage(day, now) for equipment_id in equipment_ids},
+            "conflicts": [],
+        }
+        day += timedelta(days=1)
+
+    def clipped(segments):
+        for start, end in segments:
+            start, end = max(start, period_start), min(end, period_end)
+            if start < end:
+                yield start, end
+
+    for equipment_id, intervals in utilization_intervals(period_start, period_end, now).items():
+        busy, overlaps, conflicts = sweep(intervals)
+        usage = {
+            day: item["equipment"].setdefault(equipment_id, empty_day_usage(day, now))
+            for day, item in days.items()
+        }
+
+        for start, end in clipped(busy):
+            for day, shift, minutes in split_by_shift(start, end):
+                usage[day]["busy"] += minutes
+                usage[day]["shifts"][shift]["busy"] += minutes
+        for start, end in clipped(overlaps):
+            for day, _, minutes in split_by_shift(start, end):
+                usage[day]["conflict"] += minutes
+        for start, _, _ in intervals:
+            if period_start <= start < period_end:
+                usage[start.date()]["batches"] += 1
+
+        for batch_id, other_id, start, end in conflicts:
+            start, end = max(start, period_start), min(end, period_end)
+            if start < end:
+                days[start.date()]["conflicts"].append({
+                    "equipment_id": equipment_id,
+                    "batch_id": batch_id,
+                    "other_batch_id": other_id,
+                    "start": start.isoformat(),
+                    "end": end.isoformat(),
+                    "minutes": (end - start).total_seconds() / 60,
+                })
+    return days
+
+def utilization_percent(busy, window):
+    return round(busy / window * 100, 1) if window else None
+
+def summarize_utilization(days, equipment):
+    """Сводка периода по единицам оборудования из дневных показателей.
+
+    equipment - [(id, название, тип)]; единицы с партиями, но без записи в
+    справочнике, тоже попадают в сводку.
+    """
+    names = {equipment_id: (name, equipment_type) for equipment_id, name, equipment_type in equipment}
+    ids = list(names)
+    for item in days.values():
+        for equipment_id in item["equipment"]:
+            if equipment_id not in ids:
+                ids.append(equipment_id)
+
+    result = []
+    for equipment_id in ids:
+        name, equipment_type = names.get(equipment_id, (None, None))
+        total = {"busy": 0.0, "conflict": 0.0, "window": 0.0, "batches": 0}
+        shifts = {shift: {"busy": 0.0, "window": 0.0} for shift in SHIFTS}
+        by_day, conflicts = [], []
+        for day, item in sorted(days.items()):
+            usage = item["equipment"].get(equipment_id)
+            if usage is None:
+                continue
+            for key in total:
+                total[key] += usage[key]
+            for shift in SHIFTS:
+                shifts[shift]["busy"] += usage["shifts"][shift]["busy"]
+                shifts[shift]["window"] += usage["shifts"][shift]["window"]
+            by_day.append({
+                "date": day.isoformat(),
+                "busy_minutes": round(usage["busy"], 1),
+                "conflict_minutes": round(usage["conflict"], 1),
+                "batches": usage["batches"],
+                "utilization": utilization_percent(usage["busy"], usage["window"]),
+                "shifts": {
+                    shift: utilization_percent(usage["shifts"][shift]["busy"], usage["shifts"][shift]["window"])
+                    for shift in SHIFTS
+                },
+            })
+            conflicts += [conflict for conflict in item["conflicts"] if conflict["equipment_id"] == equipment_id]
+
+        result.append({
+            "id": equipment_id,
+            "name": name,
+            "equipment_type": equipment_type,
+            "busy_minutes": round(total["busy"], 1),
+            "idle_minutes": round(total["window"] - total["busy"], 1),
+            "window_minutes": round(total["window"], 1),
+            "conflict_minutes": round(total["conflict"], 1),
+            "batches": total["batches"],
+            "utilization": utilization_percent(total["busy"], total["window"]),
+            "shifts": {
+                shift: {
+                    "busy_minutes": round(values["busy"], 1),
+                    "window_minutes": round(values["window"], 1),
+                    "utilization": utilization_percent(values["busy"], values["window"]),
+                }
+                for shift, values in shifts.items()
+            },
+            "days": by_day,
+            "conflicts": [
+                {key: value for key, value in conflict.items() if key != "equipment_id"}
+                for conflict in conflicts
+            ],
+        })
+    return result
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Потоковая выгрузка в Excel (XLSX) с постоянным расходом памяти.
+
+Книга создается в режиме write_only: строки сразу уходят во временный файл
+на диске, а не накапливаются в памяти в виде объектов ячеек. Стили общие
+(именованные), ширина колонок задается заранее - в режиме write_only ее
+нельзя поменять после записи строк. Готовые файлы кэшируются и отдаются
+через send_file (см. ExportFileCache в export_jobs.py).
+"""
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
+from openpyxl.utils import get_column_letter
+
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+MAX_COLUMN_WIDTH = 50
+
+def column_width(header, content_length):
+    """Ширина колонки по заголовку и ожидаемой длине значений (как прежняя автоширина)"""
+    return min(max(len(header), content_length) + 2, MAX_COLUMN_WIDTH)
+
+def _named_styles(header_color):
+    thin = Side(style="thin")
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    header = NamedStyle(
+        name="export_header",
+        font=Font(bold=True, color="FFFFFF", size=12),
+        fill=PatternFill(start_color=header_color, end_color=header_color, fill_type="solid"),
+        alignment=Alignment(horizontal="center", vertical="center"),
+        border=border
+    )
+    cell = NamedStyle(
+        name="export_cell",
+        alignment=Alignment(horizontal="left", vertical="center"),
+        border=border
+    )
+    number = NamedStyle(
+        name="export_number",
+        alignment=Alignment(horizontal="left", vertical="center"),
+        border=border,
+        number_format="0.00"
+    )
+    return header, cell, number
+
+def write_xlsx(path, title, columns, rows, header_color="366092"):
+    """Записывает лист в файл path.
+
+    columns - список (заголовок, ширина, числовой ли формат), rows - итератор
+    строк-последовательностей; строки читаются по одной и в памяти не копятся.
+    Возвращает количество записанных строк.
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    header_style, cell_style, number_style = _named_styles(header_color)
+    for style in (header_style, cell_style, number_style):
+        workbook.add_named_style(style)
+
+    worksheet = workbook.create_sheet(title)
+    for index, (_, width, _) in enumerate(columns, 1):
+        worksheet.column_dimensions[get_column_letter(index)].width = width
+    worksheet.freeze_panes = "A2"
+
+    def styled(value, style):
+        cell = WriteOnlyCell(worksheet, value=value)
+        cell.style = style
+        return cell
+
+    worksheet.append([styled(header, "export_header") for header, _, _ in columns])
+
+    styles = ["export_number" if is_number else "export_cell" for _, _, is_number in columns]
+    count = 0
+    for row in rows:
+        worksheet.append([styled(value, style) for value, style in zip(row, styles)])
+        count += 1
+
+    workbook.save(path)
+    return count